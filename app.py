@@ -5,9 +5,33 @@ from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, UserEditForm, LoginForm, MessageForm
-from models import db, connect_db, User, Message
+from models import db, connect_db, User, Message, Likes
+import assets
+import batch
+import cards
+import compression
+import counters
+import dbpool
+import dbstats
+import fragments
+import http_cache
+import identity
+import image_proxy
+import message_likes
+import message_search
+import metrics
+import passwords
+import replicas
+import pagination
+import streaming
+import templating
+import timeline
+import user_follows
+import user_search
+import viewer
 
 CURR_USER_KEY = "curr_user"
+BUSY_MESSAGE = "We're handling a lot of logins right now, please try again in a moment."
 
 app = Flask(__name__)
 
@@ -20,9 +44,140 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Connection pool limits for every database engine; set DB_POOLER=transaction
+# behind PgBouncer in transaction mode. See dbpool.py.
+app.config['DB_POOL_SIZE'] = int(
+    os.environ.get('DB_POOL_SIZE', dbpool.DEFAULT_POOL_SIZE))
+app.config['DB_POOL_MAX_OVERFLOW'] = int(
+    os.environ.get('DB_POOL_MAX_OVERFLOW', dbpool.DEFAULT_MAX_OVERFLOW))
+app.config['DB_POOL_TIMEOUT'] = int(
+    os.environ.get('DB_POOL_TIMEOUT', dbpool.DEFAULT_POOL_TIMEOUT))
+app.config['DB_POOL_RECYCLE'] = int(
+    os.environ.get('DB_POOL_RECYCLE', dbpool.DEFAULT_POOL_RECYCLE))
+app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', '1') != '0'
+app.config['DB_POOLER'] = os.environ.get('DB_POOLER')
+
+# Read-only views query these replicas (comma-separated, each optionally
+# `url|weight`); see replicas.py.
+app.config['SQLALCHEMY_REPLICA_URIS'] = [
+    url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+app.config['REPLICA_RETRY_AFTER'] = int(
+    os.environ.get('REPLICA_RETRY_AFTER', replicas.DEFAULT_RETRY_AFTER))
+app.config['READ_YOUR_WRITES_SECONDS'] = int(
+    os.environ.get('READ_YOUR_WRITES_SECONDS', replicas.DEFAULT_READ_YOUR_WRITES))
+
+# Authors with more followers than this are pulled into home feeds at read
+# time instead of being fanned out to every follower's timeline on write.
+app.config['TIMELINE_FANOUT_LIMIT'] = int(
+    os.environ.get('TIMELINE_FANOUT_LIMIT', timeline.DEFAULT_FANOUT_LIMIT))
+
+# Messages per page on the home, profile and likes pages; older pages are
+# reached with the `?before=` cursor.
+app.config['MESSAGES_PER_PAGE'] = int(
+    os.environ.get('MESSAGES_PER_PAGE', pagination.DEFAULT_PER_PAGE))
+
+# How feed pages load message authors: "selectin" or "joined".
+app.config['FEED_EAGER_LOADING'] = os.environ.get(
+    'FEED_EAGER_LOADING', cards.DEFAULT_STRATEGY)
+
+# Statements slower than this many milliseconds are logged as warnings.
+app.config['SLOW_QUERY_MS'] = float(
+    os.environ.get('SLOW_QUERY_MS', dbstats.DEFAULT_SLOW_QUERY_MS))
+
+# Cache of the logged-in user's id/username/images, so most requests don't
+# load the user row at all. Set a Redis URL to share it between workers.
+app.config['IDENTITY_CACHE_SIZE'] = int(
+    os.environ.get('IDENTITY_CACHE_SIZE', identity.DEFAULT_SIZE))
+app.config['IDENTITY_CACHE_TTL'] = int(
+    os.environ.get('IDENTITY_CACHE_TTL', identity.DEFAULT_TTL))
+app.config['IDENTITY_CACHE_REDIS_URL'] = os.environ.get('IDENTITY_CACHE_REDIS_URL')
+
+# bcrypt runs in a process pool; see passwords.py for what each limit does.
+app.config['BCRYPT_LOG_ROUNDS'] = int(
+    os.environ.get('BCRYPT_LOG_ROUNDS', passwords.DEFAULT_ROUNDS))
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', passwords.DEFAULT_WORKERS))
+app.config['PASSWORD_HASH_MAX_QUEUE'] = int(
+    os.environ.get('PASSWORD_HASH_MAX_QUEUE', passwords.DEFAULT_MAX_QUEUE))
+app.config['PASSWORD_HASH_PER_CLIENT'] = int(
+    os.environ.get('PASSWORD_HASH_PER_CLIENT', passwords.DEFAULT_PER_CLIENT))
+
+# Users per page on /users, and how many pages deep a listing may go.
+app.config['USERS_PER_PAGE'] = int(
+    os.environ.get('USERS_PER_PAGE', user_search.DEFAULT_PER_PAGE))
+app.config['USER_SEARCH_MAX_PAGE'] = int(
+    os.environ.get('USER_SEARCH_MAX_PAGE', user_search.DEFAULT_MAX_PAGE))
+
+# Rendered message cards and profile headers, shared by every viewer. Set a
+# Redis URL to share them between workers.
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', fragments.DEFAULT_SIZE))
+app.config['FRAGMENT_CACHE_TTL'] = int(
+    os.environ.get('FRAGMENT_CACHE_TTL', fragments.DEFAULT_TTL))
+app.config['FRAGMENT_CACHE_REDIS_URL'] = os.environ.get('FRAGMENT_CACHE_REDIS_URL')
+
+# Longest list of operations accepted by POST /api/batch.
+app.config['BATCH_MAX_OPERATIONS'] = int(
+    os.environ.get('BATCH_MAX_OPERATIONS', batch.DEFAULT_MAX_OPERATIONS))
+
+# External profile images are resized and cached on disk by the image proxy;
+# set IMAGE_PROXY_ENABLED=0 to link to them directly. The cache defaults to
+# instance/image-cache.
+app.config['IMAGE_PROXY_ENABLED'] = os.environ.get('IMAGE_PROXY_ENABLED', '1') != '0'
+app.config['IMAGE_CACHE_DIR'] = os.environ.get('IMAGE_CACHE_DIR')
+app.config['IMAGE_CACHE_MAX_BYTES'] = int(
+    os.environ.get('IMAGE_CACHE_MAX_BYTES', image_proxy.DEFAULT_MAX_BYTES))
+app.config['IMAGE_PROXY_MAX_SOURCE_BYTES'] = int(
+    os.environ.get('IMAGE_PROXY_MAX_SOURCE_BYTES', image_proxy.DEFAULT_MAX_SOURCE_BYTES))
+
+# Text responses are compressed (brotli/zstd/gzip) at this level once they
+# reach COMPRESSION_MIN_SIZE bytes; 0 turns compression off.
+app.config['COMPRESSION_LEVEL'] = int(
+    os.environ.get('COMPRESSION_LEVEL', compression.DEFAULT_LEVEL))
+app.config['COMPRESSION_MIN_SIZE'] = int(
+    os.environ.get('COMPRESSION_MIN_SIZE', compression.DEFAULT_MIN_SIZE))
+
+# Compiled templates are kept here (default instance/jinja-bytecode) for all
+# workers, and loaded at startup unless TEMPLATE_PRELOAD=0. Set
+# TEMPLATE_PROFILING to time every template and block; see templating.py.
+app.config['TEMPLATE_BYTECODE_DIR'] = os.environ.get('TEMPLATE_BYTECODE_DIR')
+app.config['TEMPLATE_PRELOAD'] = os.environ.get('TEMPLATE_PRELOAD', '1') != '0'
+app.config['TEMPLATE_PROFILING'] = bool(os.environ.get('TEMPLATE_PROFILING'))
+
+# Set to send the home and profile pages while their messages are still
+# being read, at the cost of their ETags; see streaming.py.
+app.config['STREAM_PAGES'] = bool(os.environ.get('STREAM_PAGES'))
+
+# Number of reverse proxies in front of the app. Their X-Forwarded-For
+# headers are trusted this many hops deep to find the client's address, which
+# per-client limits (see passwords.py) are keyed on. Leave at 0 when clients
+# connect directly: the header could then be forged.
+app.config['TRUSTED_PROXY_HOPS'] = int(os.environ.get('TRUSTED_PROXY_HOPS', 0))
+
+# Set to expose operational metrics at /admin/metrics and Prometheus metrics
+# at /metrics. Under a multi-process server, point METRICS_DIR at a directory
+# the workers share; see metrics.py.
+app.config['METRICS_ENABLED'] = bool(os.environ.get('METRICS_ENABLED'))
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
 toolbar = DebugToolbarExtension(app)
 
+if app.config['TRUSTED_PROXY_HOPS']:
+    from werkzeug.contrib.fixers import ProxyFix
+    app.wsgi_app = ProxyFix(app.wsgi_app, num_proxies=app.config['TRUSTED_PROXY_HOPS'])
+
 connect_db(app)
+metrics.init_app(app)
+replicas.init_app(app)
+identity.init_app(app)
+fragments.init_app(app)
+http_cache.init_app(app)
+assets.init_app(app)
+image_proxy.init_app(app)
+compression.init_app(app)
+passwords.init_app(app)
+templating.init_app(app)
+streaming.init_app(app)
 
 
 ##############################################################################
@@ -31,14 +186,23 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    `g.user` is a lazy proxy: see identity.py. Requests that may write
+    confirm the user still exists; a user deleted meanwhile is logged out.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = identity.current_user(session[CURR_USER_KEY], User.query.get,
+                                       verify=request.method not in ('GET', 'HEAD'))
+        if g.user is None:
+            del session[CURR_USER_KEY]
 
     else:
         g.user = None
 
+    viewer.load_viewer(g.user)
+
 
 def do_login(user):
     """Log in user."""
@@ -83,6 +247,10 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        except passwords.PasswordHasherBusy:
+            flash(BUSY_MESSAGE, 'danger')
+            return render_template('users/signup.html', form=form), 429
+
         do_login(user)
 
         return redirect("/")
@@ -98,10 +266,16 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        try:
+            user = User.authenticate(form.username.data,
+                                     form.password.data)
+        except passwords.PasswordHasherBusy:
+            flash(BUSY_MESSAGE, 'danger')
+            return render_template('users/login.html', form=form), 429
 
         if user:
+            # authenticate() may have upgraded the password hash
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -125,40 +299,57 @@ def logout():
 # General user routes:
 
 @app.route('/users')
+@replicas.read_only
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username or bio, and a
+    'page' param to page through the results.
     """
 
-    search = request.args.get('q')
+    search = request.args.get('q', '')
+    page = request.args.get('page', 1, type=int)
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    if page < 1 or page > user_search.max_page():
+        abort(404)
+
+    results = user_search.search_users(search, page)
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html', users=results.users,
+                           results=results, search=search)
 
 
 @app.route('/users/<int:user_id>')
+@http_cache.revalidate
+@replicas.read_only
 def users_show(user_id):
     """Show user profile."""
 
     user = User.query.get_or_404(user_id)
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    likes = [message.id for message in user.likes]
-    return render_template('users/show.html', user=user, messages=messages, likes=likes)
+    query = (Message
+             .query
+             .filter(Message.user_id == user_id)
+             .options(*cards.card_options(load_authors=False)))
+    before = pagination.cursor_from_request()
+
+    if streaming.enabled():
+        messages = pagination.stream(query, Message.timestamp, Message.id,
+                                     before=before)
+        return streaming.render('users/show.html', user=user, messages=messages)
+
+    messages, next_cursor = pagination.paginate(
+        query, Message.timestamp, Message.id, before=before)
+    http_cache.check(http_cache.profile_parts(user),
+                     http_cache.card_parts(messages),
+                     next_cursor)
+    return render_template('users/show.html', user=user,
+                           messages=pagination.Page(messages, next_cursor))
 
 
 @app.route('/users/<int:user_id>/following')
+@replicas.read_only
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -171,6 +362,7 @@ def show_following(user_id):
 
 
 @app.route('/users/<int:user_id>/followers')
+@replicas.read_only
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -191,7 +383,7 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    user_follows.set_follows(g.user.id, [followed_user.id], [])
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -205,20 +397,34 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    user_follows.set_follows(g.user.id, [], [follow_id])
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 @app.route('/users/<int:user_id>/likes', methods=["GET"])
+@http_cache.revalidate
+@replicas.read_only
 def show_likes(user_id):
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user, likes=user.likes)
+    likes, next_cursor = pagination.paginate(
+        (Message
+         .query
+         .join(Likes, Likes.message_id == Message.id)
+         .filter(Likes.user_id == user_id)
+         .options(*cards.card_options())),
+        Message.timestamp,
+        Message.id,
+        before=pagination.cursor_from_request())
+    http_cache.check(http_cache.profile_parts(user),
+                     http_cache.card_parts(likes),
+                     next_cursor)
+    return render_template('users/likes.html', user=user, likes=likes,
+                           next_cursor=next_cursor)
 
 @app.route('/messages/<int:message_id>/like', methods=['GET', 'POST'])
 def add_like(message_id):
@@ -228,23 +434,42 @@ def add_like(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    liked_message = Message.query.get_or_404(message_id)
-    if liked_message.user_id == g.user.id:
+    author_id = (db.session
+                 .query(Message.user_id)
+                 .filter(Message.id == message_id)
+                 .scalar())
+    if author_id is None:
+        abort(404)
+    if author_id == g.user.id:
         return abort(403)
 
-    user_likes = g.user.likes
+    flag, like_count = message_likes.toggle_like(g.user.id, message_id)
+    db.session.commit()
 
-    flag = False
-    if liked_message in user_likes:
-        g.user.likes = [like for like in user_likes if like != liked_message]
-    else:
-        flag = True
-        g.user.likes.append(liked_message)
+    # return redirect("/")
+    return jsonify({'liked': flag, 'likes': like_count})
+
+
+@app.route('/api/batch', methods=['POST'])
+def batch_mutations():
+    """Apply a batch of like/unlike/follow/unfollow operations in one transaction.
 
+    See batch.py for the request and response format.
+    """
+
+    if not g.user:
+        return jsonify({'error': "Access unauthorized."}), 401
+
+    try:
+        operations = batch.parse(request.get_json(silent=True),
+                                 app.config['BATCH_MAX_OPERATIONS'])
+    except batch.BatchError as e:
+        return jsonify({'error': str(e)}), 400
+
+    results = batch.apply(g.user.id, operations)
     db.session.commit()
 
-    # return redirect("/")
-    return jsonify({'liked': flag})
+    return jsonify({'results': results})
 
 @app.route('/users/profile', methods=["GET", "POST"])
 def edit_profile():
@@ -258,7 +483,13 @@ def edit_profile():
     form = UserEditForm(obj=user)
 
     if form.validate_on_submit():
-        if User.authenticate(user.username, form.password.data):
+        try:
+            is_auth = User.authenticate(user.username, form.password.data)
+        except passwords.PasswordHasherBusy:
+            flash(BUSY_MESSAGE, 'danger')
+            return render_template('users/edit.html', form=form, user_id=user.id), 429
+
+        if is_auth:
             user.username = form.username.data
             user.email = form.email.data
             user.image_url = form.image_url.data or "/static/images/default-pic.png"
@@ -266,6 +497,7 @@ def edit_profile():
             user.bio = form.bio.data
 
             db.session.commit()
+            identity.invalidate(user.id)
             return redirect(f"/users/{user.id}")
 
         flash("Wrong password, please try again.", 'danger')
@@ -283,8 +515,11 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    counters.user_removed(g.user.id)
+    timeline.remove_user(g.user.id)
+    db.session.delete(g.user._get_current_object())
     db.session.commit()
+    identity.invalidate(g.user.id)
 
     return redirect("/signup")
 
@@ -308,6 +543,9 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        counters.adjust(g.user.id, message_count=1)
+        timeline.fan_out_message(msg)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -316,13 +554,37 @@ def messages_add():
 
 
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@http_cache.revalidate
+@replicas.read_only
 def messages_show(message_id):
     """Show a message."""
 
     msg = Message.query.get_or_404(message_id)
+    http_cache.check(msg.id,
+                     msg.user.username,
+                     msg.user.image_url,
+                     g.viewer and g.viewer.is_following(msg.user))
     return render_template('messages/show.html', message=msg)
 
 
+@app.route('/search')
+def search_messages():
+    """Full-text search over messages, best match first.
+
+    Takes a 'q' param, and a 'before' cursor for further pages.
+    """
+
+    q = request.args.get('q', '').strip()
+
+    messages, next_cursor = [], None
+    if q:
+        messages, next_cursor = message_search.search_messages(
+            q, before=message_search.cursor_from_request())
+
+    return render_template('messages/search.html', q=q, messages=messages,
+                           next_cursor=next_cursor)
+
+
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
@@ -336,6 +598,9 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    counters.message_removed(msg)
+    timeline.remove_message(msg)
+    fragments.invalidate_message(msg)
     db.session.delete(msg)
     db.session.commit()
 
@@ -347,26 +612,29 @@ def messages_destroy(message_id):
 
 
 @app.route('/')
+@http_cache.revalidate
+@replicas.read_only
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
     """
 
     if g.user:
-        following_ids = [f.id for f in g.user.following] + [g.user.id]
+        before = pagination.cursor_from_request()
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        if streaming.enabled():
+            messages = timeline.stream_home_timeline(g.user.id, before=before)
+            return streaming.render('home.html', messages=messages)
 
-        liked_msg_ids = [msg.id for msg in g.user.likes]
+        messages, next_cursor = timeline.home_timeline(g.user.id, before=before)
 
-        return render_template('home.html', messages=messages, likes=liked_msg_ids)
+        http_cache.check(http_cache.profile_parts(g.user),
+                         http_cache.card_parts(messages),
+                         next_cursor)
+        return render_template('home.html',
+                               messages=pagination.Page(messages, next_cursor))
 
     else:
         return render_template('home-anon.html')
@@ -380,18 +648,76 @@ def homepage():
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Operational metrics
+
+
+@app.route('/admin/metrics')
+def admin_metrics():
+    """JSON snapshot of internal metrics; 404 unless METRICS_ENABLED is set."""
+
+    if not app.config['METRICS_ENABLED']:
+        abort(404)
+
+    return jsonify({
+        'passwords': passwords.get_hasher().stats(),
+        'fragments': fragments.get_cache().stats(),
+        'image_proxy': image_proxy.get_proxy().stats(),
+        'compression': compression.get_stats(),
+        'replicas': replicas.get_stats(),
+        'pools': dbpool.pool_stats(),
+    })
+
+
+##############################################################################
+# Maintenance commands (run with `flask <command>`)
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters():
+    """Recompute every user's message/follow/like counters."""
+
+    counters.reconcile()
+    db.session.commit()
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    """Rebuild every home timeline from the messages and follows tables."""
+
+    timeline.rebuild()
+    db.session.commit()
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index():
+    """Reload the in-process message search index, or on Postgres add the
+    search column and index if the database predates them."""
+
+    message_search.add_search_column()
+    message_search.rebuild()
+
+
+@app.cli.command('build-assets')
+def build_assets():
+    """Fingerprint, precompress and resize static files into static/dist."""
+
+    manifest = assets.build(app)
+    print(f"Built {len(manifest)} assets.")
+
+
+@app.cli.command('compile-templates')
+def compile_templates():
+    """Compile every template into the shared bytecode cache."""
+
+    names = templating.compile_all(app)
+    print(f"Compiled {len(names)} templates.")
+
+
+##############################################################################
+# Caching headers are set per route; see http_cache.py.
 
 @app.after_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add SQL timing headers on every request."""
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+    return dbstats.report(req)
@@ -0,0 +1,217 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask build-assets` copies every file under `static/` into `static/dist/`
+under a content-hashed name (`style.css` -> `style.3f2a9c1b0d4e.css`) and
+records the mapping in `static/dist/manifest.json`. It also writes
+
+- `.gz` and `.br` copies of text assets (CSS, JS, SVG, icons), so nothing is
+  compressed per request, and
+- resized copies of the images in `IMAGE_VARIANTS`, each with a WebP twin.
+
+Templates link assets with `asset_url('stylesheets/style.css')`, or
+`asset_url('images/warbler-hero.jpg', width=1200)` for a resized copy; the
+`asset` filter does the same for stored URLs such as `User.image_url`,
+sending external images through the image proxy instead.
+Built assets are served from `/assets/` with a one-year immutable policy,
+picking the `.br`/`.gz` file by `Accept-Encoding` and the WebP twin by
+`Accept`. The file goes out through `send_file`, which hands it to the
+server's `wsgi.file_wrapper` (`sendfile()` under gunicorn/uWSGI) rather
+than copying it through Python. Before a build, or for files the manifest
+doesn't know, links fall back to the plain `static` route.
+
+Brotli (`brotli`) and resizing (`Pillow`) are optional; the build skips what
+they provide when they aren't installed.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+from flask import abort, current_app, request, safe_join, send_file, url_for
+
+import http_cache
+import image_proxy
+
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt', '.map'}
+
+# Source image -> widths to produce.
+IMAGE_VARIANTS = {
+    'images/warbler-hero.jpg': [600, 1200],
+    'images/default-pic.png': [100, 200, 400],
+    'images/signed-out-home.jpg': [800, 1600],
+}
+
+# Never published: screenshots for the README.
+SKIP = ('images/Screenshot',)
+
+
+def _hashed_name(relpath, digest, suffix=''):
+    root, ext = os.path.splitext(relpath)
+    return f"{root}.{digest}{suffix}{ext}"
+
+
+def _compress(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    with gzip.open(path + '.gz', 'wb', compresslevel=9) as f:
+        f.write(data)
+
+    try:
+        import brotli
+    except ImportError:
+        return
+    with open(path + '.br', 'wb') as f:
+        f.write(brotli.compress(data, quality=11))
+
+
+def _resize(source, dest, width):
+    """Write a `width`-wide copy of `source` to `dest`, plus a WebP twin."""
+
+    from PIL import Image
+
+    with Image.open(source) as image:
+        if image.width > width:
+            height = round(image.height * width / image.width)
+            image = image.resize((width, height), Image.LANCZOS)
+        image.save(dest, optimize=True)
+        image.save(os.path.splitext(dest)[0] + '.webp', 'WEBP', quality=80)
+
+
+def build(app):
+    """Rebuild `static/dist` and its manifest; return the manifest."""
+
+    static, dist = app.static_folder, os.path.join(app.static_folder, DIST)
+    shutil.rmtree(dist, ignore_errors=True)
+
+    try:
+        import PIL
+    except ImportError:
+        PIL = None
+
+    manifest = {}
+    for root, dirs, files in os.walk(static):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != dist]
+
+        for name in files:
+            source = os.path.join(root, name)
+            relpath = os.path.relpath(source, static).replace(os.sep, '/')
+            if relpath.startswith(SKIP):
+                continue
+
+            with open(source, 'rb') as f:
+                digest = hashlib.md5(f.read()).hexdigest()[:12]
+
+            hashed = _hashed_name(relpath, digest)
+            dest = os.path.join(dist, hashed)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.copyfile(source, dest)
+            manifest[relpath] = hashed
+
+            if os.path.splitext(name)[1].lower() in COMPRESSIBLE:
+                _compress(dest)
+
+            if PIL is not None:
+                for width in IMAGE_VARIANTS.get(relpath, []):
+                    variant = _hashed_name(relpath, digest, f".w{width}")
+                    _resize(source, os.path.join(dist, variant), width)
+                    manifest[f"{relpath}@{width}"] = variant
+
+    with open(os.path.join(dist, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    app.extensions['asset_manifest'] = manifest
+    return manifest
+
+
+def load_manifest(app):
+    path = os.path.join(app.static_folder, DIST, MANIFEST)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def asset_url(filename, width=None):
+    """URL of a static file, fingerprinted and (with `width`) resized if built."""
+
+    manifest = current_app.extensions.get('asset_manifest', {})
+
+    if width is not None:
+        # The narrowest variant at least `width` wide, else the original.
+        widths = sorted(w for w in IMAGE_VARIANTS.get(filename, []) if w >= width)
+        for w in widths:
+            if f"{filename}@{w}" in manifest:
+                return url_for('assets', filename=manifest[f"{filename}@{w}"])
+
+    if filename in manifest:
+        return url_for('assets', filename=manifest[filename])
+
+    return url_for('static', filename=filename)
+
+
+def asset_filter(url, width=None):
+    """`asset_url` for a stored URL.
+
+    Anything outside /static/ drawn at a known `width` goes through the
+    image proxy (see image_proxy.py); other URLs are left alone.
+    """
+
+    prefix = '/static/'
+    if url and url.startswith(prefix):
+        return asset_url(url[len(prefix):], width)
+    if width is not None:
+        return image_proxy.proxied_url(url, width)
+    return url
+
+
+def serve(filename):
+    """Send a built asset, precompressed and/or as WebP if the client accepts it."""
+
+    dist = os.path.join(current_app.static_folder, DIST)
+    path = safe_join(dist, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = None
+
+    webp = os.path.splitext(path)[0] + '.webp'
+    if (mimetype.startswith('image/') and mimetype != 'image/webp'
+            and os.path.isfile(webp)):
+        if request.accept_mimetypes['image/webp']:
+            path, mimetype = webp, 'image/webp'
+        vary = 'Accept'
+    elif os.path.isfile(path + '.gz'):
+        for candidate in ('br', 'gzip'):
+            compressed = path + ('.br' if candidate == 'br' else '.gz')
+            if request.accept_encodings[candidate] and os.path.isfile(compressed):
+                path, encoding = compressed, candidate
+                break
+        vary = 'Accept-Encoding'
+    else:
+        vary = None
+
+    response = send_file(path, mimetype=mimetype, conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if vary:
+        response.vary.add(vary)
+    return response
+
+
+def init_app(app):
+    """Load the asset manifest and register `/assets/` and the template helpers."""
+
+    app.extensions['asset_manifest'] = load_manifest(app)
+    app.add_url_rule('/assets/<path:filename>', 'assets',
+                     http_cache.cache_control(http_cache.STATIC_IMMUTABLE)(serve))
+    app.jinja_env.globals['asset_url'] = asset_url
+    app.jinja_env.filters['asset'] = asset_filter
@@ -0,0 +1,130 @@
+"""Batched like/follow changes for `POST /api/batch`.
+
+The front end queues clicks for a moment and sends them together as
+
+    {"operations": [{"op": "like", "message_id": 12},
+                    {"op": "unfollow", "user_id": 3}, ...]}
+
+`apply()` runs the whole batch in the caller's transaction with a fixed
+number of set-based statements (see message_likes.py and user_follows.py)
+rather than one round trip and commit per click. Operations on the same
+target collapse to the last one, so like-unlike-like is a single like.
+Every operation gets a result, in request order.
+"""
+
+from models import db, Message, User
+import message_likes
+import user_follows
+
+DEFAULT_MAX_OPERATIONS = 100
+
+# op -> (target key, desired state)
+OPS = {
+    'like': ('message_id', True),
+    'unlike': ('message_id', False),
+    'follow': ('user_id', True),
+    'unfollow': ('user_id', False),
+}
+
+
+class BatchError(ValueError):
+    """The request body is not a valid batch."""
+
+
+def parse(payload, max_operations=DEFAULT_MAX_OPERATIONS):
+    """Return the batch's operations as `[(op, target_id)]`.
+
+    Raises BatchError if `payload` is malformed or too long.
+    """
+
+    if not isinstance(payload, dict) or not isinstance(payload.get('operations'), list):
+        raise BatchError("Expected a JSON object with an 'operations' list.")
+
+    raw = payload['operations']
+    if len(raw) > max_operations:
+        raise BatchError(f"At most {max_operations} operations per batch.")
+
+    operations = []
+    for item in raw:
+        op = item.get('op') if isinstance(item, dict) else None
+        if op not in OPS:
+            raise BatchError(f"Unknown operation: {op!r}.")
+
+        target_id = item.get(OPS[op][0])
+        if not isinstance(target_id, int) or isinstance(target_id, bool):
+            raise BatchError(f"'{op}' needs an integer {OPS[op][0]}.")
+
+        operations.append((op, target_id))
+
+    return operations
+
+
+def _desired(operations, key):
+    """Final desired state per target id, last operation winning."""
+
+    return {target_id: OPS[op][1]
+            for op, target_id in operations
+            if OPS[op][0] == key}
+
+
+def apply(user_id, operations):
+    """Apply `operations` for `user_id` and return one result dict per operation."""
+
+    likes = _desired(operations, 'message_id')
+    follows = _desired(operations, 'user_id')
+
+    errors = {}
+
+    authors = dict(db.session
+                   .query(Message.id, Message.user_id)
+                   .filter(Message.id.in_(likes))) if likes else {}
+    for message_id in likes:
+        if message_id not in authors:
+            errors['message_id', message_id] = 'not_found'
+        elif authors[message_id] == user_id:
+            errors['message_id', message_id] = 'own_message'
+
+    found = {id for (id,) in (db.session
+                              .query(User.id)
+                              .filter(User.id.in_(follows)))} if follows else set()
+    for followed_id in follows:
+        if followed_id not in found:
+            errors['user_id', followed_id] = 'not_found'
+        elif followed_id == user_id:
+            errors['user_id', followed_id] = 'self_follow'
+
+    likes = {id: state for id, state in likes.items()
+             if ('message_id', id) not in errors}
+    follows = {id: state for id, state in follows.items()
+               if ('user_id', id) not in errors}
+
+    message_likes.set_likes(user_id,
+                            [id for id, state in likes.items() if state],
+                            [id for id, state in likes.items() if not state])
+    user_follows.set_follows(user_id,
+                             [id for id, state in follows.items() if state],
+                             [id for id, state in follows.items() if not state])
+
+    like_counts = message_likes.like_counts(likes) if likes else {}
+    # deleted since it was checked above
+    for message_id in likes:
+        if message_id not in like_counts:
+            errors['message_id', message_id] = 'not_found'
+
+    results = []
+    for op, target_id in operations:
+        key = OPS[op][0]
+        result = {'op': op, key: target_id}
+
+        if (key, target_id) in errors:
+            result.update(ok=False, error=errors[key, target_id])
+        elif key == 'message_id':
+            result.update(ok=True,
+                          liked=likes[target_id],
+                          likes=like_counts[target_id])
+        else:
+            result.update(ok=True, following=follows[target_id])
+
+        results.append(result)
+
+    return results
@@ -0,0 +1,315 @@
+"""Latency and throughput benchmarks for Warbler's main routes.
+
+    python bench.py --seed-db --users 10000 --messages 100000 --follows 200000
+    python bench.py --requests 200 --save baseline.json
+    python bench.py --requests 200 --compare baseline.json
+    python bench.py --url http://127.0.0.1:5000 --concurrency 16 --requests 2000
+
+The database is `BENCH_DATABASE_URL` (default `postgresql:///warbler-bench`);
+`--seed-db` first fills it with a generated dataset of the given size (see
+generator/create_csvs.py and seed.py).
+
+Each scenario requests one route as a random logged-in user. By default
+requests go through the Flask test client in this process, one at a time;
+with `--url` they go over HTTP to a running server, `--concurrency` at a
+time. Either way the report gives p50/p95/p99 latency, requests per second
+and SQL statements per request (read from the `Server-Timing` header, see
+dbstats.py).
+
+`--save` writes the results as JSON; `--compare` checks a run against saved
+results and exits non-zero if any scenario's p95 latency grew by more than
+`--tolerance` or it runs more queries per request than before.
+"""
+
+import argparse
+import http.cookiejar
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from random import Random
+from time import perf_counter
+
+os.environ['DATABASE_URL'] = os.environ.get('BENCH_DATABASE_URL',
+                                            'postgresql:///warbler-bench')
+
+from app import app, CURR_USER_KEY
+from models import db, Message, User
+import seed
+
+DEFAULT_REQUESTS = 100
+DEFAULT_WARMUP = 5
+DEFAULT_TOLERANCE = 0.2
+
+QUERIES_RE = re.compile(r'db;[^,]*desc="(\d+) queries"')
+CSRF_RE = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class Sample:
+    """The ids scenarios pick their viewers and targets from."""
+
+    def __init__(self, rng, size=50):
+        user_ids = [id for (id,) in db.session.query(User.id)]
+        self.viewers = rng.sample(user_ids, min(size, len(user_ids)))
+
+        # Recent messages, with their authors so nobody likes their own.
+        self.messages = [(id, author) for id, author in (db.session
+                         .query(Message.id, Message.user_id)
+                         .order_by(Message.id.desc())
+                         .limit(size * 10))]
+
+    def like_target(self, rng, viewer):
+        candidates = [id for id, author in self.messages if author != viewer]
+        return rng.choice(candidates)
+
+
+# name -> (method, path for (sample, rng, viewer), form data)
+SCENARIOS = {
+    'homepage': ('GET', lambda s, rng, viewer: "/", None),
+    'users_show': ('GET', lambda s, rng, viewer: f"/users/{rng.choice(s.viewers)}", None),
+    'list_users': ('GET', lambda s, rng, viewer: "/users", None),
+    'show_following': ('GET', lambda s, rng, viewer: f"/users/{rng.choice(s.viewers)}/following", None),
+    'show_likes': ('GET', lambda s, rng, viewer: f"/users/{rng.choice(s.viewers)}/likes", None),
+    'add_like': ('POST', lambda s, rng, viewer: f"/messages/{s.like_target(rng, viewer)}/like", None),
+    'messages_add': ('POST', lambda s, rng, viewer: "/messages/new", {'text': "benchmark warble"}),
+}
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not sorted_values:
+        return None
+    rank = max(1, round(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(timings, queries, errors, elapsed):
+    timings = sorted(timings)
+    return {
+        'requests': len(timings),
+        'errors': errors,
+        'p50_ms': percentile(timings, 50),
+        'p95_ms': percentile(timings, 95),
+        'p99_ms': percentile(timings, 99),
+        'requests_per_sec': len(timings) / elapsed if elapsed else None,
+        'queries_per_request': sum(queries) / len(queries) if queries else None,
+    }
+
+
+def queries_from(headers):
+    match = QUERIES_RE.search(headers.get('Server-Timing') or '')
+    return int(match.group(1)) if match else None
+
+
+def run_test_client(name, sample, requests, rng):
+    """Run one scenario sequentially through the Flask test client."""
+
+    method, path_for, data = SCENARIOS[name]
+    client = app.test_client()
+    timings, queries, errors = [], [], 0
+
+    start = perf_counter()
+    for _ in range(requests):
+        viewer = rng.choice(sample.viewers)
+        with client.session_transaction() as session:
+            session[CURR_USER_KEY] = viewer
+
+        path = path_for(sample, rng, viewer)
+        began = perf_counter()
+        resp = client.open(path, method=method, data=data)
+        timings.append((perf_counter() - began) * 1000)
+
+        if resp.status_code >= 400:
+            errors += 1
+        count = queries_from(resp.headers)
+        if count is not None:
+            queries.append(count)
+
+    return summarize(timings, queries, errors, perf_counter() - start)
+
+
+class HttpUser:
+    """One logged-in virtual user talking to a running server."""
+
+    def __init__(self, base_url, user_id):
+        self.base_url = base_url.rstrip('/')
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(self.cookies),
+            NoRedirect())
+
+        # Sign our own session cookie rather than logging in through bcrypt.
+        serializer = app.session_interface.get_signing_serializer(app)
+        host = urllib.parse.urlsplit(self.base_url).hostname
+        self.cookies.set_cookie(http.cookiejar.Cookie(
+            0, app.session_cookie_name, serializer.dumps({CURR_USER_KEY: user_id}),
+            None, False, host, False, False, '/', True, False, None, False,
+            None, None, {}))
+        self.csrf_token = None
+
+    def request(self, method, path, data=None):
+        if data is not None:
+            if self.csrf_token is None:
+                _, _, body = self.request('GET', path)
+                match = CSRF_RE.search(body)
+                self.csrf_token = match.group(1) if match else ''
+            data = urllib.parse.urlencode(dict(data, csrf_token=self.csrf_token)).encode()
+
+        req = urllib.request.Request(self.base_url + path, data=data, method=method)
+        try:
+            with self.opener.open(req) as resp:
+                return resp.status, resp.headers, resp.read().decode('utf-8', 'replace')
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, ''
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def run_http(name, sample, requests, rng, base_url, concurrency):
+    """Run one scenario over HTTP with `concurrency` virtual users."""
+
+    method, path_for, data = SCENARIOS[name]
+    users = [(HttpUser(base_url, viewer), viewer)
+             for viewer in (rng.choice(sample.viewers) for _ in range(concurrency))]
+    plans = [(user, path_for(sample, rng, viewer))
+             for user, viewer in (users[i % concurrency] for i in range(requests))]
+
+    def one(plan):
+        user, path = plan
+        began = perf_counter()
+        status, headers, _ = user.request(method, path, data)
+        return (perf_counter() - began) * 1000, status, queries_from(headers)
+
+    start = perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(one, plans))
+    elapsed = perf_counter() - start
+
+    return summarize([ms for ms, _, _ in results],
+                     [count for _, _, count in results if count is not None],
+                     sum(1 for _, status, _ in results if status >= 400),
+                     elapsed)
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of regressions of `results` against `baseline`."""
+
+    regressions = []
+    for name, before in baseline['scenarios'].items():
+        after = results['scenarios'].get(name)
+        if after is None or before['p95_ms'] is None:
+            continue
+
+        if after['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_ms']:.1f}ms -> {after['p95_ms']:.1f}ms")
+
+        if (before['queries_per_request'] is not None
+                and after['queries_per_request'] is not None
+                and after['queries_per_request'] > before['queries_per_request'] + 0.5):
+            regressions.append(f"{name}: queries/request "
+                               f"{before['queries_per_request']:.1f} -> "
+                               f"{after['queries_per_request']:.1f}")
+
+        if after['errors'] > before['errors']:
+            regressions.append(f"{name}: {after['errors']} errors (was {before['errors']})")
+
+    return regressions
+
+
+def seed_database(args):
+    with tempfile.TemporaryDirectory() as data_dir:
+        subprocess.run([sys.executable, os.path.join('generator', 'create_csvs.py'),
+                        '--offline',
+                        '--seed', str(args.seed),
+                        '--users', str(args.users),
+                        '--messages', str(args.messages),
+                        '--follows', str(args.follows),
+                        '--likes', str(args.likes),
+                        '--out', data_dir],
+                       check=True)
+        seed.seed(data_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Warbler's routes.")
+    parser.add_argument('--seed-db', action='store_true',
+                        help="generate and load a dataset first")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--follows', type=int, default=20000)
+    parser.add_argument('--likes', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help="run only these scenarios (repeatable)")
+    parser.add_argument('--requests', type=int, default=DEFAULT_REQUESTS,
+                        help="requests per scenario")
+    parser.add_argument('--warmup', type=int, default=DEFAULT_WARMUP,
+                        help="unmeasured requests per scenario before timing starts")
+    parser.add_argument('--url', help="benchmark a running server instead of the test client")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--save', help="write results to this JSON file")
+    parser.add_argument('--compare', help="fail on regressions against this JSON file")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed fractional p95 slowdown when comparing")
+    args = parser.parse_args()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['DEBUG_TB_ENABLED'] = False
+
+    with app.app_context():
+        if args.seed_db:
+            seed_database(args)
+
+        rng = Random(args.seed)
+        sample = Sample(rng)
+        db.session.remove()
+
+    results = {
+        'driver': args.url or 'test_client',
+        'concurrency': args.concurrency if args.url else 1,
+        'scenarios': {},
+    }
+
+    print(f"{'scenario':<16}{'p50':>9}{'p95':>9}{'p99':>9}{'req/s':>9}{'queries':>9}{'errors':>8}")
+    for name in args.scenario or SCENARIOS:
+        if args.url:
+            run = lambda n: run_http(name, sample, n, rng, args.url, args.concurrency)
+        else:
+            run = lambda n: run_test_client(name, sample, n, rng)
+
+        if args.warmup:
+            run(args.warmup)
+        result = run(args.requests)
+        results['scenarios'][name] = result
+
+        print(f"{name:<16}"
+              f"{result['p50_ms']:>7.1f}ms{result['p95_ms']:>7.1f}ms{result['p99_ms']:>7.1f}ms"
+              f"{result['requests_per_sec']:>9.1f}"
+              f"{result['queries_per_request'] or 0:>9.1f}"
+              f"{result['errors']:>8}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
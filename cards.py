@@ -0,0 +1,44 @@
+"""Loading options for message cards.
+
+Feed pages render each message as a card showing its text, timestamp and
+author. Loading the author lazily costs one SELECT per card, so feed queries
+apply `card_options()`: the author is loaded eagerly for the whole page and
+only the columns a card displays are fetched.
+
+The eager-loading strategy is the `FEED_EAGER_LOADING` config value:
+"selectin" (one extra `IN` query per page) or "joined" (a LEFT JOIN in the
+feed query itself).
+"""
+
+from flask import current_app
+from sqlalchemy.orm import joinedload, load_only, selectinload
+
+from models import Message
+
+DEFAULT_STRATEGY = 'selectin'
+
+STRATEGIES = {
+    'joined': joinedload,
+    'selectin': selectinload,
+}
+
+MESSAGE_CARD_COLUMNS = ('id', 'text', 'timestamp', 'user_id', 'like_count')
+AUTHOR_CARD_COLUMNS = ('id', 'username', 'image_url')
+
+
+def card_options(load_authors=True, strategy=None):
+    """Query options that load a page of message cards in constant queries.
+
+    Pass `load_authors=False` when every message on the page has the same,
+    already-loaded author (e.g. a profile page).
+    """
+
+    options = [load_only(*MESSAGE_CARD_COLUMNS)]
+
+    if load_authors:
+        strategy = strategy or current_app.config.get('FEED_EAGER_LOADING',
+                                                      DEFAULT_STRATEGY)
+        loader = STRATEGIES[strategy]
+        options.append(loader(Message.user).load_only(*AUTHOR_CARD_COLUMNS))
+
+    return options
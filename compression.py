@@ -0,0 +1,279 @@
+"""Response compression.
+
+`CompressionMiddleware` wraps `app.wsgi_app` and compresses text responses
+(HTML, CSS, JS, JSON, SVG...) with the best encoding the client accepts:
+brotli, then zstd, then gzip. Brotli and zstd are used only if the optional
+`brotli` / `zstandard` packages are installed. Everything else passes
+through untouched, including images and anything that already has a
+`Content-Encoding` (such as the precompressed files from assets.py), so
+`send_file` responses keep the server's `wsgi.file_wrapper`.
+
+Responses smaller than `COMPRESSION_MIN_SIZE` bytes aren't worth it and go
+out as they are. When there's no `Content-Length` (a streamed response) the
+middleware holds back only the first `COMPRESSION_MIN_SIZE` bytes to decide,
+then compresses each chunk as the app yields it and flushes the compressor,
+so a streamed page still reaches the browser a piece at a time.
+
+`COMPRESSION_LEVEL` is passed to every encoder (gzip 1-9, brotli 0-11,
+zstd 1-22); the default suits dynamic pages. Set it to 0 to leave
+compression to a proxy in front of the app.
+
+Raw and sent bytes are counted per endpoint for `/admin/metrics`.
+"""
+
+import threading
+import zlib
+from collections import Counter, defaultdict
+
+from flask import current_app, request
+from werkzeug.http import parse_accept_header
+from werkzeug.wsgi import ClosingIterator
+
+DEFAULT_LEVEL = 5
+DEFAULT_MIN_SIZE = 500
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript',
+                      'application/xml', 'application/xhtml+xml', 'image/svg+xml')
+
+# Preferred first, among encodings the client rates equally.
+PREFERENCE = ('br', 'zstd', 'gzip')
+
+ENDPOINT_KEY = 'warbler.endpoint'
+
+
+def available_encodings():
+    """The encodings in `PREFERENCE` whose libraries are installed."""
+
+    modules = {'br': 'brotli', 'zstd': 'zstandard'}
+    encodings = []
+    for encoding in PREFERENCE:
+        if encoding in modules:
+            try:
+                __import__(modules[encoding])
+            except ImportError:
+                continue
+        encodings.append(encoding)
+    return encodings
+
+
+def negotiate(accept_encoding, encodings):
+    """The encoding from `encodings` that `accept_encoding` rates highest, or None."""
+
+    accept = parse_accept_header(accept_encoding)
+    best, best_quality = None, 0
+    for encoding in encodings:
+        quality = accept[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def encoder(encoding, level):
+    """(compress, flush, finish) functions for a new stream in `encoding`."""
+
+    if encoding == 'br':
+        import brotli
+        compressor = brotli.Compressor(quality=level)
+        return compressor.process, compressor.flush, compressor.finish
+
+    if encoding == 'zstd':
+        import zstandard
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        return (compressor.compress,
+                lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+                compressor.flush)
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return (compressor.compress,
+            lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+            compressor.flush)
+
+
+class CompressionStats:
+    """Response and byte counts per endpoint."""
+
+    def __init__(self):
+        self._routes = defaultdict(Counter)
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, raw, sent, compressed):
+        with self._lock:
+            route = self._routes[endpoint or 'unmatched']
+            route['responses'] += 1
+            route['compressed'] += compressed
+            route['raw_bytes'] += raw
+            route['sent_bytes'] += sent
+
+    def stats(self):
+        with self._lock:
+            return {endpoint: dict(counts) for endpoint, counts in self._routes.items()}
+
+
+def _no_write(data):
+    raise RuntimeError("write() isn't supported under CompressionMiddleware")
+
+
+class CompressionMiddleware:
+    """WSGI middleware compressing text responses; see the module docstring."""
+
+    def __init__(self, wsgi_app, level=DEFAULT_LEVEL, min_size=DEFAULT_MIN_SIZE):
+        self.wsgi_app = wsgi_app
+        self.level = level
+        self.min_size = min_size
+        self.encodings = available_encodings()
+        self.counters = CompressionStats()
+
+    def stats(self):
+        return self.counters.stats()
+
+    def __call__(self, environ, start_response):
+        started = {}
+
+        def capture(status, headers, exc_info=None):
+            started.update(status=status, headers=headers, exc_info=exc_info)
+            return _no_write
+
+        iterable = self.wsgi_app(environ, capture)
+        chunks = iter(iterable)
+        held, done = [], False
+
+        # An app may call start_response lazily, with its first chunk.
+        while 'status' not in started and not done:
+            try:
+                held.append(next(chunks))
+            except StopIteration:
+                done = True
+
+        status, headers = started['status'], list(started['headers'])
+        encoding = None
+        if self._compressible(environ, status, headers):
+            headers = _add_vary(headers)
+            encoding = negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''), self.encodings)
+
+        if encoding is not None:
+            length = _header(headers, 'Content-Length')
+            if length is None:
+                # Streamed: hold back enough to know whether it's worth it.
+                while not done and sum(map(len, held)) < self.min_size:
+                    try:
+                        held.append(next(chunks))
+                    except StopIteration:
+                        done = True
+                size = sum(map(len, held)) if done else self.min_size
+            else:
+                size = int(length)
+            if size < self.min_size:
+                encoding = None
+
+        if encoding is None:
+            start_response(status, headers, started['exc_info'])
+            length = _header(headers, 'Content-Length')
+            if not held and length is not None:
+                # Pass the app's iterable through as it is (file_wrapper included).
+                self.counters.record(environ.get(ENDPOINT_KEY), int(length), int(length), False)
+                return iterable
+            body = self._plain(environ, held, chunks)
+        else:
+            headers = [(name, value) for name, value in headers
+                       if name.lower() != 'content-length']
+            headers.append(('Content-Encoding', encoding))
+            headers = _weaken_etag(headers)
+            start_response(status, headers, started['exc_info'])
+            body = self._compressed(environ, encoding, held, chunks)
+
+        return ClosingIterator(body, getattr(iterable, 'close', None))
+
+    def _plain(self, environ, held, chunks):
+        raw = 0
+        try:
+            for chunk in _chain(held, chunks):
+                raw += len(chunk)
+                yield chunk
+        finally:
+            self.counters.record(environ.get(ENDPOINT_KEY), raw, raw, False)
+
+    def _compressed(self, environ, encoding, held, chunks):
+        compress, flush, finish = encoder(encoding, self.level)
+        raw = sent = 0
+        try:
+            for chunk in _chain(held, chunks):
+                raw += len(chunk)
+                data = compress(chunk) + flush()
+                if data:
+                    sent += len(data)
+                    yield data
+            data = finish()
+            sent += len(data)
+            yield data
+        finally:
+            self.counters.record(environ.get(ENDPOINT_KEY), raw, sent, True)
+
+    def _compressible(self, environ, status, headers):
+        code = int(status.split(None, 1)[0])
+        if environ.get('REQUEST_METHOD') == 'HEAD' or code < 200 or code in (204, 206, 304):
+            return False
+        if _header(headers, 'Content-Encoding') is not None:
+            return False
+        if 'no-transform' in (_header(headers, 'Cache-Control') or ''):
+            return False
+
+        mimetype = (_header(headers, 'Content-Type') or '').split(';')[0].strip().lower()
+        return mimetype.startswith(COMPRESSIBLE_TYPES)
+
+
+def _chain(held, chunks):
+    yield from held
+    yield from chunks
+
+
+def _header(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def _add_vary(headers):
+    vary = _header(headers, 'Vary')
+    if vary is None:
+        return headers + [('Vary', 'Accept-Encoding')]
+    if 'accept-encoding' in vary.lower():
+        return headers
+    return [(name, f"{value}, Accept-Encoding" if name.lower() == 'vary' else value)
+            for name, value in headers]
+
+
+def _weaken_etag(headers):
+    """Compressed bytes differ from the original, so a strong ETag must become weak."""
+
+    return [(name, f"W/{value}" if name.lower() == 'etag' and not value.startswith('W/')
+             else value)
+            for name, value in headers]
+
+
+def get_stats():
+    """Byte counts per endpoint, or {} if compression is off."""
+
+    middleware = current_app.extensions.get('compression')
+    return middleware.stats() if middleware else {}
+
+
+def _note_endpoint():
+    request.environ[ENDPOINT_KEY] = request.endpoint
+
+
+def init_app(app):
+    """Wrap `app.wsgi_app` in compression, unless `COMPRESSION_LEVEL` is 0."""
+
+    level = app.config.get('COMPRESSION_LEVEL', DEFAULT_LEVEL)
+    if not level:
+        return
+
+    middleware = CompressionMiddleware(
+        app.wsgi_app,
+        level=level,
+        min_size=app.config.get('COMPRESSION_MIN_SIZE', DEFAULT_MIN_SIZE))
+    app.wsgi_app = middleware
+    app.extensions['compression'] = middleware
+    app.before_request(_note_endpoint)
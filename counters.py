@@ -0,0 +1,105 @@
+"""Denormalized user statistics.
+
+`User.message_count`, `following_count`, `follower_count` and `like_count`
+(and `Message.like_count`) are kept up to date by the write paths in app.py,
+message_likes.py and user_follows.py, so profile headers can show them
+without loading whole relationship collections. Every adjustment is a single
+`UPDATE ... SET col = col + n`, run inside the caller's transaction.
+
+`reconcile()` recomputes all of them from scratch with set-based SQL; run it
+after bulk loads (see seed.py) or with `flask reconcile-counters`.
+"""
+
+from sqlalchemy import func, select
+
+from models import db, Follows, Likes, Message, User
+
+users = User.__table__
+messages = Message.__table__
+
+
+def adjust(user_id, **deltas):
+    """Add `deltas` (column name -> amount) to one user's counters."""
+
+    db.session.execute(users.update()
+                       .where(users.c.id == user_id)
+                       .values({users.c[col]: users.c[col] + delta
+                                for col, delta in deltas.items()}))
+
+
+def adjust_many(user_ids, **deltas):
+    """Add `deltas` to the counters of every user in `user_ids`.
+
+    `user_ids` may be a list or a subquery selecting user ids.
+    """
+
+    db.session.execute(users.update()
+                       .where(users.c.id.in_(user_ids))
+                       .values({users.c[col]: users.c[col] + delta
+                                for col, delta in deltas.items()}))
+
+
+def message_removed(msg):
+    """Uncount a message and every like it had.
+
+    Must run before the message (and its likes) are deleted.
+    """
+
+    adjust(msg.user_id, message_count=-1)
+    adjust_many(select([Likes.user_id]).where(Likes.message_id == msg.id),
+                like_count=-1)
+
+
+def user_removed(user_id):
+    """Uncount everything a user's deletion takes with it.
+
+    Must run before the user (and, by cascade, their follows, likes and
+    messages) are deleted.
+    """
+
+    adjust_many(select([Follows.user_being_followed_id])
+                .where(Follows.user_following_id == user_id),
+                follower_count=-1)
+    adjust_many(select([Follows.user_following_id])
+                .where(Follows.user_being_followed_id == user_id),
+                following_count=-1)
+
+    # Messages this user liked.
+    db.session.execute(messages.update()
+                       .where(messages.c.id.in_(
+                           select([Likes.message_id])
+                           .where(Likes.user_id == user_id)))
+                       .values(like_count=messages.c.like_count - 1))
+
+    # Likes other users gave to this user's messages.
+    lost_likes = (select([func.count()])
+                  .select_from(Likes.__table__.join(Message.__table__))
+                  .where(Likes.user_id == users.c.id)
+                  .where(Message.user_id == user_id)
+                  .as_scalar())
+    db.session.execute(users.update()
+                       .where(users.c.id.in_(
+                           select([Likes.user_id])
+                           .select_from(Likes.__table__.join(Message.__table__))
+                           .where(Message.user_id == user_id)))
+                       .values(like_count=users.c.like_count - lost_likes))
+
+
+def reconcile():
+    """Recompute every user's and message's counters from the underlying tables."""
+
+    def count(table, where):
+        return select([func.count()]).select_from(table).where(where).as_scalar()
+
+    db.session.execute(users.update().values(
+        message_count=count(Message.__table__, Message.user_id == users.c.id),
+        following_count=count(Follows.__table__,
+                              Follows.user_following_id == users.c.id),
+        follower_count=count(Follows.__table__,
+                             Follows.user_being_followed_id == users.c.id),
+        like_count=count(Likes.__table__, Likes.user_id == users.c.id),
+    ))
+
+    db.session.execute(messages.update().values(
+        like_count=count(Likes.__table__, Likes.message_id == messages.c.id),
+    ))
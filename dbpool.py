@@ -0,0 +1,165 @@
+"""Database connection pool settings and telemetry.
+
+Every engine (the primary, and each replica from replicas.py) gets its pool
+from `engine_options()`, configured by:
+
+- `DB_POOL_SIZE`, `DB_POOL_MAX_OVERFLOW`: connections kept open, and how many
+  more may be opened under load;
+- `DB_POOL_TIMEOUT`: seconds a request waits for a connection before
+  failing, rather than piling up behind a saturated pool;
+- `DB_POOL_RECYCLE`: seconds after which a connection is replaced, to stay
+  under server and firewall idle limits;
+- `DB_POOL_PRE_PING`: test each connection on checkout, so one dropped by
+  a database restart doesn't fail a request.
+
+With `DB_POOLER=transaction` the app sits behind an external pooler such as
+PgBouncer in transaction mode: it keeps no connections of its own (the
+pooler does), and since a connection may go back to another client after
+every transaction, nothing may rely on server-side session state. psycopg2
+doesn't use server-side prepared statements, and Warbler doesn't use
+session-level `SET`, `LISTEN`, advisory locks or cursors held across
+transactions, so no other change is needed.
+
+Each pool counts checkouts, new connections, time spent waiting for a
+connection (and how often that took longer than `SLOW_CHECKOUT_MS` or timed
+out), connections in use and the most ever in use at once, and overflow.
+`pool_stats()` reports them for `/admin/metrics`.
+"""
+
+import threading
+from collections import Counter
+from time import perf_counter
+
+from flask import current_app
+from sqlalchemy import exc
+from sqlalchemy.pool import NullPool, QueuePool
+
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_TIMEOUT = 10
+DEFAULT_POOL_RECYCLE = 1800
+DEFAULT_PRE_PING = True
+
+SLOW_CHECKOUT_MS = 10
+
+TRANSACTION_POOLER = 'transaction'
+
+
+class PoolStats:
+    """Counters for one pool."""
+
+    def __init__(self):
+        self.counts = Counter(dict.fromkeys(
+            ('checkouts', 'slow_checkouts', 'connects', 'timeouts'), 0))
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.wait_ms_total = 0.0
+        self.wait_ms_max = 0.0
+        self._lock = threading.Lock()
+
+    def checked_out(self, wait_ms):
+        with self._lock:
+            self.counts['checkouts'] += 1
+            if wait_ms >= SLOW_CHECKOUT_MS:
+                self.counts['slow_checkouts'] += 1
+            self.wait_ms_total += wait_ms
+            self.wait_ms_max = max(self.wait_ms_max, wait_ms)
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+    def checked_in(self):
+        with self._lock:
+            self.in_use -= 1
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            checkouts = self.counts['checkouts']
+            return dict(self.counts,
+                        checked_out=self.in_use,
+                        peak_checked_out=self.peak_in_use,
+                        wait_ms_avg=self.wait_ms_total / checkouts if checkouts else 0.0,
+                        wait_ms_max=self.wait_ms_max)
+
+
+class TimedPool:
+    """Mixin for a pool class that records `PoolStats`."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        started = perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.count('timeouts')
+            raise
+        self.stats.checked_out((perf_counter() - started) * 1000)
+        return conn
+
+    def _do_return_conn(self, conn):
+        self.stats.checked_in()
+        super()._do_return_conn(conn)
+
+    def _create_connection(self):
+        self.stats.count('connects')
+        return super()._create_connection()
+
+    def status_report(self):
+        report = self.stats.snapshot()
+        if isinstance(self, QueuePool):
+            report.update(size=self.size(), idle=self.checkedin(),
+                          overflow=max(self.overflow(), 0))
+        return report
+
+
+class TimedQueuePool(TimedPool, QueuePool):
+    pass
+
+
+class TimedNullPool(TimedPool, NullPool):
+    pass
+
+
+def engine_options(app, url):
+    """`create_engine()` pool options for `url` (a SQLAlchemy URL)."""
+
+    if url.drivername.startswith('sqlite'):
+        # In-memory databases need the pool Flask-SQLAlchemy sets up.
+        if url.database in (None, '', ':memory:'):
+            return {}
+        return {'poolclass': TimedNullPool}
+
+    if app.config.get('DB_POOLER') == TRANSACTION_POOLER:
+        return {'poolclass': TimedNullPool}
+
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': app.config.get('DB_POOL_SIZE', DEFAULT_POOL_SIZE),
+        'max_overflow': app.config.get('DB_POOL_MAX_OVERFLOW', DEFAULT_MAX_OVERFLOW),
+        'pool_timeout': app.config.get('DB_POOL_TIMEOUT', DEFAULT_POOL_TIMEOUT),
+        'pool_recycle': app.config.get('DB_POOL_RECYCLE', DEFAULT_POOL_RECYCLE),
+        'pool_pre_ping': app.config.get('DB_POOL_PRE_PING', DEFAULT_PRE_PING),
+    }
+
+
+def _report(engine):
+    pool = engine.pool
+    if isinstance(pool, TimedPool):
+        return pool.status_report()
+    return {'status': pool.status()}
+
+
+def pool_stats():
+    """Pool telemetry for the primary and each replica."""
+
+    stats = {'primary': _report(current_app.extensions['sqlalchemy'].db.engine)}
+    replica_set = current_app.extensions.get('db_replicas')
+    for replica in (replica_set.replicas if replica_set else []):
+        stats[repr(replica.engine.url)] = _report(replica.engine)
+    return stats
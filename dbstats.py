@@ -0,0 +1,103 @@
+"""Request-scoped SQL statistics.
+
+Engine events time every statement and add it to the current request's
+`QueryStats` (kept on `g`). At the end of the request app.py reports the
+totals three ways:
+
+- a `Server-Timing` response header, visible in browser dev tools;
+- one `warbler.sql` log line per request with the count, total time and the
+  slowest statements;
+- a warning for any single statement slower than `SLOW_QUERY_MS`.
+"""
+
+import heapq
+import logging
+from time import perf_counter
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_SLOW_QUERY_MS = 200
+SLOWEST_KEPT = 3
+
+logger = logging.getLogger('warbler.sql')
+
+
+class QueryStats:
+    """Statements run while handling one request."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.slowest = []
+
+    def record(self, statement, elapsed_ms):
+        self.count += 1
+        self.total_ms += elapsed_ms
+
+        entry = (elapsed_ms, statement)
+        if len(self.slowest) < SLOWEST_KEPT:
+            heapq.heappush(self.slowest, entry)
+        else:
+            heapq.heappushpop(self.slowest, entry)
+
+    def slowest_first(self):
+        return sorted(self.slowest, reverse=True)
+
+
+def current_stats():
+    """Return this request's `QueryStats`, creating it on first use."""
+
+    if 'sql_stats' not in g:
+        g.sql_stats = QueryStats()
+    return g.sql_stats
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not has_app_context():
+        return
+
+    elapsed_ms = (perf_counter() - context._query_started) * 1000
+    current_stats().record(statement, elapsed_ms)
+
+    threshold = current_app.config.get('SLOW_QUERY_MS', DEFAULT_SLOW_QUERY_MS)
+    if elapsed_ms >= threshold:
+        logger.warning("slow query: %.1fms %s", elapsed_ms, statement)
+
+
+def init_app(app):
+    """Start timing statements on every engine the app creates."""
+
+    app.config.setdefault('SLOW_QUERY_MS', DEFAULT_SLOW_QUERY_MS)
+
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def report(response):
+    """Add this request's SQL totals to `response` and the log."""
+
+    stats = g.get('sql_stats')
+    if stats is None:
+        return response
+
+    response.headers.add(
+        'Server-Timing',
+        f'db;dur={stats.total_ms:.1f};desc="{stats.count} queries"')
+
+    logger.info(
+        "method=%s path=%s status=%s queries=%d db_ms=%.1f slowest=%s",
+        request.method,
+        request.path,
+        response.status_code,
+        stats.count,
+        stats.total_ms,
+        [f"{ms:.1f}ms {statement[:80]}" for ms, statement in stats.slowest_first()])
+
+    return response
@@ -0,0 +1,166 @@
+"""Cached HTML fragments for message cards and profile headers.
+
+A message card or a profile header looks the same to every viewer, apart
+from its buttons: whether the viewer has liked the message, whether they
+follow the user, whether it's their own. So each fragment is rendered once
+without those buttons and cached, and every page view fills the buttons in
+with a tiny "overlay" macro (`like_button` / `profile_actions`) at the
+`VIEWER_SLOT` marker.
+
+Cache keys carry a hash of what the fragment shows of its user (see
+`user_version()`), computed from the row just loaded, so a profile edit made
+in any worker changes the keys in every worker and stale entries are simply
+never asked for again. A header's key also includes the user's counters; a
+card's key needs nothing more, as a message's text never changes and its
+like count is drawn by the overlay.
+
+Fragments live in a bounded, process-local LRU (`FRAGMENT_CACHE_SIZE`,
+`FRAGMENT_CACHE_TTL`), optionally backed by a shared Redis-compatible store
+(`FRAGMENT_CACHE_REDIS_URL`). Hits and misses are counted for
+`/admin/metrics`.
+"""
+
+import hashlib
+import threading
+from collections import Counter
+
+from flask import Markup, current_app, get_template_attribute
+
+from identity import LRUCache
+
+DEFAULT_SIZE = 10000
+DEFAULT_TTL = 600
+
+VIEWER_SLOT = '<!--viewer-->'
+
+# What a card shows of its author (all loaded with the card, see cards.py),
+# and what a profile header shows of its user besides the counters.
+CARD_USER_FIELDS = ('username', 'image_url')
+HEADER_USER_FIELDS = ('username', 'image_url', 'header_image_url')
+
+
+class FragmentCache:
+    """Rendered HTML by key, in a local LRU and optional shared backend.
+
+    `backend` is anything with Redis-style `get(key)`, `set(key, value, ex=)`
+    and `delete(key)` methods.
+    """
+
+    def __init__(self, maxsize=DEFAULT_SIZE, ttl=DEFAULT_TTL, backend=None):
+        self.local = LRUCache(maxsize, ttl)
+        self.ttl = ttl
+        self.backend = backend
+        self._stats = Counter()
+        self._lock = threading.Lock()
+
+    def _count(self, kind, outcome):
+        with self._lock:
+            self._stats[f"{kind}_{outcome}"] += 1
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None or self.backend is None:
+            return value
+
+        raw = self.backend.get(f"warbler:fragment:{key}")
+        if raw is None:
+            return None
+
+        value = raw.decode('utf-8') if isinstance(raw, bytes) else raw
+        self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.backend is not None:
+            self.backend.set(f"warbler:fragment:{key}", value, ex=self.ttl)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.backend is not None:
+            self.backend.delete(f"warbler:fragment:{key}")
+
+    def fetch(self, kind, key, render):
+        """Return the fragment cached under `key`, rendering and storing it on a miss."""
+
+        html = self.get(key)
+        if html is not None:
+            self._count(kind, 'hits')
+            return html
+
+        self._count(kind, 'misses')
+        html = str(render())
+        self.set(key, html)
+        return html
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+def init_app(app):
+    """Create the app's fragment cache and make the fragments available to templates."""
+
+    backend = None
+    redis_url = app.config.get('FRAGMENT_CACHE_REDIS_URL')
+    if redis_url:
+        import redis
+        backend = redis.Redis.from_url(redis_url)
+
+    app.extensions['fragment_cache'] = FragmentCache(
+        maxsize=app.config.get('FRAGMENT_CACHE_SIZE', DEFAULT_SIZE),
+        ttl=app.config.get('FRAGMENT_CACHE_TTL', DEFAULT_TTL),
+        backend=backend,
+    )
+
+    app.jinja_env.globals.update(message_card=message_card,
+                                 profile_header=profile_header)
+
+
+def get_cache():
+    return current_app.extensions['fragment_cache']
+
+
+def user_version(user, fields):
+    """A short hash of `user`'s `fields`, for fragment keys."""
+
+    values = tuple(getattr(user, field) for field in fields)
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()[:12]
+
+
+def card_key(msg):
+    return f"card:{msg.id}:{user_version(msg.user, CARD_USER_FIELDS)}"
+
+
+def message_card(msg):
+    """The `<li>` card for `msg`, with the viewer's like button filled in."""
+
+    cache = get_cache()
+    key = card_key(msg)
+    html = cache.fetch(
+        'cards', key,
+        lambda: get_template_attribute('messages/_card.html', 'card')(msg))
+
+    button = get_template_attribute('messages/_card.html', 'like_button')(msg)
+    return Markup(html.replace(VIEWER_SLOT, str(button), 1))
+
+
+def profile_header(user):
+    """The hero image and stats of `user`'s profile, with the viewer's buttons filled in."""
+
+    cache = get_cache()
+    key = (f"header:{user.id}:{user_version(user, HEADER_USER_FIELDS)}:"
+           f"{user.message_count}:{user.following_count}:"
+           f"{user.follower_count}:{user.like_count}")
+    html = cache.fetch(
+        'headers', key,
+        lambda: get_template_attribute('users/_header.html', 'header')(user))
+
+    actions = get_template_attribute('users/_header.html', 'profile_actions')(user)
+    return Markup(html.replace(VIEWER_SLOT, str(actions), 1))
+
+
+def invalidate_message(msg):
+    """Drop a deleted message's card."""
+
+    get_cache().delete(card_key(msg))
@@ -2,76 +2,251 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows:
+
+    python generator/create_csvs.py --users 1000000 --messages 10000000 \\
+        --follows 20000000 --likes 5000000 --seed 42 --offline
+
+Popularity and activity follow power laws, as on real social networks: a
+few users have most of the followers, a few post most of the messages, and
+a few messages collect most of the likes. Every pair is sampled directly
+from those distributions, never from a list of all possible pairs, so
+memory stays flat at any scale.
+
+Rows are generated in fixed-size shards by a pool of worker processes, each
+shard from its own seeded random stream, so the same `--seed` (and
+`--until`) produces the same files whatever `--workers` is. `--offline`
+skips fetching header image URLs over the network.
+
+seed.py assumes users and messages get ids 1, 2, 3... in file order.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import shutil
+from datetime import datetime
+from multiprocessing import Pool
+from random import Random
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import PowerLaw, get_random_datetime, unit_hash
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
+NUM_LIKES = 2000
+
+SHARD_SIZE = 20000
 
-fake = Faker()
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-# Generate random profile image URLs to use for users
+# Random profile image URLs to use for users
 
-image_urls = [
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+OFFLINE_HEADER_IMAGE_URLS = ['/static/images/warbler-hero.jpg']
+
+# Salts separating the random streams of each kind of row.
+USERS, MESSAGES, FOLLOWS, LIKES, AUTHORS = range(5)
+
+
+def fetch_header_image_urls():
+    """Random header image URLs to use for users."""
+
+    import requests
+    return [
+        requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
+        for i in range(1, 46)
+    ]
+
+
+class Plan:
+    """Everything a worker needs to generate any shard."""
+
+    def __init__(self, args, header_image_urls):
+        self.seed = args.seed
+        self.users = args.users
+        self.messages = args.messages
+        self.follows = args.follows
+        self.likes = args.likes
+        self.until = args.until
+        self.header_image_urls = header_image_urls
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+        # Who gets followed, who follows/posts/likes, and which messages get liked.
+        self.popularity = PowerLaw(args.users, args.exponent, args.seed, 1)
+        self.activity = PowerLaw(args.users, args.exponent, args.seed, 2)
+        self.virality = (PowerLaw(args.messages, args.exponent, args.seed, 3)
+                         if args.messages else None)
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+        # Most follows and likes any one user can make; the busiest users'
+        # surplus is spread over everyone else.
+        self.follow_limit = (args.users - 1) // 2
+        self.follow_scale = self.activity.capped_scale(args.follows, self.follow_limit)
+        self.like_limit = args.messages // 2
+        self.like_scale = self.activity.capped_scale(args.likes, self.like_limit)
+
+    def rng(self, kind, shard):
+        return Random(f"{self.seed}:{kind}:{shard}")
+
+    def author_of(self, message_id):
+        """The user who posted `message_id`, recomputable by any worker."""
+
+        return self.activity.at(unit_hash(self.seed, AUTHORS, message_id))
+
+    def degree(self, rng, user_id, total, scale, limit):
+        """How many rows `user_id` gets: their share of `total`, rounded at random."""
+
+        expected = self.activity.share(user_id) * total * scale
+        return min(int(expected + rng.random()), limit)
+
+
+def user_rows(plan, rng, fake, start, stop):
+    for i in range(start, stop):
+        username = f"{fake.user_name()}{i}"
+        yield [
+            f"{username}@{fake.free_email_domain()}",
+            username,
+            rng.choice(IMAGE_URLS),
+            PASSWORD,
+            fake.sentence(),
+            rng.choice(plan.header_image_urls),
+            fake.city(),
+        ]
+
+
+def message_rows(plan, rng, fake, start, stop):
+    for message_id in range(start, stop):
+        yield [
+            fake.paragraph()[:MAX_WARBLER_LENGTH],
+            get_random_datetime(rng=rng, now=plan.until),
+            plan.author_of(message_id),
+        ]
+
+
+def follow_rows(plan, rng, fake, start, stop):
+    for follower in range(start, stop):
+        count = plan.degree(rng, follower, plan.follows, plan.follow_scale, plan.follow_limit)
+        followed = set()
+        attempts = 0
+        while len(followed) < count and attempts < 10 * count:
+            attempts += 1
+            user_id = plan.popularity.sample(rng)
+            if user_id != follower:
+                followed.add(user_id)
+        for user_id in followed:
+            yield [user_id, follower]
+
+
+def like_rows(plan, rng, fake, start, stop):
+    for user_id in range(start, stop):
+        count = plan.degree(rng, user_id, plan.likes, plan.like_scale, plan.like_limit)
+        liked = set()
+        attempts = 0
+        while len(liked) < count and attempts < 10 * count:
+            attempts += 1
+            message_id = plan.virality.sample(rng)
+            if plan.author_of(message_id) != user_id:
+                liked.add(message_id)
+        for message_id in liked:
+            yield [user_id, message_id]
+
+
+# name -> (headers, row generator, number of ids to shard over)
+TABLES = {
+    'users': (USERS_CSV_HEADERS, user_rows, lambda plan: plan.users),
+    'messages': (MESSAGES_CSV_HEADERS, message_rows, lambda plan: plan.messages),
+    'follows': (FOLLOWS_CSV_HEADERS, follow_rows, lambda plan: plan.users if plan.follows else 0),
+    'likes': (LIKES_CSV_HEADERS, like_rows, lambda plan: plan.users if plan.likes and plan.messages else 0),
+}
+
+SALTS = {'users': USERS, 'messages': MESSAGES, 'follows': FOLLOWS, 'likes': LIKES}
+
+_plan = None
+
+
+def _init_worker(plan):
+    global _plan
+    _plan = plan
+
+
+def write_shard(task):
+    """Write one shard of one table to its part file; return (path, rows)."""
+
+    name, shard, start, stop, path = task
+    rng = _plan.rng(SALTS[name], shard)
+    fake = Faker()
+    fake.seed_instance(rng.getrandbits(32))
+
+    rows = 0
+    with open(path, 'w', newline='') as part:
+        writer = csv.writer(part)
+        for row in TABLES[name][1](_plan, rng, fake, start, stop):
+            writer.writerow(row)
+            rows += 1
+    return path, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate CSVs of random data for Warbler.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS,
+                        help="approximate number of follows")
+    parser.add_argument('--likes', type=int, default=NUM_LIKES,
+                        help="approximate number of likes")
+    parser.add_argument('--exponent', type=float, default=1.1,
+                        help="power-law exponent; higher is more skewed")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--until', type=datetime.fromisoformat,
+                        default=datetime.combine(datetime.today(), datetime.min.time()),
+                        help="latest message timestamp (default: midnight today)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--offline', action='store_true',
+                        help="don't fetch header image URLs from the network")
+    parser.add_argument('--out', default='generator')
+    args = parser.parse_args()
+
+    header_image_urls = (OFFLINE_HEADER_IMAGE_URLS if args.offline
+                         else fetch_header_image_urls())
+    plan = Plan(args, header_image_urls)
+
+    parts_dir = os.path.join(args.out, 'parts')
+    os.makedirs(parts_dir, exist_ok=True)
+
+    tasks = []
+    for name, (_, _, count) in TABLES.items():
+        for shard, start in enumerate(range(1, count(plan) + 1, SHARD_SIZE)):
+            stop = min(start + SHARD_SIZE, count(plan) + 1)
+            tasks.append((name, shard, start, stop,
+                          os.path.join(parts_dir, f"{name}-{shard:05}.csv")))
+
+    parts = {name: [] for name in TABLES}
+    with Pool(args.workers, initializer=_init_worker, initargs=(plan,)) as pool:
+        for (name, *_), (path, rows) in zip(tasks, pool.imap(write_shard, tasks)):
+            parts[name].append((path, rows))
+
+    for name, (headers, _, _) in TABLES.items():
+        with open(os.path.join(args.out, f"{name}.csv"), 'w', newline='') as out:
+            csv.writer(out).writerow(headers)
+            for path, _ in parts[name]:
+                with open(path, newline='') as part:
+                    shutil.copyfileobj(part, out)
+        print(f"{name}.csv: {sum(rows for _, rows in parts[name]):,} rows")
+
+    shutil.rmtree(parts_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,101 @@
 """Support functions for CSV generation."""
 
 from datetime import datetime
+from math import gcd
 from random import uniform
 
+MASK64 = (1 << 64) - 1
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
 
-    now = datetime.now()
+def get_random_datetime(year_gap=2, rng=None, now=None):
+    """Get a random datetime within the `year_gap` years before `now`.
+
+    Pass a seeded `random.Random` as `rng` (and a fixed `now`) for
+    reproducible output.
+    """
+
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = (rng.uniform if rng else uniform)(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+def unit_hash(*keys):
+    """A deterministic pseudo-random float in [0, 1) for a tuple of integers.
+
+    Lets any worker recompute the same "random" choice for, say, message
+    #1234 without sharing state (splitmix64 over the keys).
+    """
+
+    x = 0
+    for key in keys:
+        x = (x ^ key) + 0x9E3779B97F4A7C15 & MASK64
+        x = (x ^ (x >> 30)) * 0xBF58476D1CE4E5B9 & MASK64
+        x = (x ^ (x >> 27)) * 0x94D049BB133111EB & MASK64
+        x ^= x >> 31
+    return x / (1 << 64)
+
+
+class PowerLaw:
+    """A Zipf-like distribution over the ids 1..n.
+
+    The id of rank r (1 = most popular) has weight r ** -exponent. Ranks are
+    assigned to ids by a seeded affine permutation, so popular ids are
+    scattered rather than all at the start, and nothing of size n is ever
+    held in memory.
+    """
+
+    def __init__(self, n, exponent, *seed):
+        self.n = n
+        self.exponent = exponent
+
+        self.a = 1 + int(unit_hash(*seed, 1) * n)
+        while gcd(self.a, n) != 1:
+            self.a += 1
+        self.b = int(unit_hash(*seed, 2) * n)
+        self.a_inverse = pow(self.a, -1, n) if n > 1 else 0
+
+        # Sum of all weights, to turn a weight into a share of the total.
+        self.total = sum(r ** -exponent for r in range(1, n + 1))
+
+    def id_for_rank(self, rank):
+        return (self.a * (rank - 1) + self.b) % self.n + 1
+
+    def rank_for_id(self, id):
+        return self.a_inverse * (id - 1 - self.b) % self.n + 1
+
+    def share(self, id):
+        """The fraction of all draws that land on `id`."""
+
+        return self.rank_for_id(id) ** -self.exponent / self.total
+
+    def capped_scale(self, total, limit):
+        """Factor to multiply shares of `total` by so that, once each id's count
+        is capped at `limit`, the counts still add up to about `total`."""
+
+        capped, capped_share, scale = 0, 0.0, 1.0
+        while capped < self.n and total - capped * limit > 0:
+            scale = (total - capped * limit) / (total * (1 - capped_share))
+            share = (capped + 1) ** -self.exponent / self.total
+            if scale * total * share <= limit:
+                break
+            capped += 1
+            capped_share += share
+        return scale
+
+    def rank_at(self, u):
+        """The rank at quantile `u` in [0, 1), by the continuous inverse CDF."""
+
+        s, top = self.exponent, self.n + 1
+        if s == 1:
+            x = top ** u
+        else:
+            x = (1 + u * (top ** (1 - s) - 1)) ** (1 / (1 - s))
+        return min(int(x), self.n)
+
+    def sample(self, rng):
+        return self.id_for_rank(self.rank_at(rng.random()))
+
+    def at(self, u):
+        return self.id_for_rank(self.rank_at(u))
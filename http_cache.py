@@ -0,0 +1,173 @@
+"""HTTP caching policy.
+
+Every response gets a `Cache-Control` header from one of three places:
+
+- Routes decorated with `cache_control(...)` (or the `revalidate` /
+  `no_store` shorthands) get that policy.
+- Static files get `STATIC_IMMUTABLE` when requested through a
+  fingerprinted URL. `url_for('static', ...)` adds `?v=<content hash>`
+  automatically, so a changed file gets a new URL. Unfingerprinted URLs
+  must be revalidated; Flask answers those with ETag/Last-Modified and 304s.
+- Everything else gets `DEFAULT_POLICY`, which is not to store it at all.
+
+Pages under `revalidate` may be kept by the browser but must be checked
+with the server before reuse. Their views call `check(...)` with everything
+the page shows that can change: rows, counters, the viewer's relationship
+to them. The values are hashed into an ETag. If the browser already holds
+that version, `check()` answers `304 Not Modified` at once, skipping
+template rendering. The hash also covers the templates' source, so a
+deploy that changes a template changes every ETag.
+"""
+
+import hashlib
+import os
+from functools import wraps
+
+from flask import abort, current_app, g, make_response, request, session
+
+
+DEFAULT_POLICY = 'no-store'
+REVALIDATE_POLICY = 'private, no-cache'
+STATIC_IMMUTABLE = 'public, max-age=31536000, immutable'
+STATIC_REVALIDATE = 'public, no-cache'
+
+
+def cache_control(policy):
+    """Give a view's responses the `Cache-Control` header `policy`."""
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            g.cache_policy = policy
+            response = make_response(view(*args, **kwargs))
+            return _finish(response)
+        return wrapper
+
+    return decorator
+
+
+revalidate = cache_control(REVALIDATE_POLICY)
+no_store = cache_control(DEFAULT_POLICY)
+
+
+def _finish(response):
+    response.headers['Cache-Control'] = g.cache_policy
+    etag = g.get('etag')
+    if etag is not None and response.status_code == 200:
+        response.set_etag(etag, weak=True)
+        response.vary.add('Cookie')
+    return response
+
+
+def check(*parts):
+    """Set the page's ETag from `parts`; answer 304 now if the client has it.
+
+    Call from a `revalidate` view once the data is loaded but before
+    rendering.
+    """
+
+    # The navbar shows the viewer, and any page may show pending flashes.
+    viewer = g.user and (g.user.id, g.user.username, g.user.image_url)
+    state = (template_version(), viewer, session.get('_flashes'))
+
+    digest = hashlib.sha1(repr((state, parts)).encode('utf-8'))
+    g.etag = digest.hexdigest()[:24]
+
+    if request.method in ('GET', 'HEAD') and request.if_none_match.contains_weak(g.etag):
+        response = current_app.response_class(status=304)
+        response.set_etag(g.etag, weak=True)
+        response.vary.add('Cookie')
+        response.headers['Cache-Control'] = g.get('cache_policy', REVALIDATE_POLICY)
+        abort(response)
+
+
+def profile_parts(user):
+    """What a profile header shows, for `check()`."""
+
+    return (user.id,
+            user.username,
+            user.image_url,
+            user.header_image_url,
+            user.bio,
+            user.location,
+            user.message_count,
+            user.following_count,
+            user.follower_count,
+            user.like_count,
+            g.viewer and g.viewer.user_id != user.id and g.viewer.is_following(user))
+
+
+def card_parts(messages):
+    """What a list of message cards shows, for `check()`."""
+
+    return [(msg.id,
+             msg.like_count,
+             msg.user.username,
+             msg.user.image_url,
+             g.viewer and g.viewer.has_liked(msg))
+            for msg in messages]
+
+
+def _file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()[:12]
+
+
+_static_versions = {}
+
+
+def static_version(filename):
+    """Content hash of a static file, recomputed only when it changes."""
+
+    path = os.path.join(current_app.static_folder, filename)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+
+    cached = _static_versions.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = _static_versions[path] = (mtime, _file_hash(path))
+    return cached[1]
+
+
+_template_version = None
+
+
+def template_version():
+    """Hash of every template's source, so a template change changes every ETag."""
+
+    global _template_version
+    if _template_version is None:
+        digest = hashlib.md5()
+        folder = os.path.join(current_app.root_path, current_app.template_folder)
+        for root, dirs, files in sorted(os.walk(folder)):
+            for name in sorted(files):
+                with open(os.path.join(root, name), 'rb') as f:
+                    digest.update(f.read())
+        _template_version = digest.hexdigest()[:12]
+    return _template_version
+
+
+def _fingerprint_static(endpoint, values):
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        version = static_version(values['filename'])
+        if version:
+            values['v'] = version
+
+
+def _default_policy(response):
+    if request.endpoint == 'static':
+        if response.status_code in (200, 304):
+            response.headers['Cache-Control'] = (STATIC_IMMUTABLE if request.args.get('v')
+                                                 else STATIC_REVALIDATE)
+    elif 'Cache-Control' not in response.headers:
+        response.headers['Cache-Control'] = DEFAULT_POLICY
+    return response
+
+
+def init_app(app):
+    """Fingerprint static URLs and apply the default policies."""
+
+    app.url_defaults(_fingerprint_static)
+    app.after_request(_default_policy)
@@ -0,0 +1,210 @@
+"""Cached identity of the logged-in user.
+
+Every request used to load the logged-in `User` by primary key just to
+render the navbar. Instead, a small snapshot of the user (the "principal":
+id, username and images) is cached for `IDENTITY_CACHE_TTL` seconds in a
+bounded, process-local LRU, optionally backed by a shared Redis-compatible
+store (`IDENTITY_CACHE_REDIS_URL`) so all workers share one copy.
+
+`g.user` is a `CurrentUser` proxy: principal fields are answered from the
+snapshot, and the real `User` row is loaded only when a view touches
+anything else. Views that change the cached fields must call `invalidate()`.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from flask import abort, current_app
+
+PRINCIPAL_FIELDS = ('id', 'username', 'email', 'image_url', 'header_image_url')
+
+DEFAULT_SIZE = 1024
+DEFAULT_TTL = 60
+
+
+class LRUCache:
+    """A thread-safe, size-bounded dict whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize=DEFAULT_SIZE, ttl=DEFAULT_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires < monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class IdentityCache:
+    """Principal snapshots keyed by user id, in a local LRU and optional shared backend.
+
+    `backend` is anything with Redis-style `get(key)`, `set(key, value, ex=)`
+    and `delete(key)` methods.
+    """
+
+    def __init__(self, maxsize=DEFAULT_SIZE, ttl=DEFAULT_TTL, backend=None):
+        self.local = LRUCache(maxsize, ttl)
+        self.ttl = ttl
+        self.backend = backend
+
+    @staticmethod
+    def _key(user_id):
+        return f"warbler:principal:{user_id}"
+
+    def get(self, user_id):
+        principal = self.local.get(user_id)
+        if principal is not None or self.backend is None:
+            return principal
+
+        raw = self.backend.get(self._key(user_id))
+        if raw is None:
+            return None
+
+        principal = json.loads(raw)
+        self.local.set(user_id, principal)
+        return principal
+
+    def set(self, user_id, principal):
+        self.local.set(user_id, principal)
+        if self.backend is not None:
+            self.backend.set(self._key(user_id), json.dumps(principal), ex=self.ttl)
+
+    def invalidate(self, user_id):
+        self.local.delete(user_id)
+        if self.backend is not None:
+            self.backend.delete(self._key(user_id))
+
+
+class CurrentUser:
+    """Lazy stand-in for the logged-in `User`, used as `g.user`.
+
+    Reads of principal fields come from the cached snapshot; any other
+    attribute access (relationships, counters, methods) or assignment loads
+    the real row once and delegates to it. Pass `_get_current_object()` to
+    code that needs the ORM instance itself, such as `db.session.delete()`.
+    """
+
+    def __init__(self, principal, load):
+        object.__setattr__(self, '_principal', principal)
+        object.__setattr__(self, '_load', load)
+        object.__setattr__(self, '_user', None)
+
+    def _get_current_object(self):
+        if self._user is None:
+            user = self._load(self._principal['id'])
+            if user is None:
+                invalidate(self._principal['id'])
+                abort(403)
+            object.__setattr__(self, '_user', user)
+        return self._user
+
+    def __getattr__(self, name):
+        if self._user is None and name in self._principal:
+            return self._principal[name]
+        return getattr(self._get_current_object(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get_current_object(), name, value)
+
+    def __eq__(self, other):
+        other = getattr(other, '_get_current_object', lambda: other)()
+        return self._get_current_object() == other
+
+    def __hash__(self):
+        return hash(self._get_current_object())
+
+    def __bool__(self):
+        return True
+
+    def __repr__(self):
+        return f"<CurrentUser #{self._principal['id']}: {self._principal['username']}>"
+
+
+def principal_for(user):
+    """The cached snapshot of `user`."""
+
+    return {field: getattr(user, field) for field in PRINCIPAL_FIELDS}
+
+
+def init_app(app):
+    """Create the app's identity cache from its config."""
+
+    backend = None
+    redis_url = app.config.get('IDENTITY_CACHE_REDIS_URL')
+    if redis_url:
+        import redis
+        backend = redis.Redis.from_url(redis_url)
+
+    app.extensions['identity_cache'] = IdentityCache(
+        maxsize=app.config.get('IDENTITY_CACHE_SIZE', DEFAULT_SIZE),
+        ttl=app.config.get('IDENTITY_CACHE_TTL', DEFAULT_TTL),
+        backend=backend,
+    )
+
+
+def get_cache():
+    return current_app.extensions['identity_cache']
+
+
+def current_user(user_id, load, verify=False):
+    """Return a `CurrentUser` for `user_id`, or None if there is no such user.
+
+    `load(user_id)` fetches the real `User`; it is only called on a cache miss
+    or when the view needs more than the principal. Pass `verify=True` to
+    load it regardless (e.g. before writes), so a user deleted by another
+    worker isn't taken for logged in on the strength of this one's cache.
+    """
+
+    cache = get_cache()
+    principal = cache.get(user_id)
+
+    if principal is not None and not verify:
+        return CurrentUser(principal, load)
+
+    user = load(user_id)
+    if user is None:
+        if principal is not None:
+            cache.invalidate(user_id)
+        return None
+
+    if principal is None:
+        principal = principal_for(user)
+        cache.set(user_id, principal)
+
+    current = CurrentUser(principal, load)
+    object.__setattr__(current, '_user', user)
+    return current
+
+
+def invalidate(user_id):
+    """Drop a user's cached principal after their profile changes."""
+
+    get_cache().invalidate(user_id)
@@ -0,0 +1,393 @@
+"""Resized, cached copies of users' profile and header images.
+
+`User.image_url` and `header_image_url` can point anywhere, usually at
+full-size photos. Templates pass them through the `asset` filter with the
+width they're drawn at, which links to `/img/<width>/<token>` instead:
+
+- `token` is the source URL signed with the app's secret key, so the proxy
+  only ever fetches URLs this app handed out.
+- `width` is rounded up to one of `SIZES`, so a handful of thumbnails per
+  image serve every layout.
+
+The first request fetches the source (at most `IMAGE_PROXY_MAX_SOURCE_BYTES`;
+`/static/...` URLs are read from disk) and every request after that is
+answered from `IMAGE_CACHE_DIR`. Only public http(s) hosts are fetched from:
+the connection goes to the exact address that was checked, and each of at
+most `MAX_REDIRECTS` redirects is checked again, so neither a redirect nor a
+DNS answer that changes between the check and the connection can point the
+proxy at an internal service. Files there are named
+by the SHA-256 of their content, so two URLs serving the same photo share
+one original and one set of thumbnails. When the directory grows past
+`IMAGE_CACHE_MAX_BYTES` the least recently used files are deleted.
+
+Thumbnails are WebP for browsers that accept it (if Pillow was built with
+WebP support) and JPEG/PNG otherwise, and are served as immutable for a
+year. Only images Pillow has decoded and re-encoded are ever served, so
+without Pillow the proxy is off and templates link to the source images
+directly.
+"""
+
+import hashlib
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import ssl
+import tempfile
+import threading
+import urllib.parse
+from collections import Counter
+from time import time
+
+from flask import abort, current_app, g, redirect, request, send_file, url_for
+from itsdangerous import BadSignature, URLSafeSerializer
+
+import http_cache
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:
+    Image = None
+
+# Whether this Pillow can encode WebP; it's an optional part of the build.
+WEBP = Image is not None and features.check('webp')
+
+# Errors from decoding something that isn't an image (or is one too large).
+DECODE_ERRORS = (OSError, ValueError) + (
+    (Image.DecompressionBombError,) if Image is not None else ())
+
+SIZES = (96, 140, 200, 400, 600, 1200)
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_MAX_SOURCE_BYTES = 10 * 1024 * 1024
+FETCH_TIMEOUT = 5
+MAX_REDIRECTS = 3
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+# Reading a cached file refreshes its modification time at most this often.
+TOUCH_INTERVAL = 3600
+
+# Fraction of the limit to shrink to when evicting, so that evictions are rare.
+EVICT_TO = 0.9
+
+
+class FetchError(Exception):
+    """The source image couldn't be fetched."""
+
+
+class DiskCache:
+    """Files under `root`, deleted least recently used first past `max_bytes`.
+
+    Reading a file bumps its modification time, which is what eviction
+    orders by (access times are often not kept), unless it was bumped in the
+    last `TOUCH_INTERVAL` seconds: a hot file costs a `stat`, not a write.
+    """
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._size = None
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.root, name[:2], name)
+
+    def lookup(self, name):
+        """Path of the cached file `name`, or None."""
+
+        path = self.path(name)
+        try:
+            if time() - os.stat(path).st_mtime > TOUCH_INTERVAL:
+                os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def read(self, name):
+        path = self.lookup(name)
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def write(self, name, data):
+        """Store `data` as `name` (atomically) and return its path."""
+
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+        return path
+
+    def size(self):
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            return self._size
+
+    def _files(self):
+        for root, dirs, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._files())
+
+    def _evict(self):
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+
+        for _, size, path in files:
+            if total <= self.max_bytes * EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self._size = total
+
+
+class ImageProxy:
+    """Fetches, resizes and caches images; one per app."""
+
+    def __init__(self, cache, max_source_bytes=DEFAULT_MAX_SOURCE_BYTES, fetch=None):
+        self.cache = cache
+        self.max_source_bytes = max_source_bytes
+        self.fetch = fetch or self._fetch
+        self._stats = Counter()
+        self._lock = threading.Lock()
+
+    def _count(self, outcome):
+        with self._lock:
+            self._stats[outcome] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, cache_bytes=self.cache.size())
+
+    def _fetch(self, url):
+        if url.startswith('/static/'):
+            path = os.path.join(current_app.static_folder, url[len('/static/'):])
+            try:
+                with open(path, 'rb') as f:
+                    return f.read(self.max_source_bytes + 1)
+            except OSError as e:
+                raise FetchError(str(e))
+
+        for _ in range(MAX_REDIRECTS + 1):
+            try:
+                status, location, data = _get(url, self.max_source_bytes + 1)
+            except (OSError, ValueError, http.client.HTTPException) as e:
+                raise FetchError(str(e))
+
+            if status in REDIRECT_STATUSES and location:
+                url = urllib.parse.urljoin(url, location)
+                continue
+            if status != 200:
+                raise FetchError(f"{url} answered {status}")
+            return data
+
+        raise FetchError(f"too many redirects fetching {url}")
+
+    def source(self, url):
+        """The content digest of `url`'s image, fetching it if it's not cached."""
+
+        url_key = 'url-' + hashlib.sha256(url.encode('utf-8')).hexdigest()
+        digest = self.cache.read(url_key)
+        if digest is not None and self.cache.lookup(digest.decode()):
+            return digest.decode()
+
+        self._count('fetches')
+        data = self.fetch(url)
+        if len(data) > self.max_source_bytes:
+            raise FetchError(f"{url} is larger than {self.max_source_bytes} bytes")
+
+        digest = hashlib.sha256(data).hexdigest()
+        self.cache.write(digest, data)
+        self.cache.write(url_key, digest.encode())
+        return digest
+
+    def thumbnail(self, url, width, webp):
+        """Path and mimetype of `url`'s image resized to `width`."""
+
+        if Image is None:
+            raise FetchError("Pillow isn't installed")
+
+        digest = self.source(url)
+        for ext in (['webp'] if webp else ['jpeg', 'png']):
+            path = self.cache.lookup(f"{digest}.w{width}.{ext}")
+            if path is not None:
+                self._count('hits')
+                return path, f"image/{ext}"
+
+        self._count('misses')
+        data, ext = _resize(self.cache.read(digest), width, webp)
+        return self.cache.write(f"{digest}.w{width}.{ext}", data), f"image/{ext}"
+
+
+def _resize(data, width, webp):
+    """Encode `data` at most `width` wide; return (bytes, format extension)."""
+
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft('RGB', (width, width * 4))
+        image = ImageOps.exif_transpose(image)
+        if image.width > width:
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.LANCZOS)
+
+        out = io.BytesIO()
+        if webp:
+            ext = 'webp'
+            image.save(out, 'WEBP', quality=80)
+        elif image.mode in ('RGBA', 'LA', 'P'):
+            ext = 'png'
+            image.save(out, 'PNG', optimize=True)
+        else:
+            ext = 'jpeg'
+            image.convert('RGB').save(out, 'JPEG', quality=82, optimize=True, progressive=True)
+        return out.getvalue(), ext
+
+
+def public_address(host):
+    """An address of `host`, if every address it resolves to is public; else None."""
+
+    if not host:
+        return None
+    try:
+        infos = socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)
+    except OSError:
+        return None
+
+    addresses = [info[4][0].split('%')[0] for info in infos]
+    if not addresses or not all(ipaddress.ip_address(a).is_global for a in addresses):
+        return None
+    return addresses[0]
+
+
+class PinnedHTTPConnection(http.client.HTTPConnection):
+    """An HTTP connection to `address`, whatever `host` resolves to by now."""
+
+    def __init__(self, host, address, **kwargs):
+        super().__init__(host, **kwargs)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port), self.timeout)
+
+
+class PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """An HTTPS connection to `address`, verifying the certificate for `host`."""
+
+    def __init__(self, host, address, **kwargs):
+        super().__init__(host, context=ssl.create_default_context(), **kwargs)
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port), self.timeout)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+def _get(url, max_bytes):
+    """GET `url` from a public address without following redirects.
+
+    Returns (status, Location header, up to `max_bytes` of the body).
+    """
+
+    parts = urllib.parse.urlsplit(url)
+    address = public_address(parts.hostname) if parts.scheme in ('http', 'https') else None
+    if address is None:
+        raise FetchError(f"refusing to fetch {url}")
+
+    connection_class = PinnedHTTPSConnection if parts.scheme == 'https' else PinnedHTTPConnection
+    conn = connection_class(parts.hostname, address, port=parts.port, timeout=FETCH_TIMEOUT)
+    try:
+        conn.request('GET', urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, '')))
+        resp = conn.getresponse()
+        return resp.status, resp.getheader('Location'), resp.read(max_bytes)
+    finally:
+        conn.close()
+
+
+def _serializer():
+    return URLSafeSerializer(current_app.secret_key, salt='image-proxy')
+
+
+def bucket(width):
+    """The smallest of `SIZES` at least `width` wide (or the largest)."""
+
+    for size in SIZES:
+        if size >= width:
+            return size
+    return SIZES[-1]
+
+
+def proxied_url(url, width):
+    """The proxy URL for `url` at `width`, or `url` itself if the proxy is off."""
+
+    if (not url or Image is None
+            or not current_app.config.get('IMAGE_PROXY_ENABLED', True)):
+        return url
+    return url_for('image_proxy', width=bucket(width), token=_serializer().dumps(url))
+
+
+def get_proxy():
+    return current_app.extensions['image_proxy']
+
+
+def serve(width, token):
+    """Send the cached thumbnail for a signed source URL."""
+
+    if width not in SIZES:
+        abort(404)
+    try:
+        url = _serializer().loads(token)
+    except BadSignature:
+        abort(404)
+
+    webp = WEBP and bool(request.accept_mimetypes['image/webp'])
+    try:
+        path, mimetype = get_proxy().thumbnail(url, width, webp)
+    except FetchError:
+        # Let the browser try the source itself, and ask again next time.
+        if url.startswith(('http://', 'https://')):
+            g.cache_policy = http_cache.DEFAULT_POLICY
+            return redirect(url)
+        abort(404)
+    except DECODE_ERRORS:
+        # Not an image Pillow can read.
+        abort(404)
+
+    response = send_file(path, mimetype=mimetype, conditional=True)
+    response.vary.add('Accept')
+    return response
+
+
+def init_app(app):
+    """Create the app's image cache and register `/img/<width>/<token>`."""
+
+    root = app.config.get('IMAGE_CACHE_DIR') or os.path.join(app.instance_path, 'image-cache')
+    cache = DiskCache(root, app.config.get('IMAGE_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+    app.extensions['image_proxy'] = ImageProxy(
+        cache,
+        max_source_bytes=app.config.get('IMAGE_PROXY_MAX_SOURCE_BYTES',
+                                        DEFAULT_MAX_SOURCE_BYTES))
+    app.add_url_rule('/img/<int:width>/<token>', 'image_proxy',
+                     http_cache.cache_control(http_cache.STATIC_IMMUTABLE)(serve))
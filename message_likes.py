@@ -0,0 +1,90 @@
+"""Liking and unliking messages.
+
+A like is one row in `likes`, unique per (user, message). Toggling is a
+`DELETE`, and only if nothing was deleted an insert that ignores a
+conflicting row, so it never loads the user's liked-message collection.
+The liker's `User.like_count` and the message's `Message.like_count` are
+adjusted in the same transaction.
+"""
+
+from models import (db, delete_returning, insert_ignoring_duplicates, insert_returning,
+                    Likes, Message)
+import counters
+
+likes = Likes.__table__
+messages = Message.__table__
+
+
+def adjust_messages(message_ids, delta):
+    """Add `delta` to the like count of every message in `message_ids`."""
+
+    db.session.execute(messages.update()
+                       .where(messages.c.id.in_(message_ids))
+                       .values(like_count=messages.c.like_count + delta))
+
+
+def like_counts(message_ids):
+    """Map each of `message_ids` to its current like count."""
+
+    return dict(db.session
+                .query(Message.id, Message.like_count)
+                .filter(Message.id.in_(message_ids)))
+
+
+def toggle_like(user_id, message_id):
+    """Like the message if `user_id` hasn't yet, otherwise unlike it.
+
+    Returns `(liked, like_count)`: whether the message is now liked, and its
+    new total number of likes.
+    """
+
+    deleted = db.session.execute(likes.delete()
+                                 .where(likes.c.user_id == user_id)
+                                 .where(likes.c.message_id == message_id)).rowcount
+
+    if deleted:
+        liked, delta = False, -1
+    else:
+        inserted = db.session.execute(insert_ignoring_duplicates(
+            likes,
+            [{'user_id': user_id, 'message_id': message_id}],
+            ['user_id', 'message_id'])).rowcount
+        liked, delta = True, inserted
+
+    if delta:
+        counters.adjust(user_id, like_count=delta)
+        adjust_messages([message_id], delta)
+
+    return liked, like_counts([message_id])[message_id]
+
+
+def set_likes(user_id, like_ids, unlike_ids):
+    """Make `user_id` like every message in `like_ids` and none in `unlike_ids`.
+
+    Runs a fixed number of statements however many ids are given (on
+    Postgres). Counters follow the rows actually deleted and inserted, so a
+    concurrent batch or toggle is never counted twice. Returns the set of
+    message ids whose like state actually changed.
+    """
+
+    removed = added = set()
+
+    if unlike_ids:
+        removed = delete_returning(likes, likes.c.user_id == user_id,
+                                   'message_id', set(unlike_ids))
+        if removed:
+            adjust_messages(removed, -1)
+
+    if like_ids:
+        added = insert_returning(
+            likes,
+            [{'user_id': user_id, 'message_id': message_id} for message_id in set(like_ids)],
+            ['user_id', 'message_id'],
+            'message_id')
+        if added:
+            adjust_messages(added, 1)
+
+    if added or removed:
+        counters.adjust(user_id, like_count=len(added) - len(removed))
+
+    return added | removed
@@ -0,0 +1,290 @@
+"""Full-text search over messages for `/search?q=`.
+
+A message matches when it contains every word of the query (stop words
+aside). Results come best match first, and pages are linked with an opaque
+`?before=` cursor naming the `(score, id)` of the last result shown.
+
+On Postgres, `messages.search_vector` is a generated `tsvector` column with a
+GIN index (both created with the `messages` table, see models.py), so
+Postgres keeps it in sync on every write and ranks with `ts_rank()`. A
+database created before search existed gets them from
+`flask rebuild-search-index` (which rewrites the `messages` table once,
+locking it while it does). Other databases use `InvertedIndex`, an
+in-process BM25-ranked index that `rebuild()` loads in bulk from the
+`messages` table and ORM events keep current as
+`messages_add()`/`messages_destroy()` write. A stale index is rebuilt by one
+request at a time while the others keep searching the old one.
+"""
+
+import re
+import threading
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import Counter, defaultdict
+from math import log
+from time import monotonic
+
+from flask import abort, request
+from sqlalchemy import Float, and_, cast, event, func, literal_column, or_
+
+from models import db, Message, SEARCH_VECTOR_DDL
+import cards
+import pagination
+
+INDEX_TTL = 300
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+STOP_WORDS = frozenset("""
+    a an and are as at be but by for from has have i in is it its of on or
+    so that the this to was were will with you your
+""".split())
+
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+
+def tokenize(text):
+    """Lowercased words of `text`, without stop words."""
+
+    return [token for token in TOKEN_RE.findall(text.lower())
+            if token not in STOP_WORDS]
+
+
+def encode_cursor(score, id):
+    raw = f"{score!r}|{id}"
+    return urlsafe_b64encode(raw.encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Decode a token made by `encode_cursor`; raises ValueError if malformed."""
+
+    raw = urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('ascii')
+    score, id = raw.split('|')
+    return float(score), int(id)
+
+
+def cursor_from_request():
+    """Return the decoded `?before=` cursor, or None for the first page."""
+
+    token = request.args.get('before')
+    if not token:
+        return None
+
+    try:
+        return decode_cursor(token)
+    except ValueError:
+        abort(400)
+
+
+class InvertedIndex:
+    """In-process full-text index over message text, ranked with BM25."""
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.docs = {}
+        self.total_length = 0
+        self.built_at = None
+        self.size = None
+        self.lock = threading.RLock()
+
+    def add(self, message_id, text):
+        with self.lock:
+            self.remove(message_id)
+            tokens = tokenize(text)
+            counts = Counter(tokens)
+            for token, count in counts.items():
+                self.postings[token][message_id] = count
+            self.docs[message_id] = (len(tokens), list(counts))
+            self.total_length += len(tokens)
+
+    def remove(self, message_id):
+        with self.lock:
+            doc = self.docs.pop(message_id, None)
+            if doc is None:
+                return
+
+            length, tokens = doc
+            self.total_length -= length
+            for token in tokens:
+                postings = self.postings[token]
+                postings.pop(message_id, None)
+                if not postings:
+                    del self.postings[token]
+
+    def rebuild(self, rows, size):
+        """Replace the contents with `rows`, searching the old ones meanwhile."""
+
+        fresh = InvertedIndex()
+        for message_id, text in rows:
+            fresh.add(message_id, text)
+
+        with self.lock:
+            self.postings = fresh.postings
+            self.docs = fresh.docs
+            self.total_length = fresh.total_length
+            self.built_at = monotonic()
+            self.size = size
+
+    def search(self, q):
+        """Return `[(score, message_id)]` for messages containing every query word."""
+
+        with self.lock:
+            tokens = set(tokenize(q))
+            if not tokens or not self.docs:
+                return []
+
+            postings = [self.postings.get(token, {}) for token in tokens]
+            if not all(postings):
+                return []
+
+            n = len(self.docs)
+            average = self.total_length / n or 1
+            idfs = [log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for p in postings]
+
+            results = []
+            for message_id in min(postings, key=len):
+                if not all(message_id in p for p in postings):
+                    continue
+
+                norm = K1 * (1 - B + B * self.docs[message_id][0] / average)
+                score = sum(idf * p[message_id] * (K1 + 1) / (p[message_id] + norm)
+                            for idf, p in zip(idfs, postings))
+                results.append((score, message_id))
+
+            return results
+
+
+index = InvertedIndex()
+
+# Held by the one request rebuilding `index`.
+_rebuilding = threading.Lock()
+
+
+def _uses_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def _table_size():
+    return db.session.query(func.count(Message.id)).scalar()
+
+
+def rebuild():
+    """Load the local index from the `messages` table, streaming in batches.
+
+    Does nothing on Postgres, which doesn't use the local index.
+    """
+
+    if _uses_postgres():
+        return
+
+    size = _table_size()
+    rows = (db.session
+            .query(Message.id, Message.text)
+            .yield_per(1000))
+    index.rebuild(rows, size)
+
+
+def local_index():
+    """Return `index`, rebuilding it if stale or if the table changed.
+
+    Writes made through this process's ORM update the index directly (see
+    the mapper events below); a row count that disagrees with the index
+    means someone else -- another worker, a bulk load, a cascade -- changed
+    the table. Only the first build makes searches wait: after that, one
+    request rebuilds and the rest search the index as it was.
+    """
+
+    if not _is_stale():
+        return index
+
+    if _rebuilding.acquire(blocking=index.built_at is None):
+        try:
+            if _is_stale():
+                rebuild()
+        finally:
+            _rebuilding.release()
+    return index
+
+
+def _is_stale():
+    return (index.built_at is None
+            or monotonic() - index.built_at > INDEX_TTL
+            or index.size != _table_size())
+
+
+def add_search_column():
+    """On Postgres, add `search_vector` and its index if they're missing."""
+
+    if _uses_postgres():
+        db.session.execute(SEARCH_VECTOR_DDL)
+        db.session.commit()
+
+
+@event.listens_for(Message, 'after_insert')
+def _index_message(mapper, connection, msg):
+    with index.lock:
+        if index.built_at is not None:
+            index.add(msg.id, msg.text)
+            index.size += 1
+
+
+@event.listens_for(Message, 'after_delete')
+def _unindex_message(mapper, connection, msg):
+    with index.lock:
+        if index.built_at is not None and msg.id in index.docs:
+            index.remove(msg.id)
+            index.size -= 1
+
+
+def _search_postgres(q, before, size):
+    vector = literal_column('messages.search_vector')
+    tsquery = func.plainto_tsquery('english', q)
+    # ts_rank() is a `real`; as a double it survives the cursor's round trip
+    # exactly, so the boundary row compares equal to the score handed back.
+    rank = cast(func.ts_rank(vector, tsquery), Float)
+
+    query = (db.session
+             .query(Message, rank)
+             .filter(vector.op('@@')(tsquery))
+             .options(*cards.card_options()))
+
+    if before is not None:
+        score, id = before
+        query = query.filter(or_(rank < score,
+                                 and_(rank == score, Message.id < id)))
+
+    rows = query.order_by(rank.desc(), Message.id.desc()).limit(size + 1).all()
+    return [(score, msg) for msg, score in rows]
+
+
+def _search_local(q, before, size):
+    matches = sorted(local_index().search(q), reverse=True)
+
+    if before is not None:
+        matches = [match for match in matches if match < before]
+
+    matches = matches[:size + 1]
+    messages = {msg.id: msg for msg in (Message
+                                        .query
+                                        .filter(Message.id.in_([id for _, id in matches]))
+                                        .options(*cards.card_options()))}
+    return [(score, messages[id]) for score, id in matches if id in messages]
+
+
+def search_messages(q, before=None, size=None):
+    """One page of messages matching `q`, best first, and the next-page cursor."""
+
+    size = size or pagination.per_page()
+
+    if _uses_postgres():
+        results = _search_postgres(q, before, size)
+    else:
+        results = _search_local(q, before, size)
+
+    if len(results) <= size:
+        return [msg for _, msg in results], None
+
+    page = results[:size]
+    score, last = page[-1]
+    return [msg for _, msg in page], encode_cursor(score, last.id)
@@ -0,0 +1,285 @@
+"""Prometheus metrics at `/metrics`.
+
+Every request is counted and timed by endpoint, method and status, with a
+gauge of requests in flight and histograms of SQL statements per request
+(from dbstats.py), time in `render_template` per template, and bcrypt time
+per operation (from passwords.py, i.e. `User.signup`/`User.authenticate`).
+Request latency covers the view and its hooks, not the time spent sending a
+streamed body.
+
+Metrics live in the process that recorded them. Under a pre-forking server
+set `METRICS_DIR` to a directory shared by the workers (and emptied when the
+server starts): each worker writes its numbers there at most once every
+`WRITE_INTERVAL` seconds, and `/metrics` adds up every worker's file.
+Counters and histograms of workers that have exited are kept; their gauges
+are dropped.
+
+Like `/admin/metrics`, `/metrics` is a 404 unless `METRICS_ENABLED` is set.
+"""
+
+import json
+import os
+import tempfile
+import threading
+from time import monotonic, perf_counter
+
+from flask import abort, before_render_template, current_app, g, request, template_rendered
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+BCRYPT_BUCKETS = (.05, .1, .25, .5, 1, 2, 5)
+
+WRITE_INTERVAL = 1
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric:
+    """One metric and its values by label values."""
+
+    def __init__(self, registry, kind, name, help, labelnames, buckets=None):
+        self.registry = registry
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        with self.registry.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def observe(self, value, *labels):
+        """Add `value` to a histogram: bucket counts (cumulative), then sum and count."""
+
+        with self.registry.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+
+class Registry:
+    """This process's metrics."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self._written = None
+
+    def _add(self, kind, name, help, labelnames=(), buckets=None):
+        self.metrics[name] = Metric(self, kind, name, help, tuple(labelnames), buckets)
+        return self.metrics[name]
+
+    def counter(self, name, help, labelnames=()):
+        return self._add('counter', name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._add('gauge', name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add('histogram', name, help, labelnames, tuple(buckets))
+
+    def snapshot(self):
+        with self.lock:
+            return {name: [[list(labels), value] for labels, value in metric.values.items()]
+                    for name, metric in self.metrics.items()}
+
+    def write(self, directory, pid=None):
+        """Save this process's values to `directory` for `collect()`."""
+
+        data = json.dumps(self.snapshot())
+        fd, temp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.replace(temp, os.path.join(directory, f"metrics-{pid or os.getpid()}.json"))
+        self._written = monotonic()
+
+    def maybe_write(self, directory):
+        if self._written is None or monotonic() - self._written >= WRITE_INTERVAL:
+            self.write(directory)
+
+    def collect(self, directory=None):
+        """{name: {labels: value}}, added up over every process writing to `directory`."""
+
+        if directory is None:
+            snapshots = [(True, self.snapshot())]
+        else:
+            self.write(directory)
+            snapshots = []
+            for name in os.listdir(directory):
+                if name.startswith('metrics-') and name.endswith('.json'):
+                    pid = int(name[len('metrics-'):-len('.json')])
+                    try:
+                        with open(os.path.join(directory, name)) as f:
+                            snapshots.append((_alive(pid), json.load(f)))
+                    except (OSError, ValueError):
+                        continue
+
+        totals = {name: {} for name in self.metrics}
+        for alive, snapshot in snapshots:
+            for name, entries in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is None or (metric.kind == 'gauge' and not alive):
+                    continue
+                for labels, value in entries:
+                    labels = tuple(labels)
+                    total = totals[name].get(labels)
+                    if metric.kind == 'histogram':
+                        totals[name][labels] = (value if total is None
+                                                else [a + b for a, b in zip(total, value)])
+                    else:
+                        totals[name][labels] = (total or 0) + value
+        return totals
+
+    def render(self, directory=None):
+        """The Prometheus text exposition of `collect()`."""
+
+        lines = []
+        for name, values in self.collect(directory).items():
+            metric = self.metrics[name]
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for labels, value in sorted(values.items()):
+                pairs = list(zip(metric.labelnames, labels))
+                if metric.kind != 'histogram':
+                    lines.append(f"{name}{_labels(pairs)} {_number(value)}")
+                    continue
+
+                # Bucket counts are already cumulative: see Metric.observe().
+                for bound, count in zip(metric.buckets, value):
+                    lines.append(f"{name}_bucket{_labels(pairs + [('le', _number(bound))])} {count}")
+                lines.append(f"{name}_bucket{_labels(pairs + [('le', '+Inf')])} {value[-1]}")
+                lines.append(f"{name}_sum{_labels(pairs)} {_number(value[-2])}")
+                lines.append(f"{name}_count{_labels(pairs)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter(
+    'warbler_http_requests_total', "Requests handled.",
+    ('endpoint', 'method', 'status'))
+LATENCY = REGISTRY.histogram(
+    'warbler_http_request_duration_seconds', "Time to handle a request.",
+    ('endpoint', 'method'))
+IN_FLIGHT = REGISTRY.gauge(
+    'warbler_http_requests_in_flight', "Requests being handled.",
+    ('endpoint',))
+QUERIES = REGISTRY.histogram(
+    'warbler_db_queries_per_request', "SQL statements run by a request.",
+    ('endpoint',), buckets=QUERY_BUCKETS)
+DB_SECONDS = REGISTRY.counter(
+    'warbler_db_seconds_total', "Time spent running SQL statements.",
+    ('endpoint',))
+RENDER = REGISTRY.histogram(
+    'warbler_template_render_seconds', "Time in render_template.",
+    ('template',))
+BCRYPT = REGISTRY.histogram(
+    'warbler_bcrypt_seconds', "Time to hash or check a password, including queueing.",
+    ('operation',), buckets=BCRYPT_BUCKETS)
+
+
+def observe_bcrypt(operation, seconds):
+    BCRYPT.observe(seconds, operation)
+
+
+def _endpoint():
+    return request.endpoint or 'unmatched'
+
+
+def _start_request():
+    g.metrics_started = perf_counter()
+    IN_FLIGHT.inc(_endpoint())
+
+
+def _note_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+def _finish_request(exc):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return
+
+    endpoint = _endpoint()
+    IN_FLIGHT.dec(endpoint)
+    LATENCY.observe(perf_counter() - started, endpoint, request.method)
+    REQUESTS.inc(endpoint, request.method, str(g.get('metrics_status', 500)))
+
+    stats = g.get('sql_stats')
+    QUERIES.observe(stats.count if stats else 0, endpoint)
+    if stats:
+        DB_SECONDS.inc(endpoint, amount=stats.total_ms / 1000)
+
+    directory = current_app.config.get('METRICS_DIR')
+    if directory:
+        REGISTRY.maybe_write(directory)
+
+
+def _template_started(sender, template, context, **extra):
+    g.setdefault('metrics_templates', []).append(perf_counter())
+
+
+def _template_finished(sender, template, context, **extra):
+    started = g.get('metrics_templates')
+    if started:
+        RENDER.observe(perf_counter() - started.pop(), template.name or 'string')
+
+
+def metrics():
+    """Prometheus text exposition; 404 unless METRICS_ENABLED is set."""
+
+    if not current_app.config.get('METRICS_ENABLED'):
+        abort(404)
+
+    body = REGISTRY.render(current_app.config.get('METRICS_DIR'))
+    return current_app.response_class(body, content_type=CONTENT_TYPE)
+
+
+def init_app(app):
+    """Instrument every request and serve `/metrics`.
+
+    Call before registering other request hooks, so requests they answer
+    early are still counted.
+    """
+
+    app.before_request(_start_request)
+    app.after_request(_note_status)
+    app.teardown_request(_finish_request)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_finished, app)
+    app.add_url_rule('/metrics', 'metrics', metrics)
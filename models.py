@@ -2,11 +2,49 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from flask import g, has_app_context, has_request_context
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import DDL, event, orm
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql.expression import TextClause, UpdateBase
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+import dbpool
+import dbstats
+import passwords
+
+
+class RoutingSession(SignallingSession):
+    """A session that sends a read-only view's queries to a replica.
+
+    replicas.py decides whether a request may read from a replica
+    (`g.db_route`) and which one. Flushes, INSERT/UPDATE/DELETE and raw SQL
+    always go to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if (has_request_context() and g.get('db_route') == 'replica'
+                and not self._flushing
+                and not isinstance(clause, (UpdateBase, TextClause))):
+            replicas = self.app.extensions.get('db_replicas')
+            replica = replicas and replicas.current()
+            if replica is not None:
+                return replica.engine
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        # Pool sizing and telemetry; see dbpool.py.
+        rv = super().apply_driver_hacks(app, sa_url, options)
+        options.update(dbpool.engine_options(app, sa_url))
+        return rv
+
+
+db = RoutingSQLAlchemy()
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -31,6 +69,10 @@ class Likes(db.Model):
 
     __tablename__ = 'likes' 
 
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id', name='uq_likes_user_message'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True
@@ -93,6 +135,36 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized stats, maintained by counters.py
+
+    message_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    follower_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -120,23 +192,34 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.is_following(self)
 
     def is_following(self, other_user):
-        """Is this user following `other_user`?"""
+        """Is this user following `other_user`?
+
+        Uses the request's viewer context (see viewer.py) when this user is
+        the one logged in; otherwise asks the database with a single EXISTS.
+        """
+
+        viewer = g.get('viewer') if has_app_context() else None
+        if viewer is not None and viewer.user_id == self.id:
+            return viewer.is_following(other_user)
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.query(
+            db.exists()
+            .where(Follows.user_following_id == self.id)
+            .where(Follows.user_being_followed_id == other_user.id)
+        ).scalar()
 
     @classmethod
     def signup(cls, username, email, password, image_url, header_image_url):
         """Sign up user.
 
-        Hashes password and adds user to system.
+        Hashes password and adds user to system. Raises
+        passwords.PasswordHasherBusy if the hashing queue is full.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash_password(password, username=username)
 
         user = User(
             username=username,
@@ -159,18 +242,43 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the user's hash was made with an outdated bcrypt cost, it is
+        replaced; the caller commits. Raises passwords.PasswordHasherBusy if
+        the hashing queue is full.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = passwords.check_password(user.password, password,
+                                               username=username)
             if is_auth:
+                if passwords.needs_rehash(user.password):
+                    user.password = passwords.hash_password(password,
+                                                            username=username)
                 return user
 
         return False
 
 
+# The default /users listing: most followed first.
+db.Index('ix_users_follower_count', User.follower_count.desc(), User.id)
+
+# Trigram indexes for case-insensitive substring search on Postgres
+# (see user_search.py); other databases search an in-process index.
+event.listen(
+    User.__table__,
+    'after_create',
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm;"
+        "CREATE INDEX ix_users_username_trgm ON users"
+        " USING gin (lower(username) gin_trgm_ops);"
+        "CREATE INDEX ix_users_bio_trgm ON users"
+        " USING gin (lower(coalesce(bio, '')) gin_trgm_ops);")
+    .execute_if(dialect='postgresql'),
+)
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
@@ -198,11 +306,149 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Denormalized, maintained by message_likes.py
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
     def __repr__(self):
         return f"<Message #{self.id}, {self.text}, {self.timestamp}, {self.user_id}>"
 
+
+# Full-text search on Postgres (see message_search.py): a generated tsvector
+# column Postgres keeps in sync itself, with a GIN index.
+# Idempotent, so `flask rebuild-search-index` can add both to an existing
+# database.
+SEARCH_VECTOR_DDL = (
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector"
+    " GENERATED ALWAYS AS (to_tsvector('english', text)) STORED;"
+    "CREATE INDEX IF NOT EXISTS ix_messages_search_vector ON messages"
+    " USING gin (search_vector);")
+
+event.listen(
+    Message.__table__,
+    'after_create',
+    DDL(SEARCH_VECTOR_DDL).execute_if(dialect='postgresql'),
+)
+
+# Serves profile pages: one user's messages, newest first, paged by cursor.
+db.Index(
+    'ix_messages_user_timestamp',
+    Message.user_id,
+    Message.timestamp.desc(),
+    Message.id.desc(),
+)
+
+
+class TimelineEntry(db.Model):
+    """A message materialized onto one user's home timeline.
+
+    Rows are written when a message is posted (fan-out on write), so the
+    home feed is a range scan over `(owner_id, timestamp)` instead of a
+    query over every account the owner follows. See timeline.py.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    owner_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+        index=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+        index=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+db.Index(
+    'ix_timeline_entries_owner_timestamp',
+    TimelineEntry.owner_id,
+    TimelineEntry.timestamp.desc(),
+    TimelineEntry.message_id.desc(),
+)
+
+
+def insert_ignoring_duplicates(table, rows, index_elements):
+    """An INSERT of `rows` into `table` that skips rows violating the
+    unique constraint on `index_elements` instead of failing.
+
+    The statement's rowcount is the number of rows actually inserted.
+    """
+
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+        return (postgresql.insert(table)
+                .values(rows)
+                .on_conflict_do_nothing(index_elements=index_elements))
+
+    if dialect == 'sqlite':
+        return table.insert().values(rows).prefix_with('OR IGNORE')
+
+    return table.insert().values(rows)
+
+
+def insert_returning(table, rows, index_elements, key):
+    """Insert `rows` like `insert_ignoring_duplicates`; return the `key`
+    values of the rows actually inserted.
+
+    One `INSERT ... RETURNING` on Postgres; elsewhere one INSERT per row,
+    judged by its rowcount.
+    """
+
+    if db.engine.dialect.name == 'postgresql':
+        statement = (insert_ignoring_duplicates(table, rows, index_elements)
+                     .returning(table.c[key]))
+        return {value for (value,) in db.session.execute(statement)}
+
+    return {row[key] for row in rows
+            if db.session.execute(
+                insert_ignoring_duplicates(table, [row], index_elements)).rowcount}
+
+
+def delete_returning(table, condition, key, values):
+    """Delete the rows of `table` matching `condition` whose `key` is in
+    `values`; return the `key` values of the rows actually deleted.
+
+    One `DELETE ... RETURNING` on Postgres; elsewhere one DELETE per value,
+    judged by its rowcount.
+    """
+
+    column = table.c[key]
+    if db.engine.dialect.name == 'postgresql':
+        statement = (table.delete()
+                     .where(condition)
+                     .where(column.in_(values))
+                     .returning(column))
+        return {value for (value,) in db.session.execute(statement)}
+
+    return {value for value in values
+            if db.session.execute(table.delete()
+                                  .where(condition)
+                                  .where(column == value)).rowcount}
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -211,3 +457,4 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    dbstats.init_app(app)
@@ -0,0 +1,148 @@
+"""Keyset (cursor) pagination for message lists.
+
+Pages are ordered newest first by `(timestamp, id)`. Instead of an OFFSET,
+each page hands out an opaque `before` cursor naming the last message shown;
+the next page starts strictly after it. Every page is the same index range
+scan no matter how far back the reader has gone.
+
+`stream()` reads a page from a server-side cursor instead, a batch of
+`STREAM_BATCH_SIZE` rows at a time, for pages rendered as they're read
+(see streaming.py).
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from flask import abort, current_app, request
+from sqlalchemy import and_, or_
+
+DEFAULT_PER_PAGE = 100
+STREAM_BATCH_SIZE = 25
+
+CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(timestamp, id):
+    """Encode a `(timestamp, id)` position as an opaque, URL-safe token."""
+
+    raw = f"{timestamp.strftime(CURSOR_FORMAT)}|{id}"
+    return urlsafe_b64encode(raw.encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Decode a token made by `encode_cursor`.
+
+    Raises ValueError if the token is malformed.
+    """
+
+    raw = urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('ascii')
+    timestamp, id = raw.split('|')
+    return datetime.strptime(timestamp, CURSOR_FORMAT), int(id)
+
+
+def cursor_from_request():
+    """Return the decoded `?before=` cursor, or None for the first page."""
+
+    token = request.args.get('before')
+    if not token:
+        return None
+
+    try:
+        return decode_cursor(token)
+    except ValueError:
+        abort(400)
+
+
+def per_page():
+    """Number of messages on one page (the `MESSAGES_PER_PAGE` setting)."""
+
+    return current_app.config.get('MESSAGES_PER_PAGE', DEFAULT_PER_PAGE)
+
+
+def keyset_filter(query, timestamp_col, id_col, before):
+    """Restrict `query` to rows older than the `before` cursor."""
+
+    if before is None:
+        return query
+
+    timestamp, id = before
+
+    # The redundant `<=` lets the planner use it as an index range bound.
+    return query.filter(and_(
+        timestamp_col <= timestamp,
+        or_(timestamp_col < timestamp, id_col < id),
+    ))
+
+
+def split_page(items, size):
+    """Split `size + 1` fetched items into `(page, next_cursor)`."""
+
+    if len(items) <= size:
+        return items, None
+
+    page = items[:size]
+    last = page[-1]
+    return page, encode_cursor(last.timestamp, last.id)
+
+
+def paginate(query, timestamp_col, id_col, before=None, size=None):
+    """Return one page of `query` and the cursor for the next page.
+
+    `timestamp_col`/`id_col` are the columns the page is ordered by; the
+    returned items must expose them as `.timestamp` and `.id`.
+    """
+
+    size = size or per_page()
+
+    items = (keyset_filter(query, timestamp_col, id_col, before)
+             .order_by(timestamp_col.desc(), id_col.desc())
+             .limit(size + 1)
+             .all())
+
+    return split_page(items, size)
+
+
+class Page(list):
+    """A page of items, with the cursor for the next page (or None)."""
+
+    def __init__(self, items, next_cursor=None):
+        super().__init__(items)
+        self.next_cursor = next_cursor
+
+
+class StreamedPage:
+    """A page of items read from `rows` (`size + 1` of them) as it's iterated.
+
+    Iterate it once; `next_cursor` is only known after that.
+    """
+
+    def __init__(self, rows, size):
+        self.rows = rows
+        self.size = size
+        self.next_cursor = None
+
+    def __iter__(self):
+        last = None
+        for count, item in enumerate(self.rows):
+            if count == self.size:
+                self.next_cursor = encode_cursor(last.timestamp, last.id)
+                break
+            last = item
+            yield item
+
+
+def stream(query, timestamp_col, id_col, before=None, size=None):
+    """Like `paginate`, but return a `StreamedPage` read with `yield_per`.
+
+    Nothing is queried until the page is iterated. Eager loads in `query`
+    must be joined, not "selectin".
+    """
+
+    size = size or per_page()
+
+    rows = (keyset_filter(query, timestamp_col, id_col, before)
+            .order_by(timestamp_col.desc(), id_col.desc())
+            .limit(size + 1)
+            .yield_per(STREAM_BATCH_SIZE))
+
+    return StreamedPage(rows, size)
@@ -0,0 +1,218 @@
+"""Password hashing off the request thread.
+
+bcrypt is deliberately slow: at cost 12 a single hash or check takes a few
+hundred milliseconds of CPU. Done inline, a burst of logins ties up every
+worker thread. Instead, hashes and checks run in a small process pool
+(`PASSWORD_HASH_WORKERS`; 0 runs them inline), behind
+
+- a bounded queue (`PASSWORD_HASH_MAX_QUEUE` jobs waiting or running), and
+- a per-client limit (`PASSWORD_HASH_PER_CLIENT` concurrent jobs for any one
+  IP address or username),
+
+both of which fail fast with `PasswordHasherBusy` rather than queueing
+without limit. A job that takes longer than the timeout fails with
+`PasswordHasherTimeout` (also a `PasswordHasherBusy`); if it's already
+running it keeps its place in the queue until it finishes, so the queue
+bounds the work the pool actually has. The bcrypt cost is
+`BCRYPT_LOG_ROUNDS`; hashes made with a different cost are upgraded on the
+next successful login (see `User.authenticate`).
+
+The IP address is `request.remote_addr`. Behind a reverse proxy that is the
+proxy's address, shared by every client, unless `TRUSTED_PROXY_HOPS` is set
+to the number of proxies in front of the app (see app.py), so that it's
+taken from `X-Forwarded-For` instead.
+"""
+
+import multiprocessing
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from time import perf_counter
+
+import bcrypt
+from flask import current_app, has_app_context, has_request_context, request
+
+import metrics
+
+DEFAULT_ROUNDS = 12
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_QUEUE = 32
+DEFAULT_PER_CLIENT = 2
+DEFAULT_TIMEOUT = 10
+
+
+class PasswordHasherBusy(Exception):
+    """The hashing queue, or this client's share of it, is full."""
+
+
+class PasswordHasherTimeout(PasswordHasherBusy):
+    """A job didn't finish in time."""
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'),
+                         bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(pw_hash, password):
+    return bcrypt.checkpw(password.encode('utf-8'), pw_hash.encode('utf-8'))
+
+
+def hash_rounds(pw_hash):
+    """The cost factor a bcrypt hash was made with."""
+
+    return int(pw_hash.split('$')[2])
+
+
+class PasswordHasher:
+    """Runs bcrypt jobs in a process pool with bounded concurrency."""
+
+    def __init__(self, rounds=DEFAULT_ROUNDS, workers=DEFAULT_WORKERS,
+                 max_queue=DEFAULT_MAX_QUEUE, per_client=DEFAULT_PER_CLIENT,
+                 timeout=DEFAULT_TIMEOUT):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_queue = max_queue
+        self.per_client = per_client
+        self.timeout = timeout
+
+        self._executor = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._by_client = Counter()
+        self._stats = Counter()
+
+    @property
+    def executor(self):
+        if self._executor is None and self.workers:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(
+                        self.workers,
+                        mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def _acquire(self, clients):
+        with self._lock:
+            if self._in_flight >= self.max_queue:
+                self._stats['rejected'] += 1
+                raise PasswordHasherBusy("Password hashing queue is full")
+
+            if any(self._by_client[client] >= self.per_client for client in clients):
+                self._stats['rejected'] += 1
+                raise PasswordHasherBusy("Too many concurrent attempts")
+
+            self._in_flight += 1
+            self._by_client.update(clients)
+
+    def _release(self, clients):
+        with self._lock:
+            self._in_flight -= 1
+            self._by_client.subtract(clients)
+            for client in clients:
+                if self._by_client[client] <= 0:
+                    del self._by_client[client]
+
+    def _run(self, kind, clients, fn, *args):
+        self._acquire(clients)
+        start = perf_counter()
+        release = True
+        try:
+            if self.executor is None:
+                return fn(*args)
+
+            future = self.executor.submit(fn, *args)
+            try:
+                return future.result(self.timeout)
+            except FutureTimeout:
+                if not future.cancel():
+                    # Still running: hold its slots until it's done.
+                    release = False
+                    future.add_done_callback(lambda future: self._release(clients))
+                with self._lock:
+                    self._stats['timeouts'] += 1
+                raise PasswordHasherTimeout("Password hashing timed out")
+        finally:
+            if release:
+                self._release(clients)
+            elapsed = perf_counter() - start
+            with self._lock:
+                self._stats[kind] += 1
+                self._stats[f"{kind}_seconds"] += elapsed
+            metrics.observe_bcrypt(kind, elapsed)
+
+    def hash(self, password, clients=()):
+        """Return a bcrypt hash of `password` at the configured cost."""
+
+        if not password:
+            raise ValueError("Password must be non-empty.")
+
+        return self._run('hash', clients, _hash, password, self.rounds)
+
+    def check(self, pw_hash, password, clients=()):
+        """Does `password` match `pw_hash`?"""
+
+        return self._run('check', clients, _check, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """Was `pw_hash` made with a different cost than the configured one?"""
+
+        return hash_rounds(pw_hash) != self.rounds
+
+    def stats(self):
+        """Queue depth, job counts and total seconds spent per job kind."""
+
+        with self._lock:
+            return dict(self._stats,
+                        queue_depth=self._in_flight,
+                        max_queue=self.max_queue,
+                        workers=self.workers)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+# Used outside an app context (scripts, model tests): hashes inline.
+default_hasher = PasswordHasher(workers=0)
+
+
+def init_app(app):
+    """Create the app's password hasher from its config."""
+
+    app.extensions['password_hasher'] = PasswordHasher(
+        rounds=app.config.get('BCRYPT_LOG_ROUNDS', DEFAULT_ROUNDS),
+        workers=app.config.get('PASSWORD_HASH_WORKERS', DEFAULT_WORKERS),
+        max_queue=app.config.get('PASSWORD_HASH_MAX_QUEUE', DEFAULT_MAX_QUEUE),
+        per_client=app.config.get('PASSWORD_HASH_PER_CLIENT', DEFAULT_PER_CLIENT),
+    )
+
+
+def get_hasher():
+    if has_app_context():
+        return current_app.extensions.get('password_hasher', default_hasher)
+    return default_hasher
+
+
+def _clients(username):
+    """The keys a job counts against for the per-client limit."""
+
+    clients = []
+    if has_request_context() and request.remote_addr:
+        clients.append(f"ip:{request.remote_addr}")
+    if username:
+        clients.append(f"user:{username}")
+    return clients
+
+
+def hash_password(password, username=None):
+    return get_hasher().hash(password, _clients(username))
+
+
+def check_password(pw_hash, password, username=None):
+    return get_hasher().check(pw_hash, password, _clients(username))
+
+
+def needs_rehash(pw_hash):
+    return get_hasher().needs_rehash(pw_hash)
@@ -0,0 +1,53 @@
+"""Count the SQL statements a block of code runs.
+
+Used by the test suite to hold pages to a query budget:
+
+    class MyTests(QueryBudgetMixin, TestCase):
+        def test_home(self):
+            with self.assertMaxQueries(6):
+                self.client.get("/")
+"""
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from models import db
+
+
+class QueryCounter:
+    """Context manager recording every statement run on `db.engine`."""
+
+    def __init__(self, engine=None):
+        self.engine = engine or db.engine
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+class QueryBudgetMixin:
+    """TestCase mixin adding `assertMaxQueries`."""
+
+    @contextmanager
+    def assertMaxQueries(self, budget):
+        """Fail if the block runs more than `budget` SQL statements."""
+
+        with QueryCounter() as counter:
+            yield counter
+
+        if counter.count > budget:
+            statements = "\n\n".join(counter.statements)
+            self.fail(f"{counter.count} queries run, budget was {budget}:\n\n"
+                      f"{statements}")
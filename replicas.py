@@ -0,0 +1,196 @@
+"""Read replicas.
+
+With `DATABASE_REPLICA_URLS` set (comma-separated, each optionally
+`url|weight`), views decorated with `read_only` run their queries on a
+replica, chosen per request by smooth weighted round-robin. Everything else
+stays on the primary (`SQLALCHEMY_DATABASE_URI`):
+
+- every other view, and non-GET requests to read-only views;
+- flushes, INSERT/UPDATE/DELETE and raw SQL, even inside a read-only view
+  (see `RoutingSession` in models.py);
+- for `READ_YOUR_WRITES_SECONDS` after the client's last successful write
+  request, so a redirect after posting shows the post even if the replicas
+  haven't caught up yet.
+
+A replica that fails to connect is taken out of rotation for
+`REPLICA_RETRY_AFTER` seconds, then probed with `SELECT 1` before it's used
+again. A read-only view whose replica fails mid-request is re-run on the
+primary.
+"""
+
+import threading
+from functools import wraps
+from time import monotonic, time
+
+from flask import current_app, g, request, session
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+import dbpool
+
+DEFAULT_RETRY_AFTER = 30
+DEFAULT_READ_YOUR_WRITES = 10
+
+PRIMARY_UNTIL_KEY = '_primary_until'
+SAFE_METHODS = ('GET', 'HEAD')
+
+
+class Replica:
+    """One replica database."""
+
+    def __init__(self, url, weight=1, **options):
+        self.url = url
+        self.weight = weight
+        self.engine = create_engine(url, **options)
+        self.current_weight = 0
+        self.down_until = None
+        self.picks = 0
+
+    def probe(self):
+        try:
+            with self.engine.connect() as conn:
+                conn.execute(select([1]))
+        except DBAPIError:
+            return False
+        return True
+
+
+class ReplicaSet:
+    """The app's replicas, with health tracking and weighted round-robin."""
+
+    def __init__(self, replicas, retry_after=DEFAULT_RETRY_AFTER):
+        self.replicas = replicas
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+
+        for replica in replicas:
+            self._watch(replica)
+
+    def _watch(self, replica):
+        def on_error(context):
+            if context.is_disconnect or isinstance(context.sqlalchemy_exception,
+                                                   OperationalError):
+                self.mark_down(replica)
+
+        event.listen(replica.engine, 'handle_error', on_error)
+
+    def mark_down(self, replica):
+        with self._lock:
+            replica.down_until = monotonic() + self.retry_after
+
+    def _recover(self):
+        """Probe replicas whose time out of rotation is up."""
+
+        now = monotonic()
+        with self._lock:
+            due = [r for r in self.replicas
+                   if r.down_until is not None and r.down_until <= now]
+            # Claim them, so only this thread probes.
+            for replica in due:
+                replica.down_until = now + self.retry_after
+
+        for replica in due:
+            if replica.probe():
+                with self._lock:
+                    replica.down_until = None
+
+    def pick(self):
+        """The next healthy replica, or None if there isn't one."""
+
+        self._recover()
+        with self._lock:
+            healthy = [r for r in self.replicas if r.down_until is None]
+            if not healthy:
+                return None
+
+            for replica in healthy:
+                replica.current_weight += replica.weight
+            best = max(healthy, key=lambda r: r.current_weight)
+            best.current_weight -= sum(r.weight for r in healthy)
+            best.picks += 1
+            return best
+
+    def current(self):
+        """This request's replica, picked on first use."""
+
+        if 'db_replica' not in g:
+            g.db_replica = self.pick()
+        return g.db_replica
+
+    def stats(self):
+        with self._lock:
+            return [{'url': repr(r.engine.url),
+                     'weight': r.weight,
+                     'healthy': r.down_until is None,
+                     'picks': r.picks}
+                    for r in self.replicas]
+
+
+def get_replicas():
+    return current_app.extensions.get('db_replicas')
+
+
+def get_stats():
+    replicas = get_replicas()
+    return replicas.stats() if replicas else []
+
+
+def _may_use_replica():
+    return (get_replicas() is not None
+            and request.method in SAFE_METHODS
+            and session.get(PRIMARY_UNTIL_KEY, 0) <= time())
+
+
+def read_only(view):
+    """Run `view`'s queries on a replica when the request allows it."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not _may_use_replica():
+            return view(*args, **kwargs)
+
+        g.db_route = 'replica'
+        try:
+            return view(*args, **kwargs)
+        except OperationalError:
+            if g.get('db_replica') is None:
+                raise
+
+        # The replica failed (and is now out of rotation): start over on the primary.
+        current_app.extensions['sqlalchemy'].db.session.rollback()
+        g.db_route = 'primary'
+        g.db_replica = None
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def _stick_to_primary(response):
+    if (get_replicas() is not None and request.method not in SAFE_METHODS
+            and response.status_code < 400):
+        session[PRIMARY_UNTIL_KEY] = time() + current_app.config.get(
+            'READ_YOUR_WRITES_SECONDS', DEFAULT_READ_YOUR_WRITES)
+    return response
+
+
+def parse_url(entry):
+    """`url|weight` -> (url, weight)."""
+
+    url, _, weight = entry.strip().partition('|')
+    return url, int(weight or 1)
+
+
+def init_app(app):
+    """Connect the replicas in `SQLALCHEMY_REPLICA_URIS`, if any."""
+
+    replicas = []
+    for entry in app.config.get('SQLALCHEMY_REPLICA_URIS') or []:
+        url, weight = parse_url(entry)
+        replicas.append(Replica(url, weight, **dbpool.engine_options(app, make_url(url))))
+
+    app.extensions['db_replicas'] = (
+        ReplicaSet(replicas,
+                   retry_after=app.config.get('REPLICA_RETRY_AFTER', DEFAULT_RETRY_AFTER))
+        if replicas else None)
+    app.after_request(_stick_to_primary)
@@ -1,20 +1,208 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+    python seed.py [--data-dir generator] [--chunk-size 10000]
 
+Drops and recreates every table, then streams `users.csv`, `messages.csv`,
+`follows.csv` and (if present) `likes.csv` into them `--chunk-size` rows at
+a time, so memory stays flat however big the files are. On Postgres each
+chunk goes in with `COPY ... FROM STDIN`; elsewhere with an executemany
+`INSERT`. Secondary indexes and foreign keys are dropped for the load and
+rebuilt once at the end, which is far cheaper than maintaining them row by
+row. Each CSV's header row names the columns it fills.
+"""
 
-db.drop_all()
-db.create_all()
+import argparse
+import csv
+import io
+import os
+from contextlib import contextmanager
+from datetime import datetime
+from time import perf_counter
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+from sqlalchemy import DateTime, Integer, text
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+from app import app, db
+from models import User, Message, Follows, Likes
+import counters
+import timeline
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+DEFAULT_CHUNK_SIZE = 10000
 
-db.session.commit()
+# Load order matters once foreign keys are back: users before anything
+# that points at them.
+TABLES = [
+    ('users.csv', User.__table__),
+    ('messages.csv', Message.__table__),
+    ('follows.csv', Follows.__table__),
+    ('likes.csv', Likes.__table__),
+]
+
+
+def chunks(rows, size):
+    """Split an iterable of rows into lists of at most `size`."""
+
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def copy_chunk(connection, table, columns, rows):
+    """Load `rows` (lists of CSV strings) into `table` with Postgres' COPY."""
+
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        buf)
+
+
+def _converter(column):
+    """CSV string -> Python value for `column`; empty strings are NULL, as in COPY."""
+
+    if isinstance(column.type, DateTime):
+        convert = datetime.fromisoformat
+    elif isinstance(column.type, Integer):
+        convert = int
+    else:
+        convert = str
+    return lambda value: convert(value) if value != '' else None
+
+
+def insert_chunk(connection, table, columns, rows):
+    """Load `rows` into `table` with one executemany INSERT."""
+
+    converters = [_converter(table.c[column]) for column in columns]
+    connection.execute(table.insert(), [
+        {column: convert(value)
+         for column, convert, value in zip(columns, converters, row)}
+        for row in rows
+    ])
+
+
+def load_csv(connection, table, path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Stream the CSV at `path` into `table`; return the number of rows loaded."""
+
+    load_chunk = (copy_chunk if connection.dialect.name == 'postgresql'
+                  else insert_chunk)
+
+    loaded = 0
+    start = perf_counter()
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        columns = next(reader)
+        for chunk in chunks(reader, chunk_size):
+            load_chunk(connection, table, columns, chunk)
+            loaded += len(chunk)
+            report(table.name, loaded, start, end='\r')
+
+    report(table.name, loaded, start)
+    return loaded
+
+
+def report(label, rows, start, end='\n'):
+    elapsed = perf_counter() - start
+    rate = rows / elapsed if elapsed else 0
+    print(f"{label}: {rows:,} rows in {elapsed:.1f}s ({rate:,.0f} rows/s)", end=end, flush=True)
+
+
+def _deferrable(connection, tables):
+    """Return `(drops, creates)`: SQL to remove, then restore, the secondary
+    indexes and foreign keys of `tables`.
+
+    Primary keys and unique constraints stay in place; they guard the load.
+    """
+
+    names = [table.name for table in tables]
+
+    if connection.dialect.name == 'postgresql':
+        indexes = connection.execute(text(
+            "SELECT i.schemaname, i.indexname, i.indexdef FROM pg_indexes i"
+            " WHERE i.tablename = ANY(:names) AND NOT EXISTS ("
+            "  SELECT 1 FROM pg_constraint c"
+            "  WHERE c.conname = i.indexname AND c.contype IN ('p', 'u'))"),
+            names=names).fetchall()
+        foreign_keys = connection.execute(text(
+            "SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid)"
+            " FROM pg_constraint"
+            " WHERE contype = 'f' AND conrelid::regclass::text = ANY(:names)"),
+            names=names).fetchall()
+
+        drops = ([f'ALTER TABLE {table} DROP CONSTRAINT "{name}"'
+                  for table, name, _ in foreign_keys]
+                 + [f'DROP INDEX "{schema}"."{name}"' for schema, name, _ in indexes])
+        creates = ([definition for _, _, definition in indexes]
+                   + [f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}'
+                      for table, name, definition in foreign_keys])
+        return drops, creates
+
+    # SQLite: foreign keys are part of the table definition (and unenforced
+    # by default), so only indexes are deferred. Automatic indexes have no SQL.
+    placeholders = ', '.join(f':t{i}' for i in range(len(names)))
+    indexes = connection.execute(text(
+        "SELECT name, sql FROM sqlite_master"
+        f" WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({placeholders})"),
+        **{f't{i}': name for i, name in enumerate(names)}).fetchall()
+    return ([f'DROP INDEX "{name}"' for name, _ in indexes],
+            [sql for _, sql in indexes])
+
+
+@contextmanager
+def deferred_indexes(connection, tables):
+    """Drop the secondary indexes and foreign keys of `tables` for the
+    duration of the block and rebuild them afterwards."""
+
+    drops, creates = _deferrable(connection, tables)
+    for statement in drops:
+        connection.execute(text(statement))
+
+    yield
+
+    start = perf_counter()
+    for statement in creates:
+        connection.execute(text(statement))
+    print(f"rebuilt {len(creates)} indexes and constraints in {perf_counter() - start:.1f}s")
+
+
+def seed(data_dir='generator', chunk_size=DEFAULT_CHUNK_SIZE):
+    db.drop_all()
+    db.create_all()
+
+    tables = [(os.path.join(data_dir, filename), table)
+              for filename, table in TABLES
+              if os.path.exists(os.path.join(data_dir, filename))]
+
+    start = perf_counter()
+    total = 0
+    with db.engine.begin() as connection:
+        with deferred_indexes(connection, [table for _, table in tables]):
+            for path, table in tables:
+                total += load_csv(connection, table, path, chunk_size)
+
+        if connection.dialect.name == 'postgresql':
+            connection.execute(text("ANALYZE"))
+
+    report('total', total, start)
+
+    counters.reconcile()
+    timeline.rebuild()
+    db.session.commit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-dir', default='generator',
+                        help="directory holding the CSV files")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="rows per COPY/INSERT batch")
+    args = parser.parse_args()
+
+    with app.app_context():
+        seed(args.data_dir, args.chunk_size)
@@ -1,5 +1,49 @@
 const BASE_URL = "http://127.0.0.1:5000"
 
+// Like clicks are queued and sent together to /api/batch once the user has
+// stopped clicking for BATCH_DELAY ms. Clicking the same message again before
+// then just changes its queued operation.
+const BATCH_DELAY = 300;
+
+const pendingLikes = new Map();
+let batchTimer = null;
+
+function queueLike(msgId, liked, onResult) {
+    pendingLikes.set(msgId, {liked, onResult});
+    clearTimeout(batchTimer);
+    batchTimer = setTimeout(sendBatch, BATCH_DELAY);
+}
+
+function sendBatch() {
+    const batch = new Map(pendingLikes);
+    pendingLikes.clear();
+
+    const operations = [...batch].map(([msgId, {liked}]) => ({
+        op: liked ? 'like' : 'unlike',
+        message_id: Number(msgId),
+    }));
+
+    fetch(`${BASE_URL}/api/batch`, {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({operations}),
+    }).then((res) => {
+        if (!res.ok) throw new Error(res.statusText);
+        return res.json();
+    }).then((data) => {
+        for (const result of data['results']) {
+            batch.get(String(result['message_id'])).onResult(result);
+        }
+    }).catch((e) => {
+        for (const {onResult} of batch.values()) onResult({ok: false});
+        alert('Could not like post.');
+    });
+}
+
+function setLikeButton(likeBtn, liked) {
+    likeBtn.className = liked ? "btn btn-sm btn-primary" : "btn btn-sm btn-secondary";
+}
+
 $(".messages-like").on("click", async function (evt) {
     evt.preventDefault();
   
@@ -8,15 +52,18 @@ $(".messages-like").on("click", async function (evt) {
 	const msgId = $closestLi.attr('id');
 
     const likeBtn = document.getElementById(`like-button-${msgId}`);
+    const wasLiked = likeBtn.classList.contains('btn-primary');
 
-    fetch(`${BASE_URL}/messages/${msgId}/like`, {method: 'GET', method: 'POST'}).then((res) => 
-    res.json()).then((data) => {
-        if (data['liked'] === true) {
-            likeBtn.className = "btn btn-sm btn-primary";
+    // Show the new state right away; the server's answer corrects it.
+    setLikeButton(likeBtn, !wasLiked);
+    queueLike(msgId, !wasLiked, (result) => {
+        if (result['ok']) {
+            setLikeButton(likeBtn, result['liked']);
+            $(likeBtn).find('.like-count').text(result['likes']);
         } else {
-            likeBtn.className = "btn btn-sm btn-secondary";
+            setLikeButton(likeBtn, wasLiked);
         }
-    }).catch((e) => alert('Could not like post.'));
+    });
   });
 
 $(".user-like").on("click", async function (evt) {
@@ -27,17 +74,16 @@ $(".user-like").on("click", async function (evt) {
 	const msgId = $closestLi.attr('id');
 
     const likeBtn = document.getElementById(`like-button-${msgId}`);
+    const wasLiked = likeBtn.classList.contains('btn-primary');
 
-    fetch(`${BASE_URL}/messages/${msgId}/like`, {method: 'GET', method: 'POST'}).then((res) => 
-    res.json()).then((data) => {
-        if (data['liked'] === true) {
-            likeBtn.className = "btn btn-sm btn-primary";
+    setLikeButton(likeBtn, !wasLiked);
+    queueLike(msgId, !wasLiked, (result) => {
+        if (!result['ok']) {
+            setLikeButton(likeBtn, wasLiked);
+        } else if (result['liked']) {
+            setLikeButton(likeBtn, true);
         } else {
-            // likeBtn.className = "btn btn-sm btn-secondary";
-            // $('[id="ID of element"]').remove(); 
             $(`#${msgId}`).remove()
         }
-    }).catch((e) => alert('Could not like post.'));
+    });
   });
-
-
@@ -0,0 +1,79 @@
+"""Streamed feed pages.
+
+With `STREAM_PAGES` set, the home feed and profile pages are sent while
+they're rendered instead of being built in memory first. Their messages
+come from a `pagination.StreamedPage`, read from a server-side cursor
+(`yield_per`) a batch at a time as the template loops over them, so the
+page shell and first messages reach the browser while the rest are still
+being fetched, and a page's rows are never all in memory at once.
+
+Rendered output is sent in chunks of about `CHUNK_BYTES`, and straight
+away wherever a template calls `{{ stream_flush() }}` (just before its
+message list, so the shell goes out before the message query runs).
+
+The status and headers are sent before the body is rendered, so a streamed
+page:
+
+- has no ETag (see http_cache.py): it's always sent in full;
+- isn't re-run on the primary if its replica fails partway through (see
+  replicas.py), and an error while rendering cuts the page short;
+- reports only the queries run before the first byte in `Server-Timing`.
+"""
+
+from flask import (Markup, before_render_template, current_app, g,
+                   stream_with_context, template_rendered)
+
+CHUNK_BYTES = 4096
+
+FLUSH_MARKER = '<!--flush-->'
+
+
+def enabled():
+    return bool(current_app.config.get('STREAM_PAGES'))
+
+
+def stream_flush():
+    """Template global: send what's rendered so far, when streaming."""
+
+    return Markup(FLUSH_MARKER) if g.get('streaming') else ''
+
+
+def chunks(pieces, size=CHUNK_BYTES):
+    """Join template output into chunks of about `size` characters, split at flush markers."""
+
+    buffer, buffered = [], 0
+    for piece in pieces:
+        flush = FLUSH_MARKER in piece
+        if flush:
+            piece = piece.replace(FLUSH_MARKER, '')
+        buffer.append(piece)
+        buffered += len(piece)
+
+        if buffered and (flush or buffered >= size):
+            yield ''.join(buffer)
+            buffer, buffered = [], 0
+
+    if buffered:
+        yield ''.join(buffer)
+
+
+def render(template_name, **context):
+    """Like `render_template`, but return a response streaming the page."""
+
+    app = current_app._get_current_object()
+    template = app.jinja_env.get_template(template_name)
+    app.update_template_context(context)
+    g.streaming = True
+
+    def generate():
+        before_render_template.send(app, template=template, context=context)
+        yield from chunks(template.generate(context))
+        template_rendered.send(app, template=template, context=context)
+
+    return app.response_class(stream_with_context(generate()), mimetype='text/html')
+
+
+def init_app(app):
+    """Make `stream_flush()` available to templates."""
+
+    app.jinja_env.globals['stream_flush'] = stream_flush
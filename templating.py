@@ -0,0 +1,167 @@
+"""Precompiled templates and template render profiling.
+
+Jinja compiles each template to Python the first time a worker renders it.
+With a bytecode cache (`TEMPLATE_BYTECODE_DIR`, shared by every worker) the
+compiled code is kept on disk, keyed by the template's source checksum, and
+`flask compile-templates` fills it ahead of a deploy. At startup
+(`TEMPLATE_PRELOAD`) every template is loaded from that cache, so a fresh
+worker's first requests don't pay for compiling.
+
+With `TEMPLATE_PROFILING` set, every template and block rendered in a
+request is timed, both in total and excluding the templates and blocks it
+renders itself ("self" time). The slowest appear in the response's
+`Server-Timing` header next to the SQL time from dbstats.py, and all of
+them in a `warbler.templates` log line. Macros (such as the cached cards in
+fragments.py) count towards whatever calls them.
+"""
+
+import logging
+import os
+import tempfile
+from time import perf_counter
+
+from flask import g, has_request_context, request
+from jinja2 import FileSystemBytecodeCache, Template
+
+SERVER_TIMING_ENTRIES = 10
+
+logger = logging.getLogger('warbler.templates')
+
+
+class BytecodeCache(FileSystemBytecodeCache):
+    """A `FileSystemBytecodeCache` that several processes can share.
+
+    Files are written to a temporary name and renamed into place, so a
+    worker never reads one half-written; unreadable files just recompile.
+    """
+
+    def load_bytecode(self, bucket):
+        try:
+            super().load_bytecode(bucket)
+        except (EOFError, ValueError, TypeError):
+            bucket.reset()
+
+    def dump_bytecode(self, bucket):
+        fd, temp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.replace(temp, self._get_cache_filename(bucket))
+        except OSError:
+            os.unlink(temp)
+
+
+def app_templates(app):
+    """Names of the app's own templates (not extensions')."""
+
+    return sorted(app.jinja_loader.list_templates())
+
+
+def compile_all(app):
+    """Load every app template, compiling any the bytecode cache lacks; return their names."""
+
+    names = app_templates(app)
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
+
+
+class TemplateProfile:
+    """Render times for one request, by template and block."""
+
+    def __init__(self):
+        self.timings = {}
+        self._stack = []
+
+    def start(self):
+        self._stack.append(0.0)
+        return perf_counter()
+
+    def finish(self, label, started):
+        elapsed = perf_counter() - started
+        children = self._stack.pop()
+        if self._stack:
+            self._stack[-1] += elapsed
+
+        count, total, own = self.timings.get(label, (0, 0.0, 0.0))
+        self.timings[label] = (count + 1, total + elapsed, own + elapsed - children)
+
+    def slowest(self):
+        """(label, count, total ms, self ms), most self time first."""
+
+        return sorted(((label, count, total * 1000, own * 1000)
+                       for label, (count, total, own) in self.timings.items()),
+                      key=lambda timing: timing[3], reverse=True)
+
+
+def _timed(label, render):
+    def render_timed(context):
+        if not has_request_context():
+            yield from render(context)
+            return
+
+        if 'template_profile' not in g:
+            g.template_profile = TemplateProfile()
+        profile = g.template_profile
+
+        started = profile.start()
+        try:
+            yield from render(context)
+        finally:
+            profile.finish(label, started)
+
+    return render_timed
+
+
+class ProfiledTemplate(Template):
+    """A template whose body and blocks record their render time."""
+
+    @classmethod
+    def _from_namespace(cls, environment, namespace, globals):
+        template = super()._from_namespace(environment, namespace, globals)
+        name = template.name or 'string'
+        template.root_render_func = _timed(name, template.root_render_func)
+        template.blocks = {block: _timed(f"{name}#{block}", render)
+                           for block, render in template.blocks.items()}
+        return template
+
+
+def enable_profiling(app):
+    """Time templates from now on (templates already loaded are reloaded)."""
+
+    app.jinja_env.template_class = ProfiledTemplate
+    if app.jinja_env.cache is not None:
+        app.jinja_env.cache.clear()
+
+
+def _server_timing(response):
+    profile = g.get('template_profile')
+    if profile is not None:
+        for label, count, total_ms, self_ms in profile.slowest()[:SERVER_TIMING_ENTRIES]:
+            response.headers.add('Server-Timing', f'tpl;dur={self_ms:.1f};desc="{label}"')
+    return response
+
+
+def _log_profile(exc):
+    profile = g.pop('template_profile', None)
+    if profile is not None:
+        logger.info("path=%s templates=%s", request.path,
+                    [f"{label} x{count} {total_ms:.1f}ms (self {self_ms:.1f}ms)"
+                     for label, count, total_ms, self_ms in profile.slowest()])
+
+
+def init_app(app):
+    """Set up the bytecode cache, preload templates and, if configured, profiling."""
+
+    directory = app.config.get('TEMPLATE_BYTECODE_DIR') or os.path.join(
+        app.instance_path, 'jinja-bytecode')
+    os.makedirs(directory, exist_ok=True)
+    app.jinja_env.bytecode_cache = BytecodeCache(directory)
+
+    if app.config.get('TEMPLATE_PROFILING'):
+        enable_profiling(app)
+    app.after_request(_server_timing)
+    app.teardown_request(_log_profile)
+
+    if app.config.get('TEMPLATE_PRELOAD'):
+        compile_all(app)
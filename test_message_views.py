@@ -5,10 +5,30 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
+import gzip
+import io
 import os
+import shutil
+import tempfile
+import zlib
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+import jinja2
+from bs4 import BeautifulSoup
+
+from models import db, connect_db, Message, User, TimelineEntry
+from querycount import QueryBudgetMixin
+import assets
+import compression
+import image_proxy
+import message_search
+import templating
+import timeline
+
+try:
+    import PIL
+except ImportError:
+    PIL = None
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -33,7 +53,7 @@ db.create_all()
 app.config['WTF_CSRF_ENABLED'] = False
 
 
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(QueryBudgetMixin, TestCase):
     """Test views for messages."""
 
     def setUp(self):
@@ -45,6 +65,11 @@ class MessageViewTestCase(TestCase):
         db.drop_all() 
         db.create_all() 
 
+        # users are recreated for every test, so forget cached identities
+        # and fragments
+        app.extensions['identity_cache'].local.clear()
+        app.extensions['fragment_cache'].local.clear()
+
         self.client = app.test_client()
 
         self.testuser = User.signup(username="testuser",
@@ -143,4 +168,563 @@ class MessageViewTestCase(TestCase):
 
             
 
-            
\ No newline at end of file
+    def test_new_message_in_follower_timeline(self):
+        """Does a new message show up on the home page of the author's followers?"""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="follower",
+                               image_url=None,
+                               header_image_url=None)
+        db.session.commit()
+        follower_id = follower.id
+        author_id = self.testuser.id
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = follower_id
+
+            client.post(f"/users/follow/{author_id}")
+
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = author_id
+
+            client.post("/messages/new", data={"text": "Fanned out"})
+
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = follower_id
+
+            response = client.get("/")
+            self.assertIn("Fanned out", str(response.data))
+
+            entries = TimelineEntry.query.filter_by(owner_id=follower_id).all()
+            self.assertEqual(len(entries), 1)
+
+    def test_follow_backfills_timeline(self):
+        """Does following several users at once backfill each one's latest messages?"""
+
+        authors = []
+        for name in ("alice", "bob"):
+            author = User.signup(username=name,
+                                 email=f"{name}@test.com",
+                                 password=name,
+                                 image_url=None,
+                                 header_image_url=None)
+            db.session.flush()
+            for i in range(3):
+                db.session.add(Message(text=f"{name} {i}", user_id=author.id))
+            authors.append(author.id)
+        db.session.commit()
+        follower_id = self.testuser.id
+
+        app.config['TIMELINE_BACKFILL'] = 2
+        try:
+            with self.client as client:
+                with client.session_transaction() as session:
+                    session[CURR_USER_KEY] = follower_id
+                client.post("/api/batch", json={'operations': [
+                    {'op': 'follow', 'user_id': author_id} for author_id in authors]})
+        finally:
+            del app.config['TIMELINE_BACKFILL']
+
+        entries = TimelineEntry.query.filter_by(owner_id=follower_id).all()
+        latest = [(author_id, msg.id)
+                  for author_id in authors
+                  for msg in (Message.query
+                              .filter_by(user_id=author_id)
+                              .order_by(Message.timestamp.desc(), Message.id.desc())
+                              .limit(2))]
+        self.assertEqual(sorted((entry.author_id, entry.message_id) for entry in entries),
+                         sorted(latest))
+
+    def test_author_back_under_fanout_limit(self):
+        """Do messages posted while an author was pulled reach feeds once they're pushed again?"""
+
+        followers = []
+        for name in ("alice", "bob"):
+            follower = User.signup(username=name,
+                                   email=f"{name}@test.com",
+                                   password=name,
+                                   image_url=None,
+                                   header_image_url=None)
+            db.session.flush()
+            followers.append(follower.id)
+        db.session.commit()
+        author_id = self.testuser.id
+        alice_id, bob_id = followers
+
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        try:
+            with self.client as client:
+                for follower_id in followers:
+                    with client.session_transaction() as session:
+                        session[CURR_USER_KEY] = follower_id
+                    client.post(f"/users/follow/{author_id}")
+
+                with client.session_transaction() as session:
+                    session[CURR_USER_KEY] = author_id
+                client.post("/messages/new", data={"text": "Posted while pulled"})
+                self.assertEqual(TimelineEntry.query.filter_by(owner_id=alice_id).count(), 0)
+
+                with client.session_transaction() as session:
+                    session[CURR_USER_KEY] = bob_id
+                client.post(f"/users/stop-following/{author_id}")
+
+                with client.session_transaction() as session:
+                    session[CURR_USER_KEY] = alice_id
+                response = client.get("/")
+                self.assertIn("Posted while pulled", str(response.data))
+                self.assertEqual(TimelineEntry.query.filter_by(owner_id=alice_id).count(), 1)
+        finally:
+            app.config['TIMELINE_FANOUT_LIMIT'] = timeline.DEFAULT_FANOUT_LIMIT
+
+        # An emptied timeline is restored by `flask rebuild-timelines`.
+        TimelineEntry.query.delete()
+        db.session.commit()
+        result = app.test_cli_runner().invoke(args=['rebuild-timelines'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(TimelineEntry.query.filter_by(owner_id=alice_id).count(), 1)
+
+    def test_unfollow_removes_from_timeline(self):
+        """Does unfollowing someone remove their messages from your home page?"""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="follower",
+                               image_url=None,
+                               header_image_url=None)
+        msg = Message(text="Soon gone", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+        follower_id = follower.id
+        author_id = self.testuser.id
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = follower_id
+
+            client.post(f"/users/follow/{author_id}")
+            response = client.get("/")
+            self.assertIn("Soon gone", str(response.data))
+
+            client.post(f"/users/stop-following/{author_id}")
+            response = client.get("/")
+            self.assertNotIn("Soon gone", str(response.data))
+
+    def test_home_page_query_budget(self):
+        """Does the home page load message authors without one query per card?"""
+
+        for i in range(10):
+            author = User(username=f"author{i}", email=f"author{i}@test.com",
+                          password="x")
+            db.session.add(author)
+            db.session.flush()
+            self.testuser.following.append(author)
+            db.session.add(Message(text=f"card {i}", user_id=author.id))
+        db.session.commit()
+        testuser_id = self.testuser.id
+
+        with app.app_context():
+            timeline.rebuild()
+            db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = testuser_id
+
+            with self.assertMaxQueries(6):
+                response = client.get("/")
+
+            self.assertIn("@author9", str(response.data))
+
+    def test_cached_identity(self):
+        """Once cached, does the logged-in user cost no queries on a simple page?"""
+
+        testuser_id = self.testuser.id
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = testuser_id
+
+            client.get("/messages/new")
+
+            with self.assertMaxQueries(0):
+                response = client.get("/messages/new")
+
+            self.assertIn('alt="testuser"', str(response.data))
+
+    def test_search_messages(self):
+        """Does /search find messages containing every query word, best first?"""
+
+        db.session.add_all([
+            Message(text="Birds are singing today", user_id=self.testuser.id),
+            Message(text="Birds birds birds singing", user_id=self.testuser.id),
+            Message(text="Nothing to see here", user_id=self.testuser.id),
+        ])
+        db.session.commit()
+
+        with self.client as client:
+            response = client.get("/search?q=singing+birds")
+            soup = BeautifulSoup(response.data, 'html.parser')
+            found = [p.text for p in soup.select("#messages p")]
+
+            self.assertEqual(found, ["Birds birds birds singing",
+                                     "Birds are singing today"])
+
+    def test_search_sees_new_messages(self):
+        """Are new and deleted messages reflected in search results?"""
+
+        testuser_id = self.testuser.id
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = testuser_id
+
+            client.get("/search?q=fresh")
+            client.post("/messages/new", data={"text": "Fresh warble"})
+
+            response = client.get("/search?q=fresh")
+            self.assertIn("Fresh warble", str(response.data))
+
+            msg = Message.query.filter_by(text="Fresh warble").one()
+            client.post(f"/messages/{msg.id}/delete")
+
+            response = client.get("/search?q=fresh")
+            self.assertNotIn("Fresh warble", str(response.data))
+
+    def test_search_serves_old_index_while_rebuilding(self):
+        """Do searches use the old index, not wait, while another request rebuilds it?"""
+
+        db.session.add(Message(text="Old warble", user_id=self.testuser.id))
+        db.session.commit()
+        self.client.get("/search?q=warble")
+
+        # Written behind the ORM's back, as another worker would.
+        db.session.execute(Message.__table__.insert().values(
+            text="New warble", user_id=self.testuser.id))
+        db.session.commit()
+
+        with message_search._rebuilding:
+            response = self.client.get("/search?q=warble")
+        self.assertIn("Old warble", str(response.data))
+        self.assertNotIn("New warble", str(response.data))
+
+        response = self.client.get("/search?q=warble")
+        self.assertIn("New warble", str(response.data))
+
+    def test_search_messages_pagination(self):
+        """Do search results page with a cursor?"""
+
+        app.config['MESSAGES_PER_PAGE'] = 2
+        try:
+            for i in range(3):
+                db.session.add(Message(text=f"warble number {i}", user_id=self.testuser.id))
+            db.session.commit()
+
+            with self.client as client:
+                response = client.get("/search?q=warble")
+                soup = BeautifulSoup(response.data, 'html.parser')
+                self.assertEqual(len(soup.select("#messages li")), 2)
+
+                more = soup.find("a", string="More results")
+                response = client.get(more["href"])
+                soup = BeautifulSoup(response.data, 'html.parser')
+                self.assertEqual(len(soup.select("#messages li")), 1)
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
+    def test_conditional_get(self):
+        """Is an unchanged page answered with 304, and a changed one re-rendered?"""
+
+        author = User.signup("poster", "poster@test.com", "password", None, None)
+        db.session.commit()
+        db.session.add(Message(id=5150, text="Cache me", user_id=author.id))
+        db.session.commit()
+        uid, author_id = self.testuser.id, author.id
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = uid
+
+            response = client.get("/messages/5150")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Cache-Control'], 'private, no-cache')
+            etag = response.headers['ETag']
+
+            response = client.get("/messages/5150", headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b"")
+
+            client.post(f"/users/follow/{author_id}")
+            response = client.get("/messages/5150", headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("Unfollow", str(response.data))
+
+    def test_static_caching(self):
+        """Are fingerprinted static URLs immutable, and other responses unstored?"""
+
+        with app.test_request_context():
+            from flask import url_for
+            url = url_for('static', filename='script.js')
+        self.assertIn("?v=", url)
+
+        response = self.client.get(url)
+        self.assertIn("immutable", response.headers['Cache-Control'])
+
+        response = self.client.get("/login")
+        self.assertEqual(response.headers['Cache-Control'], 'no-store')
+
+    def test_built_assets(self):
+        """Are built assets fingerprinted and served precompressed or as WebP?"""
+
+        static = app.static_folder
+        with tempfile.TemporaryDirectory() as folder:
+            app.static_folder = shutil.copytree(static, os.path.join(folder, 'static'))
+            try:
+                assets.build(app)
+                with app.test_request_context():
+                    script = assets.asset_url('script.js')
+                    hero = assets.asset_url('images/warbler-hero.jpg', width=500)
+                    avatar = assets.asset_filter('https://example.com/me.jpg', width=96)
+
+                self.assertTrue(script.startswith("/assets/script."))
+                self.assertTrue(avatar.startswith("/img/96/"))
+
+                response = self.client.get(script, headers={'Accept-Encoding': 'gzip'})
+                self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+                self.assertIn("immutable", response.headers['Cache-Control'])
+                self.assertIn("Accept-Encoding", response.headers['Vary'])
+                response.close()
+
+                response = self.client.get(script)
+                self.assertNotIn('Content-Encoding', response.headers)
+                response.close()
+
+                if PIL is not None:
+                    self.assertIn(".w600.", hero)
+                    response = self.client.get(hero, headers={'Accept': 'image/webp,*/*'})
+                    self.assertEqual(response.mimetype, 'image/webp')
+                    response.close()
+            finally:
+                app.static_folder = static
+                app.extensions['asset_manifest'] = assets.load_manifest(app)
+
+    def test_image_proxy(self):
+        """Are external images fetched once, resized and cached on disk?"""
+
+        with tempfile.TemporaryDirectory() as folder:
+            cache = image_proxy.DiskCache(folder, max_bytes=1000)
+            cache.write('aaaa', b'a' * 600)
+            os.utime(cache.path('aaaa'), (0, 0))
+            cache.write('bbbb', b'b' * 600)
+            self.assertIsNone(cache.lookup('aaaa'))
+            self.assertIsNotNone(cache.lookup('bbbb'))
+
+        # Internal addresses are refused, however they're spelled.
+        proxy = image_proxy.ImageProxy(None)
+        for url in ('http://127.0.0.1/me.png', 'http://169.254.169.254/latest/meta-data',
+                    'http://[::ffff:10.0.0.1]/me.png', 'file:///etc/passwd', 'http:///me.png'):
+            with self.assertRaises(image_proxy.FetchError):
+                proxy.fetch(url)
+
+        if PIL is None:
+            # Without Pillow nothing can be checked to be an image: no proxy.
+            with app.test_request_context():
+                url = image_proxy.proxied_url('https://example.com/me.png', 90)
+            self.assertEqual(url, 'https://example.com/me.png')
+            return
+
+        fetched = []
+
+        def fetch(url):
+            fetched.append(url)
+            if url.endswith('.html'):
+                return b"<html>not an image</html>"
+            with open(os.path.join(app.static_folder, 'images', 'default-pic.png'), 'rb') as f:
+                return f.read()
+
+        original = app.extensions['image_proxy']
+        with tempfile.TemporaryDirectory() as folder:
+            app.extensions['image_proxy'] = image_proxy.ImageProxy(
+                image_proxy.DiskCache(folder), fetch=fetch)
+            try:
+                with app.test_request_context():
+                    url = image_proxy.proxied_url('https://example.com/me.png', 90)
+                    page = image_proxy.proxied_url('https://example.com/page.html', 90)
+                self.assertTrue(url.startswith("/img/96/"))
+
+                for accept in ('image/webp,*/*', 'image/webp,*/*', '*/*'):
+                    response = self.client.get(url, headers={'Accept': accept})
+                    self.assertEqual(response.status_code, 200)
+                    self.assertIn("immutable", response.headers['Cache-Control'])
+                    response.close()
+                self.assertEqual(fetched, ['https://example.com/me.png'])
+
+                from PIL import Image
+                response = self.client.get(url, headers={'Accept': 'image/webp'})
+                self.assertEqual(response.mimetype, 'image/webp')
+                with Image.open(io.BytesIO(response.data)) as image:
+                    self.assertLessEqual(image.width, 96)
+                response.close()
+
+                # A Pillow built without WebP serves the fallback instead.
+                webp, image_proxy.WEBP = image_proxy.WEBP, False
+                try:
+                    response = self.client.get(url, headers={'Accept': 'image/webp,*/*'})
+                    self.assertEqual(response.mimetype, 'image/png')
+                    response.close()
+                finally:
+                    image_proxy.WEBP = webp
+
+                # What isn't an image is never passed on.
+                self.assertEqual(self.client.get(page).status_code, 404)
+
+                response = self.client.get(url[:-2] + "xx")
+                self.assertEqual(response.status_code, 404)
+            finally:
+                app.extensions['image_proxy'] = original
+
+    def test_compression(self):
+        """Are large text responses compressed, streamed ones chunk by chunk?"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser.id
+
+        response = self.client.get("/", headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn("Accept-Encoding", response.headers['Vary'])
+        self.assertIn(b"@testuser", gzip.decompress(response.data))
+
+        response = self.client.get("/")
+        self.assertNotIn('Content-Encoding', response.headers)
+
+        response = self.client.get("/static/images/warbler-logo.png",
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        response.close()
+
+        routes = app.extensions['compression'].stats()
+        self.assertLess(routes['homepage']['sent_bytes'], routes['homepage']['raw_bytes'])
+
+        # A streamed response comes out a decompressible piece at a time.
+        closed = []
+
+        class Body:
+            def __iter__(self):
+                yield b"<p>first</p>" * 100
+                yield b"<p>second</p>" * 100
+
+            def close(self):
+                closed.append(True)
+
+        def streaming_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/html')])
+            return Body()
+
+        middleware = compression.CompressionMiddleware(streaming_app)
+        body = middleware({'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': 'gzip'},
+                          lambda status, headers, exc_info=None: None)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks = iter(body)
+        self.assertEqual(decompressor.decompress(next(chunks)), b"<p>first</p>" * 100)
+        rest = b"".join(chunks)
+        self.assertEqual(decompressor.decompress(rest), b"<p>second</p>" * 100)
+        body.close()
+        self.assertEqual(closed, [True])
+
+    def test_template_profiling(self):
+        """Are templates and blocks timed per request?"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser.id
+
+        templating.enable_profiling(app)
+        try:
+            response = self.client.get(f"/users/{self.testuser.id}")
+        finally:
+            app.jinja_env.template_class = jinja2.Template
+            app.jinja_env.cache.clear()
+
+        timing = ", ".join(response.headers.getlist("Server-Timing"))
+        for label in ("users/show.html", "users/detail.html#content", "base.html"):
+            self.assertIn(f'desc="{label}"', timing)
+
+    def test_template_bytecode_cache(self):
+        """Does precompiling fill the bytecode cache, and do fresh loads use it?"""
+
+        original = app.jinja_env.bytecode_cache
+        with tempfile.TemporaryDirectory() as folder:
+            app.jinja_env.bytecode_cache = cache = templating.BytecodeCache(folder)
+            try:
+                app.jinja_env.cache.clear()
+                names = templating.compile_all(app)
+                self.assertIn("home.html", names)
+                self.assertEqual(len(os.listdir(folder)), len(names))
+
+                loaded = []
+                load_bytecode = cache.load_bytecode
+
+                def spy(bucket):
+                    load_bytecode(bucket)
+                    loaded.append(bucket.code is not None)
+                cache.load_bytecode = spy
+
+                app.jinja_env.cache.clear()
+                app.jinja_env.get_template("home.html")
+                self.assertEqual(loaded, [True])
+            finally:
+                app.jinja_env.bytecode_cache = original
+                app.jinja_env.cache.clear()
+
+    def test_streamed_pages(self):
+        """With STREAM_PAGES, do feed pages stream their shell first, and still paginate?"""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="follower",
+                               image_url=None,
+                               header_image_url=None)
+        db.session.commit()
+        follower_id = follower.id
+        author_id = self.testuser.id
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = follower_id
+            client.post(f"/users/follow/{author_id}")
+
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = author_id
+            for i in range(3):
+                client.post("/messages/new", data={"text": f"Streamed {i}"})
+
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = follower_id
+
+            # The author is now also pulled, so the merge must drop duplicates.
+            app.config.update(STREAM_PAGES=True, MESSAGES_PER_PAGE=2,
+                              TIMELINE_FANOUT_LIMIT=0)
+            try:
+                for url in ("/", f"/users/{author_id}"):
+                    response = client.get(url, buffered=False)
+                    self.assertTrue(response.is_streamed)
+                    self.assertIsNone(response.headers.get('ETag'))
+
+                    chunks = [chunk.decode() for chunk in response.response]
+                    response.close()
+                    self.assertIn('id="messages"', chunks[0])
+                    self.assertNotIn("Streamed", chunks[0])
+
+                    soup = BeautifulSoup("".join(chunks), 'html.parser')
+                    self.assertEqual([li.p.text for li in soup.select("#messages li")],
+                                     ["Streamed 2", "Streamed 1"])
+                    older = soup.find("a", string="Older messages")
+
+                    response = client.get(older["href"])
+                    soup = BeautifulSoup(response.data, 'html.parser')
+                    self.assertEqual([li.p.text for li in soup.select("#messages li")],
+                                     ["Streamed 0"])
+                    self.assertIsNone(soup.find("a", string="Older messages"))
+            finally:
+                app.config.update(STREAM_PAGES=False, MESSAGES_PER_PAGE=100,
+                                  TIMELINE_FANOUT_LIMIT=timeline.DEFAULT_FANOUT_LIMIT)
@@ -10,6 +10,7 @@ from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
 
 from models import db, User, Message, Follows
+import passwords
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -214,3 +215,44 @@ class UserModelTestCase(TestCase):
 
         self.assertFalse(User.authenticate(self.u1.username, "badpassword"))
 
+    def test_rehash_outdated_cost(self):
+        """Does a successful login upgrade a hash made with an old bcrypt cost?"""
+
+        self.u1.password = passwords.PasswordHasher(rounds=4, workers=0).hash("password")
+        db.session.commit()
+
+        u = User.authenticate(self.u1.username, "password")
+        db.session.commit()
+
+        self.assertEqual(passwords.hash_rounds(u.password), passwords.DEFAULT_ROUNDS)
+        self.assertTrue(User.authenticate(self.u1.username, "password"))
+
+    def test_hasher_queue_limit(self):
+        """Does the hasher refuse work once its queue is full?"""
+
+        hasher = passwords.PasswordHasher(rounds=4, workers=0, max_queue=0)
+
+        with self.assertRaises(passwords.PasswordHasherBusy):
+            hasher.hash("password")
+
+        self.assertEqual(hasher.stats()['rejected'], 1)
+
+    def test_hasher_timeout(self):
+        """Does a job that times out fail as busy, and keep its slot while it runs?"""
+
+        hasher = passwords.PasswordHasher(rounds=4, workers=1, max_queue=1)
+        try:
+            hasher.hash("password")  # start the worker
+
+            hasher.rounds, hasher.timeout = 14, 0.05
+            with self.assertRaises(passwords.PasswordHasherTimeout):
+                hasher.hash("password")
+            self.assertEqual(hasher.stats()['timeouts'], 1)
+            self.assertEqual(hasher.stats()['queue_depth'], 1)
+
+            with self.assertRaises(passwords.PasswordHasherBusy):
+                hasher.hash("password")
+        finally:
+            hasher.shutdown()
+
+        self.assertEqual(hasher.stats()['queue_depth'], 0)
@@ -1,9 +1,21 @@
 import os
+import subprocess
+import tempfile
 from unittest import TestCase
 from models import db, User, Message, Follows, Likes
 from bs4 import BeautifulSoup
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError, TimeoutError as SQLAlchemyTimeoutError
+import counters
+import dbpool
+import message_likes
+import metrics
+import replicas
+import user_follows
+import user_search
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+REPLICA_URL = "postgresql:///warbler-test-replica"
 
 from app import app, CURR_USER_KEY
  
@@ -20,6 +32,11 @@ class UserViewsTestCase(TestCase):
         db.drop_all() 
         db.create_all() 
 
+        # users are recreated for every test, so forget cached identities
+        # and fragments
+        app.extensions['identity_cache'].local.clear()
+        app.extensions['fragment_cache'].local.clear()
+
         self.client = app.test_client()
 
         u = User.signup(
@@ -87,6 +104,10 @@ class UserViewsTestCase(TestCase):
 
         db.session.commit()
 
+        # fixtures bypass the routes, so bring the stat counters up to date
+        counters.reconcile()
+        db.session.commit()
+
     def tearDown(self): 
         """Clean up any fouled transaction.""" 
         
@@ -200,6 +221,9 @@ class UserViewsTestCase(TestCase):
         db.session.add(l1)
         db.session.commit()
 
+        counters.reconcile()
+        db.session.commit()
+
     def test_user_view_with_likes(self):
         self.setup_likes()
         with self.client as client:
@@ -264,3 +288,502 @@ class UserViewsTestCase(TestCase):
             # the like has been deleted
             self.assertEqual(len(likes), 0)
 
+
+##########################################################
+# TEST PAGINATION
+##########################################################
+
+    def test_profile_pagination(self):
+        """Does the profile page hand out a cursor to older messages?"""
+
+        app.config['MESSAGES_PER_PAGE'] = 2
+        try:
+            for i in range(3):
+                db.session.add(Message(text=f"page message {i}", user_id=self.uid))
+            db.session.commit()
+
+            with self.client as client:
+                response = client.get(f"/users/{self.uid}")
+                soup = BeautifulSoup(response.data, 'html.parser')
+                self.assertEqual(len(soup.select("#messages li")), 2)
+
+                older = soup.find("a", string="Older messages")
+                self.assertIsNotNone(older)
+
+                response = client.get(older["href"])
+                soup = BeautifulSoup(response.data, 'html.parser')
+                self.assertEqual(len(soup.select("#messages li")), 2)
+                self.assertIsNone(soup.find("a", string="Older messages"))
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
+    def test_bad_cursor(self):
+        """Is a malformed cursor rejected?"""
+
+        with self.client as client:
+            response = client.get(f"/users/{self.uid}?before=not-a-cursor")
+            self.assertEqual(response.status_code, 400)
+
+##########################################################
+# TEST COUNTERS
+##########################################################
+
+    def test_follow_counters(self):
+        """Do following/unfollowing keep both users' counters in step?"""
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.uid2
+
+            client.post(f"/users/follow/{self.uid}")
+            self.assertEqual(User.query.get(self.uid2).following_count, 1)
+            self.assertEqual(User.query.get(self.uid).follower_count, 2)
+
+            client.post(f"/users/stop-following/{self.uid}")
+            self.assertEqual(User.query.get(self.uid2).following_count, 0)
+            self.assertEqual(User.query.get(self.uid).follower_count, 1)
+
+    def test_reconcile_counters(self):
+        """Does reconcile() recompute counters from the underlying tables?"""
+
+        User.query.filter_by(id=self.uid).update({'message_count': 42})
+        db.session.commit()
+
+        counters.reconcile()
+        db.session.commit()
+
+        u = User.query.get(self.uid)
+        self.assertEqual(u.message_count, 1)
+        self.assertEqual(u.following_count, 1)
+        self.assertEqual(u.follower_count, 1)
+        self.assertEqual(u.like_count, 0)
+
+##########################################################
+# TEST VIEWER CONTEXT
+##########################################################
+
+    def test_user_list_follow_buttons(self):
+        """Does the user list show Unfollow only for users the viewer follows?"""
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.uid
+
+            response = client.get("/users")
+            soup = BeautifulSoup(response.data, 'html.parser')
+            buttons = [b.text for b in soup.select(".card-contents button")]
+
+            self.assertEqual(buttons.count("Unfollow"), 1)
+            self.assertEqual(buttons.count("Follow"), 2)
+
+##########################################################
+# TEST SQL INSTRUMENTATION
+##########################################################
+
+    def test_server_timing_header(self):
+        """Does each response report its SQL totals?"""
+
+        with self.client as client:
+            response = client.get(f"/users/{self.uid}")
+
+            timing = response.headers.get("Server-Timing")
+            self.assertIsNotNone(timing)
+            self.assertTrue(timing.startswith("db;dur="))
+            self.assertIn("queries", timing)
+
+    def test_edit_profile_refreshes_identity(self):
+        """Does editing your profile update the cached navbar identity?"""
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.uid
+
+            client.get("/")
+            client.post("/users/profile", data={
+                "username": "renamed",
+                "email": "test@test.com",
+                "password": "HASHED_PASSWORD",
+            })
+
+            response = client.get("/")
+            self.assertIn('alt="renamed"', str(response.data))
+
+    def test_search_users_ranking(self):
+        """Are exact and prefix username matches ranked ahead of the rest?"""
+
+        u = User.query.get(self.uid2)
+        u.bio = "a testuser fan"
+        db.session.commit()
+
+        with self.client as client:
+            response = client.get("/users?q=TESTUSER")
+            soup = BeautifulSoup(response.data, 'html.parser')
+            names = [p.text for p in soup.select(".card-link p")]
+
+            self.assertEqual(names, ["@testuser", "@testuser1", "@lmnop"])
+
+    def test_search_users_serves_old_index_while_rebuilding(self):
+        """Do user searches use the old index, not wait, while another request rebuilds it?"""
+
+        self.client.get("/users?q=testuser")
+
+        # Written behind the ORM's back, as another worker would.
+        db.session.execute(User.__table__.insert().values(
+            id=9999, username="testuser9", email="test9@test9.com",
+            password="HASHED_PASSWORD9"))
+        db.session.commit()
+
+        with user_search._rebuilding:
+            response = self.client.get("/users?q=testuser")
+        self.assertNotIn("@testuser9", str(response.data))
+
+        response = self.client.get("/users?q=testuser")
+        self.assertIn("@testuser9", str(response.data))
+
+    def test_list_users_paginated(self):
+        """Is the unfiltered user listing split into pages?"""
+
+        app.config['USERS_PER_PAGE'] = 2
+        try:
+            with self.client as client:
+                response = client.get("/users")
+                soup = BeautifulSoup(response.data, 'html.parser')
+                self.assertEqual(len(soup.select(".card-link")), 2)
+                self.assertIsNotNone(soup.find("a", string="Next"))
+
+                response = client.get("/users?page=2")
+                soup = BeautifulSoup(response.data, 'html.parser')
+                self.assertEqual(len(soup.select(".card-link")), 1)
+                self.assertIsNone(soup.find("a", string="Next"))
+        finally:
+            app.config['USERS_PER_PAGE'] = 30
+
+    def test_like_toggle_counts(self):
+        """Does toggling a like return and store the message's new like count?"""
+
+        msg = Message(id=1946, text="count me", user_id=self.uid1)
+        db.session.add(msg)
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.uid
+
+            resp = client.post("/messages/1946/like")
+            self.assertEqual(resp.json, {'liked': True, 'likes': 1})
+            self.assertEqual(User.query.get(self.uid).like_count, 1)
+
+            resp = client.post("/messages/1946/like")
+            self.assertEqual(resp.json, {'liked': False, 'likes': 0})
+            self.assertEqual(User.query.get(self.uid).like_count, 0)
+            self.assertEqual(Message.query.get(1946).like_count, 0)
+
+    def test_like_unique(self):
+        """Can a user like the same message only once?"""
+
+        msg = Message(id=1947, text="once", user_id=self.uid1)
+        db.session.add_all([msg, Likes(user_id=self.uid, message_id=1947)])
+        db.session.commit()
+
+        db.session.add(Likes(user_id=self.uid, message_id=1947))
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+
+    def test_batch_mutations(self):
+        """Does /api/batch apply likes and follows together, last operation winning?"""
+
+        msg = Message(id=1948, text="batch me", user_id=self.uid1)
+        db.session.add(msg)
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.uid2
+
+            resp = client.post("/api/batch", json={'operations': [
+                {'op': 'like', 'message_id': 1948},
+                {'op': 'unlike', 'message_id': 1948},
+                {'op': 'like', 'message_id': 1948},
+                {'op': 'follow', 'user_id': self.uid},
+                {'op': 'follow', 'user_id': self.uid2},
+                {'op': 'like', 'message_id': 9999},
+            ]})
+
+            self.assertEqual(resp.status_code, 200)
+            results = resp.json['results']
+            self.assertEqual(len(results), 6)
+            self.assertEqual(results[2], {'op': 'like', 'message_id': 1948,
+                                          'ok': True, 'liked': True, 'likes': 1})
+            self.assertEqual(results[3], {'op': 'follow', 'user_id': self.uid,
+                                          'ok': True, 'following': True})
+            self.assertEqual(results[4]['error'], 'self_follow')
+            self.assertEqual(results[5]['error'], 'not_found')
+
+            self.assertEqual(Likes.query.filter_by(user_id=self.uid2).count(), 1)
+            self.assertEqual(User.query.get(self.uid2).like_count, 1)
+            self.assertEqual(User.query.get(self.uid2).following_count, 1)
+            self.assertEqual(User.query.get(self.uid).follower_count, 2)
+
+            resp = client.post("/api/batch", json={'operations': [
+                {'op': 'unlike', 'message_id': 1948},
+                {'op': 'unfollow', 'user_id': self.uid},
+            ]})
+            self.assertEqual([r['ok'] for r in resp.json['results']], [True, True])
+            self.assertEqual(Message.query.get(1948).like_count, 0)
+            self.assertEqual(User.query.get(self.uid).follower_count, 1)
+
+    def test_bulk_changes_count_rows_changed(self):
+        """Do bulk likes and follows only count the rows they actually changed?"""
+
+        db.session.add(Message(id=1949, text="like me", user_id=self.uid1))
+        db.session.commit()
+
+        # Already liked by a toggle (or a concurrent batch): nothing to count.
+        message_likes.toggle_like(self.uid2, 1949)
+        self.assertEqual(message_likes.set_likes(self.uid2, [1949], []), set())
+        self.assertEqual(message_likes.set_likes(self.uid2, [], [1949]), {1949})
+        self.assertEqual(message_likes.set_likes(self.uid2, [], [1949]), set())
+        db.session.commit()
+        self.assertEqual(Message.query.get(1949).like_count, 0)
+        self.assertEqual(User.query.get(self.uid2).like_count, 0)
+
+        with app.app_context():
+            self.assertEqual(user_follows.set_follows(self.uid2, [self.uid, self.uid1], []),
+                             {self.uid, self.uid1})
+            self.assertEqual(user_follows.set_follows(self.uid2, [self.uid], []), set())
+            db.session.commit()
+        self.assertEqual(User.query.get(self.uid2).following_count, 2)
+        self.assertEqual(User.query.get(self.uid).follower_count, 2)
+
+    def test_batch_rejects_bad_requests(self):
+        """Are malformed, oversized and logged-out batches refused?"""
+
+        resp = self.client.post("/api/batch", json={'operations': []})
+        self.assertEqual(resp.status_code, 401)
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.uid
+
+            resp = client.post("/api/batch", json={'operations': [{'op': 'boost'}]})
+            self.assertEqual(resp.status_code, 400)
+
+            too_many = [{'op': 'like', 'message_id': i}
+                        for i in range(app.config['BATCH_MAX_OPERATIONS'] + 1)]
+            resp = client.post("/api/batch", json={'operations': too_many})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_deleted_user_logged_out_before_writes(self):
+        """Is a user deleted by another worker logged out here, not left to write?"""
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.uid1
+
+            # cache the principal
+            client.get("/")
+            follows = Follows.query.count()
+
+            # As another worker would: straight to the table.
+            db.session.execute(User.__table__.delete()
+                               .where(User.__table__.c.id == self.uid1))
+            db.session.commit()
+
+            resp = client.post("/api/batch", json={'operations': [
+                {'op': 'follow', 'user_id': self.uid}]})
+            self.assertEqual(resp.status_code, 401)
+
+            with client.session_transaction() as session:
+                self.assertNotIn(CURR_USER_KEY, session)
+
+        self.assertEqual(Follows.query.count(), follows)
+
+    def test_cached_fragments_overlay_viewer(self):
+        """Are cards and headers served from cache with each viewer's own buttons?"""
+
+        cache = app.extensions['fragment_cache']
+        before = cache.stats()
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.uid1
+
+            response = client.get(f"/users/{self.uid}")
+            soup = BeautifulSoup(response.data, 'html.parser')
+            self.assertIsNotNone(soup.find("button", string="Unfollow"))
+            self.assertEqual(len(soup.select("#messages .messages-like")), 1)
+
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.uid
+
+            response = client.get(f"/users/{self.uid}")
+            soup = BeautifulSoup(response.data, 'html.parser')
+            self.assertIsNotNone(soup.find("a", string="Edit Profile"))
+            self.assertIsNone(soup.find("button", string="Unfollow"))
+            self.assertEqual(len(soup.select("#messages .messages-like")), 0)
+            self.assertIn("testing message", str(response.data))
+
+        after = cache.stats()
+        for key, change in [('cards_misses', 1), ('cards_hits', 1), ('headers_hits', 1)]:
+            self.assertEqual(after.get(key, 0) - before.get(key, 0), change)
+
+    def test_fragments_follow_edits_from_other_workers(self):
+        """Does a profile edit made elsewhere show up without any invalidation here?"""
+
+        with self.client as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.uid1
+
+            etag = client.get(f"/users/{self.uid}").headers['ETag']
+
+            # As another worker would: straight to the table.
+            db.session.execute(User.__table__.update()
+                               .where(User.__table__.c.id == self.uid)
+                               .values(username="renamed"))
+            db.session.commit()
+
+            response = client.get(f"/users/{self.uid}", headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            soup = BeautifulSoup(response.data, 'html.parser')
+            self.assertIn("@renamed", soup.select_one("#messages").text)
+            self.assertNotIn("@testuser", response.data.decode())
+
+    def test_replica_routing(self):
+        """Do read-only views read from a replica, except right after a write?"""
+
+        replica = replicas.Replica(REPLICA_URL)
+        db.metadata.drop_all(bind=replica.engine)
+        db.metadata.create_all(bind=replica.engine)
+        replica.engine.execute(User.__table__.insert().values(
+            id=9999, username="replicauser", email="replica@test.com", password="x"))
+
+        original = app.extensions['db_replicas']
+        app.extensions['db_replicas'] = replica_set = replicas.ReplicaSet([replica])
+        try:
+            with self.client as client:
+                response = client.get("/users")
+                self.assertIn("replicauser", str(response.data))
+                self.assertNotIn("testuser", str(response.data))
+
+                # Down replicas are skipped until they answer a probe again.
+                replica_set.mark_down(replica)
+                response = client.get("/users")
+                self.assertIn("testuser", str(response.data))
+                replica.down_until = 0
+                response = client.get("/users")
+                self.assertIn("replicauser", str(response.data))
+
+                # A write keeps this client on the primary for a while.
+                client.post("/login", data={"username": "nobody", "password": "wrong"})
+                response = client.get("/users")
+                self.assertIn("testuser", str(response.data))
+
+                with client.session_transaction() as session:
+                    session[replicas.PRIMARY_UNTIL_KEY] = 0
+                response = client.get("/users")
+                self.assertIn("replicauser", str(response.data))
+
+            # A replica that can't be reached fails over to the primary.
+            broken = replicas.Replica("sqlite:////nonexistent/replica.db")
+            app.extensions['db_replicas'] = replicas.ReplicaSet([broken])
+            response = self.client.get("/users")
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("testuser", str(response.data))
+            self.assertIsNotNone(broken.down_until)
+        finally:
+            app.extensions['db_replicas'] = original
+            db.metadata.drop_all(bind=replica.engine)
+            replica.engine.dispose()
+
+        # Smooth weighted round-robin.
+        heavy, light = replicas.Replica(REPLICA_URL, 2), replicas.Replica(REPLICA_URL, 1)
+        replica_set = replicas.ReplicaSet([heavy, light])
+        picks = [replica_set.pick() for _ in range(6)]
+        self.assertEqual(picks, [heavy, light, heavy] * 2)
+
+    def test_pool_metrics(self):
+        """Are connection checkouts, waits and timeouts reported?"""
+
+        app.config['METRICS_ENABLED'] = True
+        try:
+            self.client.get("/users")
+            pools = self.client.get("/admin/metrics").get_json()['pools']
+        finally:
+            app.config['METRICS_ENABLED'] = False
+
+        self.assertGreaterEqual(pools['primary']['checkouts'], 1)
+        self.assertIn('wait_ms_max', pools['primary'])
+
+        engine = create_engine(REPLICA_URL, poolclass=dbpool.TimedQueuePool,
+                               pool_size=1, max_overflow=0, pool_timeout=0.1)
+        try:
+            with engine.connect():
+                with self.assertRaises(SQLAlchemyTimeoutError):
+                    engine.connect()
+                report = engine.pool.status_report()
+                self.assertEqual(report['checked_out'], 1)
+                self.assertEqual(report['timeouts'], 1)
+            self.assertEqual(engine.pool.status_report()['checked_out'], 0)
+        finally:
+            engine.dispose()
+
+    def test_prometheus_metrics(self):
+        """Does /metrics report per-route counts, histograms and bcrypt time?"""
+
+        def sample(body, line):
+            for row in body.splitlines():
+                if row.startswith(line + " "):
+                    return float(row.rsplit(" ", 1)[1])
+            return 0
+
+        self.assertEqual(self.client.get("/metrics").status_code, 404)
+
+        app.config['METRICS_ENABLED'] = True
+        try:
+            before = self.client.get("/metrics").get_data(as_text=True)
+            self.client.get("/users")
+            self.client.get("/users")
+            self.client.post("/login", data={"username": "testuser", "password": "HASHED_PASSWORD"})
+            response = self.client.get("/metrics")
+        finally:
+            app.config['METRICS_ENABLED'] = False
+
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        after = response.get_data(as_text=True)
+
+        for line, change in [
+                ('warbler_http_requests_total{endpoint="list_users",method="GET",status="200"}', 2),
+                ('warbler_http_request_duration_seconds_count{endpoint="list_users",method="GET"}', 2),
+                ('warbler_db_queries_per_request_count{endpoint="list_users"}', 2),
+                ('warbler_template_render_seconds_count{template="users/index.html"}', 2),
+                ('warbler_bcrypt_seconds_count{operation="check"}', 1)]:
+            self.assertEqual(sample(after, line) - sample(before, line), change, line)
+
+    def test_metrics_across_processes(self):
+        """Are counters summed over every worker, and dead workers' gauges dropped?"""
+
+        def registry():
+            registry = metrics.Registry()
+            registry.counter('jobs_total', "Jobs.", ('kind',))
+            registry.gauge('busy', "Busy workers.")
+            return registry
+
+        this, other = registry(), registry()
+        this.metrics['jobs_total'].inc('a')
+        this.metrics['busy'].inc()
+        other.metrics['jobs_total'].inc('a', amount=2)
+        other.metrics['busy'].inc()
+
+        dead = subprocess.Popen(["true"])
+        dead.wait()
+
+        with tempfile.TemporaryDirectory() as directory:
+            other.write(directory, pid=os.getppid())
+            self.assertEqual(this.collect(directory),
+                             {'jobs_total': {('a',): 3}, 'busy': {(): 2}})
+
+            other.write(directory, pid=dead.pid)
+            os.remove(os.path.join(directory, f"metrics-{os.getppid()}.json"))
+            text = this.render(directory)
+            self.assertIn('jobs_total{kind="a"} 3', text)
+            self.assertIn('busy 1', text)
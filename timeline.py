@@ -0,0 +1,316 @@
+"""Materialized home timelines for Warbler.
+
+Every user's home feed is stored in the `timeline_entries` table, one row per
+(owner, message). Rows are written when a message is posted ("fan-out on
+write"), so reading the feed is a single range scan over
+`(owner_id, timestamp)` no matter how many accounts the owner follows.
+
+Authors with a very large audience are not fanned out -- writing one row per
+follower for every message they post would be too expensive. Their messages
+are pulled at read time instead and merged into the materialized feed.
+The cut-off is the `TIMELINE_FANOUT_LIMIT` config value, compared against
+the denormalized `User.follower_count`. When an author drops back to the
+limit, their recent messages (posted while they were pulled, so never
+pushed) are backfilled onto every follower's timeline; `flask
+rebuild-timelines` rebuilds every timeline from scratch.
+"""
+
+import heapq
+
+from flask import current_app
+from sqlalchemy import exists, func, literal, select
+
+from models import db, Follows, Message, TimelineEntry, User
+import cards
+import pagination
+
+DEFAULT_FANOUT_LIMIT = 10000
+DEFAULT_BACKFILL = 100
+
+ENTRY_COLUMNS = ['owner_id', 'message_id', 'author_id', 'timestamp']
+
+entries = TimelineEntry.__table__
+
+
+def fanout_limit():
+    """Follower count above which an author's messages are pulled, not pushed."""
+
+    return current_app.config.get('TIMELINE_FANOUT_LIMIT', DEFAULT_FANOUT_LIMIT)
+
+
+def high_follower_ids(user_ids):
+    """Return the subset of `user_ids` whose messages are not fanned out."""
+
+    return {
+        user_id for (user_id,) in (db.session
+            .query(User.id)
+            .filter(User.id.in_(user_ids))
+            .filter(User.follower_count > fanout_limit()))
+    }
+
+
+def at_fanout_limit(user_ids):
+    """Return the subset of `user_ids` whose follower count is exactly the limit.
+
+    Right after their follower counts went down by one, these are the
+    authors who just stopped being pulled.
+    """
+
+    return {
+        user_id for (user_id,) in (db.session
+            .query(User.id)
+            .filter(User.id.in_(user_ids))
+            .filter(User.follower_count == fanout_limit()))
+    }
+
+
+def _recent_messages(author_ids):
+    """The latest `TIMELINE_BACKFILL` messages of each of `author_ids`."""
+
+    ranked = (select([Message.id,
+                      Message.user_id,
+                      Message.timestamp,
+                      func.row_number().over(
+                          partition_by=Message.user_id,
+                          order_by=(Message.timestamp.desc(), Message.id.desc()),
+                      ).label('rank')])
+              .where(Message.user_id.in_(author_ids))
+              .alias('ranked'))
+
+    return (select([ranked.c.id, ranked.c.user_id, ranked.c.timestamp])
+            .where(ranked.c.rank <= current_app.config.get('TIMELINE_BACKFILL',
+                                                           DEFAULT_BACKFILL))
+            .alias('recent'))
+
+
+def fan_out_message(msg):
+    """Write a new message onto its author's and followers' timelines.
+
+    The message must already be flushed so it has an id and timestamp.
+    """
+
+    db.session.execute(entries.insert().values(
+        owner_id=msg.user_id,
+        message_id=msg.id,
+        author_id=msg.user_id,
+        timestamp=msg.timestamp,
+    ))
+
+    if high_follower_ids([msg.user_id]):
+        return
+
+    followers = (select([Follows.user_following_id,
+                         literal(msg.id),
+                         literal(msg.user_id),
+                         literal(msg.timestamp)])
+                 .where(Follows.user_being_followed_id == msg.user_id)
+                 .where(Follows.user_following_id != msg.user_id))
+
+    db.session.execute(entries.insert().from_select(ENTRY_COLUMNS, followers))
+
+
+def remove_message(msg):
+    """Remove a message from every timeline it was written to."""
+
+    db.session.execute(entries.delete().where(entries.c.message_id == msg.id))
+
+
+def add_follows(follower_id, followed_ids):
+    """Backfill a follower's timeline with the recent messages of new follows.
+
+    One query picks out the high-follower authors (which aren't fanned out)
+    and one windowed `INSERT ... SELECT` copies the latest messages of all
+    the others, however many there are.
+    """
+
+    followed_ids = set(followed_ids) - {follower_id}
+    if not followed_ids:
+        return
+
+    followed_ids -= high_follower_ids(followed_ids)
+    if not followed_ids:
+        return
+
+    recent = _recent_messages(followed_ids)
+    rows = select([literal(follower_id),
+                   recent.c.id,
+                   recent.c.user_id,
+                   recent.c.timestamp])
+
+    db.session.execute(entries.insert().from_select(ENTRY_COLUMNS, rows))
+
+
+def backfill_followers(author_ids):
+    """Copy the recent messages of `author_ids` onto all their followers' timelines.
+
+    For authors who have just dropped to the fan-out limit: what they posted
+    while above it was pulled at read time and never pushed. Messages
+    already on a timeline are skipped.
+    """
+
+    author_ids = set(author_ids)
+    if not author_ids:
+        return
+
+    recent = _recent_messages(author_ids)
+    already = (exists()
+               .where(entries.c.owner_id == Follows.user_following_id)
+               .where(entries.c.message_id == recent.c.id))
+    rows = (select([Follows.user_following_id,
+                    recent.c.id,
+                    recent.c.user_id,
+                    recent.c.timestamp])
+            .where(Follows.user_being_followed_id == recent.c.user_id)
+            .where(Follows.user_following_id != recent.c.user_id)
+            .where(~already))
+
+    db.session.execute(entries.insert().from_select(ENTRY_COLUMNS, rows))
+
+
+def remove_follows(follower_id, followed_ids):
+    """Drop unfollowed authors' messages from the follower's timeline."""
+
+    followed_ids = set(followed_ids) - {follower_id}
+    if not followed_ids:
+        return
+
+    db.session.execute(entries.delete()
+                       .where(entries.c.owner_id == follower_id)
+                       .where(entries.c.author_id.in_(followed_ids)))
+
+
+def remove_user(user_id):
+    """Remove a user's own timeline and their messages from everyone else's.
+
+    Run after `counters.user_removed()` and before the user's follows are
+    deleted, so authors the user's departure brings down to the fan-out
+    limit are backfilled.
+    """
+
+    followed = (select([Follows.user_being_followed_id])
+                .where(Follows.user_following_id == user_id))
+    backfill_followers(at_fanout_limit(followed))
+
+    db.session.execute(entries.delete()
+                       .where((entries.c.owner_id == user_id)
+                              | (entries.c.author_id == user_id)))
+
+
+def _page_queries(user_id, before, size, strategy=None):
+    """The queries for one page of a home timeline: pushed, then any pulled.
+
+    Each is ordered newest first and limited to `size + 1` messages.
+    """
+
+    query = (Message
+             .query
+             .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+             .filter(TimelineEntry.owner_id == user_id)
+             .options(*cards.card_options(strategy=strategy)))
+    queries = [pagination
+               .keyset_filter(query,
+                              TimelineEntry.timestamp,
+                              TimelineEntry.message_id,
+                              before)
+               .order_by(TimelineEntry.timestamp.desc(),
+                         TimelineEntry.message_id.desc())
+               .limit(size + 1)]
+
+    followed_ids = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == user_id))
+    pulled_ids = high_follower_ids(followed_ids)
+
+    if pulled_ids:
+        pulled = pagination.keyset_filter(
+            (Message
+             .query
+             .filter(Message.user_id.in_(pulled_ids))
+             .options(*cards.card_options(strategy=strategy))),
+            Message.timestamp,
+            Message.id,
+            before)
+        queries.append(pulled
+                       .order_by(Message.timestamp.desc(), Message.id.desc())
+                       .limit(size + 1))
+
+    return queries
+
+
+def home_timeline(user_id, before=None, size=None):
+    """Return one page of `user_id`'s home timeline and the next-page cursor.
+
+    `before` is a decoded `(timestamp, id)` cursor from pagination.py.
+    """
+
+    size = size or pagination.per_page()
+
+    pushed, *pulled = _page_queries(user_id, before, size)
+    messages = pushed.all()
+
+    if not pulled:
+        return pagination.split_page(messages, size)
+
+    # An author may have crossed the fan-out limit after some of their
+    # messages were pushed, so the same message can come from both paths.
+    merged = {msg.id: msg for msg in messages + pulled[0].all()}
+    merged = sorted(merged.values(),
+                    key=lambda msg: (msg.timestamp, msg.id),
+                    reverse=True)
+    return pagination.split_page(merged[:size + 1], size)
+
+
+def stream_home_timeline(user_id, before=None, size=None):
+    """Return one page of `user_id`'s home timeline as a `pagination.StreamedPage`.
+
+    The pushed and pulled messages are read from server-side cursors and
+    merged as the page is iterated.
+    """
+
+    size = size or pagination.per_page()
+
+    # yield_per can't be combined with "selectin" loading: join the authors.
+    queries = [query.yield_per(pagination.STREAM_BATCH_SIZE)
+               for query in _page_queries(user_id, before, size, strategy='joined')]
+    return pagination.StreamedPage(_merge_newest_first(queries), size)
+
+
+def _merge_newest_first(sources):
+    """Merge newest-first message iterables, skipping a message both contain."""
+
+    last_id = None
+    for msg in heapq.merge(*sources,
+                           key=lambda msg: (msg.timestamp, msg.id),
+                           reverse=True):
+        if msg.id != last_id:
+            yield msg
+        last_id = msg.id
+
+
+def rebuild():
+    """Rebuild every timeline from the `messages` and `follows` tables."""
+
+    db.session.execute(entries.delete())
+
+    own = select([Message.user_id.label('owner_id'),
+                  Message.id,
+                  Message.user_id,
+                  Message.timestamp])
+    db.session.execute(entries.insert().from_select(ENTRY_COLUMNS, own))
+
+    pulled_ids = {
+        user_id for (user_id,) in (db.session
+            .query(User.id)
+            .filter(User.follower_count > fanout_limit()))
+    }
+
+    followed = (select([Follows.user_following_id,
+                        Message.id,
+                        Message.user_id,
+                        Message.timestamp])
+                .where(Follows.user_being_followed_id == Message.user_id)
+                .where(Follows.user_following_id != Message.user_id))
+    if pulled_ids:
+        followed = followed.where(Message.user_id.notin_(pulled_ids))
+
+    db.session.execute(entries.insert().from_select(ENTRY_COLUMNS, followed))
@@ -0,0 +1,49 @@
+"""Following and unfollowing users in bulk.
+
+The counterpart of message_likes.py for the `follows` table: on Postgres,
+one `DELETE ... RETURNING` and one duplicate-ignoring `INSERT ... RETURNING`
+however many users are involved, with both sides' follow counters and the
+follower's timeline updated in the same transaction for the rows that
+actually changed.
+"""
+
+from models import delete_returning, insert_returning, Follows
+import counters
+import timeline
+
+follows = Follows.__table__
+
+
+def set_follows(user_id, follow_ids, unfollow_ids):
+    """Make `user_id` follow every user in `follow_ids` and none in `unfollow_ids`.
+
+    Counters and the timeline follow the rows actually deleted and
+    inserted. Returns the set of user ids whose follow state actually
+    changed.
+    """
+
+    removed = added = set()
+
+    if unfollow_ids:
+        removed = delete_returning(follows, follows.c.user_following_id == user_id,
+                                   'user_being_followed_id', set(unfollow_ids))
+        if removed:
+            counters.adjust_many(removed, follower_count=-1)
+            timeline.remove_follows(user_id, removed)
+            timeline.backfill_followers(timeline.at_fanout_limit(removed))
+
+    if follow_ids:
+        added = insert_returning(
+            follows,
+            [{'user_following_id': user_id, 'user_being_followed_id': followed_id}
+             for followed_id in set(follow_ids)],
+            ['user_being_followed_id', 'user_following_id'],
+            'user_being_followed_id')
+        if added:
+            counters.adjust_many(added, follower_count=1)
+            timeline.add_follows(user_id, added)
+
+    if added or removed:
+        counters.adjust(user_id, following_count=len(added) - len(removed))
+
+    return added | removed
@@ -0,0 +1,269 @@
+"""Ranked, paginated user search for `/users?q=`.
+
+Matching is a case-insensitive substring match on username or bio. Results
+are ranked by match quality -- exact username, then username prefix, then
+username substring, then bio-only -- with ties broken by trigram similarity
+and then follower count.
+
+On Postgres, matching uses `pg_trgm` GIN indexes on `lower(username)` and
+`lower(bio)` (created with the `users` table, see models.py) and
+`similarity()` for ranking. Other databases (SQLite in development and
+tests) use `NgramIndex`, an in-process trigram index over all users that is
+kept current by ORM events and rebuilt when the table changes behind its
+back.
+"""
+
+import threading
+from collections import defaultdict
+from time import monotonic
+
+from flask import current_app
+from sqlalchemy import case, event, func, or_
+
+from models import db, User
+
+DEFAULT_PER_PAGE = 30
+DEFAULT_MAX_PAGE = 50
+INDEX_TTL = 300
+
+NGRAM = 3
+
+EXACT, PREFIX, USERNAME, BIO = 3, 2, 1, 0
+
+
+class SearchPage:
+    """One page of search (or listing) results."""
+
+    def __init__(self, users, page, has_next):
+        self.users = users
+        self.page = page
+        self.has_next = has_next
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+
+def per_page():
+    return current_app.config.get('USERS_PER_PAGE', DEFAULT_PER_PAGE)
+
+
+def max_page():
+    return current_app.config.get('USER_SEARCH_MAX_PAGE', DEFAULT_MAX_PAGE)
+
+
+def ngrams(text, n=NGRAM):
+    """The set of character n-grams in `text`."""
+
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def similarity(a, b):
+    """Trigram similarity of two strings, as Postgres' `similarity()` computes it."""
+
+    a_grams = ngrams(f"  {a} ")
+    b_grams = ngrams(f"  {b} ")
+    if not a_grams or not b_grams:
+        return 0.0
+    return len(a_grams & b_grams) / len(a_grams | b_grams)
+
+
+def match_tier(q, username, bio):
+    """How well `q` matches, or None for no match. All inputs lowercased."""
+
+    if username == q:
+        return EXACT
+    if username.startswith(q):
+        return PREFIX
+    if q in username:
+        return USERNAME
+    if q in bio:
+        return BIO
+    return None
+
+
+class NgramIndex:
+    """In-process trigram index over usernames and bios."""
+
+    def __init__(self):
+        self.docs = {}
+        self.postings = defaultdict(set)
+        self.built_at = None
+        self.signature = None
+        self.lock = threading.RLock()
+
+    def add(self, user_id, username, bio):
+        with self.lock:
+            self.remove(user_id)
+            username, bio = username.lower(), (bio or '').lower()
+            self.docs[user_id] = (username, bio)
+            for gram in ngrams(username) | ngrams(bio):
+                self.postings[gram].add(user_id)
+
+    def remove(self, user_id):
+        with self.lock:
+            doc = self.docs.pop(user_id, None)
+            if doc is None:
+                return
+            for gram in ngrams(doc[0]) | ngrams(doc[1]):
+                self.postings[gram].discard(user_id)
+                if not self.postings[gram]:
+                    del self.postings[gram]
+
+    def rebuild(self, rows, signature):
+        """Replace the contents with `rows`, searching the old ones meanwhile."""
+
+        fresh = NgramIndex()
+        for user_id, username, bio in rows:
+            fresh.add(user_id, username, bio)
+
+        with self.lock:
+            self.docs = fresh.docs
+            self.postings = fresh.postings
+            self.built_at = monotonic()
+            self.signature = signature
+
+    def search(self, q):
+        """Return `[(tier, similarity, user_id)]` for every user matching `q`."""
+
+        with self.lock:
+            grams = ngrams(q)
+            if grams:
+                candidates = set.intersection(
+                    *(self.postings.get(gram, set()) for gram in grams))
+            else:
+                candidates = self.docs.keys()
+
+            matches = []
+            for user_id in candidates:
+                username, bio = self.docs[user_id]
+                tier = match_tier(q, username, bio)
+                if tier is not None:
+                    matches.append((tier, similarity(q, username), user_id))
+            return matches
+
+
+index = NgramIndex()
+
+# Held by the one request rebuilding `index`.
+_rebuilding = threading.Lock()
+
+
+def _table_signature():
+    return tuple(db.session.query(func.count(User.id), func.max(User.id)).one())
+
+
+def local_index():
+    """Return `index`, rebuilding it if stale or if the table changed.
+
+    Only the first build makes searches wait: after that, one request
+    rebuilds and the rest search the index as it was.
+    """
+
+    signature = _table_signature()
+    if not _is_stale(signature):
+        return index
+
+    if _rebuilding.acquire(blocking=index.built_at is None):
+        try:
+            signature = _table_signature()
+            if _is_stale(signature):
+                rows = (db.session
+                        .query(User.id, User.username, User.bio)
+                        .yield_per(1000))
+                index.rebuild(rows, signature)
+        finally:
+            _rebuilding.release()
+    return index
+
+
+def _is_stale(signature):
+    return (index.built_at is None
+            or monotonic() - index.built_at > INDEX_TTL
+            or index.signature != signature)
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def _index_user(mapper, connection, user):
+    if index.built_at is not None:
+        index.add(user.id, user.username, user.bio)
+
+
+@event.listens_for(User, 'after_delete')
+def _unindex_user(mapper, connection, user):
+    index.remove(user.id)
+
+
+def _page_of(query, page):
+    size = per_page()
+    users = query.offset((page - 1) * size).limit(size + 1).all()
+    return SearchPage(users[:size], page, len(users) > size)
+
+
+def list_users(page=1):
+    """Every user, most followed first, a page at a time."""
+
+    query = User.query.order_by(User.follower_count.desc(), User.id)
+    return _page_of(query, page)
+
+
+def _escape_like(q):
+    return q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _search_postgres(q, page):
+    username = func.lower(User.username)
+    bio = func.lower(func.coalesce(User.bio, ''))
+    escaped = _escape_like(q)
+
+    tier = case(
+        [(username == q, EXACT),
+         (username.like(f"{escaped}%", escape='\\'), PREFIX),
+         (username.like(f"%{escaped}%", escape='\\'), USERNAME)],
+        else_=BIO)
+
+    query = (User
+             .query
+             .filter(or_(username.like(f"%{escaped}%", escape='\\'),
+                         bio.like(f"%{escaped}%", escape='\\')))
+             .order_by(tier.desc(),
+                       func.similarity(username, q).desc(),
+                       User.follower_count.desc(),
+                       User.id))
+    return _page_of(query, page)
+
+
+def _search_local(q, page):
+    matches = local_index().search(q)
+
+    followers = {}
+    ids = [user_id for _, _, user_id in matches]
+    for start in range(0, len(ids), 500):
+        followers.update(db.session
+                         .query(User.id, User.follower_count)
+                         .filter(User.id.in_(ids[start:start + 500])))
+
+    ranked = sorted(
+        (match for match in matches if match[2] in followers),
+        key=lambda match: (-match[0], -match[1], -followers[match[2]], match[2]))
+
+    size = per_page()
+    page_ids = [user_id for _, _, user_id in ranked[(page - 1) * size:page * size]]
+    users = {user.id: user for user in User.query.filter(User.id.in_(page_ids))}
+
+    return SearchPage([users[user_id] for user_id in page_ids if user_id in users],
+                      page,
+                      len(ranked) > page * size)
+
+
+def search_users(q, page=1):
+    """Users matching `q`, best match first, a page at a time."""
+
+    q = q.strip().lower()
+    if not q:
+        return list_users(page)
+
+    if db.engine.dialect.name == 'postgresql':
+        return _search_postgres(q, page)
+    return _search_local(q, page)
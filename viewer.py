@@ -0,0 +1,63 @@
+"""Per-request relationship context for the logged-in user.
+
+List pages ask "does the viewer follow this user?" / "has the viewer liked
+this message?" once per card. Rather than walking the viewer's `following`
+and `likes` collections each time, the ids are loaded once per request into
+sets, and every check after that is a set lookup.
+"""
+
+from flask import g
+
+from models import db, Follows, Likes
+
+
+class Viewer:
+    """What the current user follows and likes, loaded lazily as id sets."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self._following_ids = None
+        self._liked_ids = None
+
+    @property
+    def following_ids(self):
+        """Ids of the users the viewer follows."""
+
+        if self._following_ids is None:
+            self._following_ids = {
+                user_id for (user_id,) in (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == self.user_id))
+            }
+        return self._following_ids
+
+    @property
+    def liked_ids(self):
+        """Ids of the messages the viewer has liked."""
+
+        if self._liked_ids is None:
+            self._liked_ids = {
+                message_id for (message_id,) in (db.session
+                    .query(Likes.message_id)
+                    .filter(Likes.user_id == self.user_id))
+            }
+        return self._liked_ids
+
+    def is_following(self, user):
+        return user.id in self.following_ids
+
+    def has_liked(self, message):
+        return message.id in self.liked_ids
+
+    def invalidate(self):
+        """Forget the loaded sets after the viewer's follows or likes change."""
+
+        self._following_ids = None
+        self._liked_ids = None
+
+
+def load_viewer(user):
+    """Attach a `Viewer` for `user` (or None if logged out) to `g`."""
+
+    g.viewer = Viewer(user.id) if user else None
+    return g.viewer